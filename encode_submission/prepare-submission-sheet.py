@@ -25,6 +25,7 @@ from htsworkflow.util.api import (
     make_auth_from_opts,
     HtswApi,
 )
+from htsworkflow.util.fastqindex import load_sequence_index
 from encoded_client.hashfile import make_md5sum
 from encoded_client.rdfhelp import load_into_model
 
@@ -283,6 +284,10 @@ class FlowcellDetails:
 
 
 def get_read_length(submission_pathname):
+    index = load_sequence_index(str(submission_pathname))
+    if index is not None and index.read_length is not None:
+        return index.read_length
+
     stream = xopen.xopen(submission_pathname, "rt")
     header = stream.readline().strip()
     sequence = stream.readline().strip()
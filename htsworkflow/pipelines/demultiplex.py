@@ -0,0 +1,353 @@
+"""Split pooled fastq files by the index barcode of each read
+
+Barcodes come from the multiplex indexes of the libraries in a lane
+(Library.index_sequences as reported by the flowcell api) or a tab
+separated file of name and index. Every barcode is expanded to the
+sequences within a number of mismatches so each read is assigned with
+a single dictionary lookup.
+"""
+from __future__ import print_function
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import json
+import logging
+from optparse import OptionParser
+import os
+import sys
+
+from htsworkflow.util.compression import open_compressed
+from htsworkflow.util.fastqindex import IndexingWriter
+from htsworkflow.util.fastqio import read_fastq_batches, FastqWriter
+from htsworkflow.util.opener import autoopen
+
+LOGGER = logging.getLogger(__name__)
+
+BASES = b'ACGTN'
+UNDETERMINED = 'Undetermined'
+# each library gets a smaller buffer than FastqWriter's default
+# since there may be many of them
+WRITER_BUFFER_SIZE = 256 * 1024
+
+
+def expand_barcode(sequence, mismatches=1):
+    """Return the set of sequences within mismatches substitutions
+    """
+    sequence = sequence.upper()
+    expanded = set([sequence])
+    for count in range(1, mismatches + 1):
+        for positions in itertools.combinations(range(len(sequence)), count):
+            choices = [[b for b in BASES if b != sequence[p]]
+                       for p in positions]
+            for replacement in itertools.product(*choices):
+                variant = bytearray(sequence)
+                for p, b in zip(positions, replacement):
+                    variant[p] = b
+                expanded.add(bytes(variant))
+    return expanded
+
+
+def make_barcode_table(barcodes, mismatches=1):
+    """Map every acceptable observed barcode to the name it belongs to
+
+    barcodes is a dictionary of name to index sequence, dual indexes
+    are separated with a '-' and are allowed mismatches in each index.
+    Observed dual indexes are expected to be separated by a '+'.
+
+    Raises ValueError if the barcodes have different shapes or are
+    too close together to be told apart with this many mismatches.
+    """
+    table = {}
+    lengths = None
+    for name in sorted(barcodes):
+        parts = [p.strip().encode('ascii')
+                 for p in barcodes[name].split('-')]
+        part_lengths = tuple(len(p) for p in parts)
+        if lengths is None:
+            lengths = part_lengths
+        elif part_lengths != lengths:
+            raise ValueError(
+                "Barcode %s for %s isn't the same length as the others" % (
+                    barcodes[name], name))
+
+        expanded = [expand_barcode(p, mismatches) for p in parts]
+        for variant in itertools.product(*expanded):
+            key = b'+'.join(variant)
+            other = table.setdefault(key, name)
+            if other != name:
+                raise ValueError(
+                    "Barcodes for %s and %s are within %d mismatches "
+                    "(both match %s)" % (other, name, mismatches,
+                                         key.decode('ascii')))
+    return table, lengths
+
+
+def pooled_barcodes(flowcell_info, lane):
+    """Return name to index sequence for the pooled libraries in lane
+
+    flowcell_info is what retrieve_config.retrieve_flowcell_info returns.
+    """
+    # retrieve_config needs django settings, so only load it when used
+    from htsworkflow.pipelines.retrieve_config import format_pooled_libraries
+
+    lane_set = flowcell_info['lane_set']
+    libraries = lane_set.get(str(lane), lane_set.get(lane, []))
+    barcodes = {}
+    for library in libraries:
+        for sample in format_pooled_libraries({}, library):
+            if len(sample['Index']) > 0:
+                barcodes[sample['SampleProject']] = sample['Index']
+    return barcodes
+
+
+def load_barcodes(stream):
+    """Read name and index sequence pairs from a tab separated file
+    """
+    barcodes = {}
+    for line in stream:
+        line = line.strip()
+        if len(line) == 0 or line.startswith('#'):
+            continue
+        name, sequence = line.split('\t')[:2]
+        if name in barcodes:
+            raise ValueError("%s is listed more than once" % (name,))
+        barcodes[name] = sequence
+    return barcodes
+
+
+def get_read_barcode(header):
+    """Return the index barcode from a fastq header
+
+    Handles CASAVA 1.8 (@... 1:N:0:ACGTAC) and older (@...#ACGTAC/1)
+    headers.
+    """
+    if b' ' in header:
+        return header[header.rfind(b':') + 1:]
+    start = header.rfind(b'#') + 1
+    end = header.rfind(b'/')
+    return header[start:end if end > start else len(header)]
+
+
+class Demultiplexer(object):
+    """Assign fastq reads to libraries by their index barcode
+
+    open_output is called with a library name (or UNDETERMINED) the
+    first time a read is assigned to it and should return a binary
+    stream.
+    """
+    def __init__(self, barcodes, open_output, mismatches=1,
+                 buffer_size=WRITER_BUFFER_SIZE):
+        self.barcodes = barcodes
+        self.table, self.lengths = make_barcode_table(barcodes, mismatches)
+        self.open_output = open_output
+        self.buffer_size = buffer_size
+        self.writers = {}
+        # reads assigned to each name
+        self.counts = Counter()
+        # barcodes of the reads we couldn't assign
+        self.undetermined = Counter()
+        # undetermined reads whose index lengths didn't match
+        self.wrong_length = 0
+        self._make_key = None
+
+    def _key_function(self, barcode):
+        """Return how to turn observed barcodes into table keys
+
+        Reads often have more index cycles than the library barcodes,
+        in which case each index is trimmed to the barcode length.
+        The key function is picked from one read, other reads whose
+        index lengths differ from it get a key of None so they're left
+        undetermined rather than trimmed into the wrong library.
+        """
+        parts = barcode.split(b'+')
+        if len(parts) != len(self.lengths):
+            # nothing shaped like this can be in the table
+            return list
+        size = len(barcode)
+        if tuple(len(p) for p in parts) == self.lengths:
+            return lambda barcodes: [b if len(b) == size else None
+                                     for b in barcodes]
+        if len(parts) == 1:
+            length = self.lengths[0]
+            return lambda barcodes: [b[:length] if len(b) == size else None
+                                     for b in barcodes]
+        layout = [len(p) for p in parts]
+        lengths = self.lengths
+
+        def make_keys(barcodes):
+            keys = []
+            for b in barcodes:
+                parts = b.split(b'+')
+                if len(b) != size or list(map(len, parts)) != layout:
+                    keys.append(None)
+                else:
+                    keys.append(b'+'.join(
+                        p[:l] for p, l in zip(parts, lengths)))
+            return keys
+        return make_keys
+
+    def _get_writer(self, name):
+        writer = self.writers.get(name)
+        if writer is None:
+            writer = FastqWriter(self.open_output(name), self.buffer_size)
+            self.writers[name] = writer
+        return writer
+
+    def add_lines(self, lines):
+        """Assign a batch of fastq lines from read_fastq_batches
+        """
+        headers = lines[0::4]
+        barcodes = [get_read_barcode(h) for h in headers]
+        if self._make_key is None and len(barcodes) > 0:
+            self._make_key = self._key_function(barcodes[0])
+        keys = self._make_key(barcodes)
+        self.wrong_length += keys.count(None)
+        names = list(map(self.table.get, keys))
+
+        groups = {}
+        for i, name in enumerate(names):
+            group = groups.get(name)
+            if group is None:
+                groups[name] = group = []
+            group.append(i)
+
+        for name, group in groups.items():
+            if name is None:
+                self.undetermined.update([barcodes[i] for i in group])
+                name = UNDETERMINED
+            self.counts[name] += len(group)
+            records = [None] * (len(group) * 4)
+            for j in range(4):
+                records[j::4] = [lines[i * 4 + j] for i in group]
+            self._get_writer(name).write_lines(records)
+
+    def run(self, stream):
+        """Assign all the reads in stream
+        """
+        for lines in read_fastq_batches(stream):
+            self.add_lines(lines)
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+
+    def report(self, top=10):
+        """Return a json serializable dictionary of read counts
+        """
+        counts = dict((name, self.counts[name]) for name in self.barcodes)
+        return {
+            'barcodes': self.barcodes,
+            'counts': counts,
+            'undetermined': self.counts[UNDETERMINED],
+            'wrong_length': self.wrong_length,
+            'top_undetermined': [
+                (barcode.decode('ascii'), count)
+                for barcode, count in self.undetermined.most_common(top)],
+        }
+
+
+def make_parser():
+    parser = OptionParser("%prog: [options] fastq+")
+    parser.add_option('-b', '--barcodes', default=None,
+                      help='tab separated file of name and index sequence')
+    parser.add_option('-f', '--flowcell', default=None,
+                      help='use the barcodes of pooled libraries in this '
+                           'flowcell')
+    parser.add_option('-l', '--lane', default=None,
+                      help='lane of --flowcell to use')
+    parser.add_option('-u', '--url', default=None,
+                      help='flowcell api server')
+    parser.add_option('-m', '--mismatches', default=1, type='int',
+                      help='mismatches allowed in each index')
+    parser.add_option('-o', '--output-dir', default='.',
+                      help='directory to write <name>.fastq files into')
+    parser.add_option('--gzip', default=False, action='store_true',
+                      help='gzip output')
+    parser.add_option('--bzip', default=False, action='store_true',
+                      help='bzip output')
+    parser.add_option('--threads', default=1, type='int',
+                      help='number of threads shared by all the outputs '
+                           'for compression')
+    parser.add_option('--report', default=None,
+                      help='write json read counts to this file')
+    parser.add_option('-v', '--verbose', default=False, action='store_true',
+                      help="show what we're doing")
+    return parser
+
+
+def main(cmdline=None):
+    parser = make_parser()
+    opts, args = parser.parse_args(cmdline)
+
+    if opts.verbose:
+        logging.basicConfig(level=logging.INFO)
+    else:
+        logging.basicConfig(level=logging.WARN)
+
+    if len(args) == 0:
+        parser.error("Please specify fastq files to demultiplex")
+
+    if opts.barcodes is not None:
+        with open(opts.barcodes) as stream:
+            barcodes = load_barcodes(stream)
+    elif opts.flowcell is not None and opts.lane is not None \
+         and opts.url is not None:
+        from htsworkflow.pipelines.retrieve_config import \
+             retrieve_flowcell_info
+        flowcell_info = retrieve_flowcell_info(opts.url, opts.flowcell)
+        barcodes = pooled_barcodes(flowcell_info, opts.lane)
+    else:
+        parser.error("Please specify --barcodes or --flowcell, --lane "
+                     "and --url")
+    if len(barcodes) == 0:
+        parser.error("No barcodes found")
+
+    extension = '.fastq'
+    compression = None
+    if opts.gzip:
+        compression = '.gz'
+    elif opts.bzip:
+        compression = '.bz2'
+    if compression is not None:
+        extension += compression
+
+    # every library's writer shares the same compression threads
+    executor = None
+    if compression is not None and opts.threads > 1:
+        executor = ThreadPoolExecutor(opts.threads)
+
+    def open_output(name):
+        pathname = os.path.join(opts.output_dir, name + extension)
+        LOGGER.info("Writing %s", pathname)
+        return IndexingWriter(
+            open_compressed(pathname, compression, opts.threads,
+                            executor=executor), pathname)
+
+    demultiplexer = Demultiplexer(barcodes, open_output, opts.mismatches)
+    try:
+        for filename in args:
+            with autoopen(filename, 'rb') as stream:
+                demultiplexer.run(stream)
+    finally:
+        demultiplexer.close()
+        if executor is not None:
+            executor.shutdown()
+
+    report = demultiplexer.report()
+    if report['wrong_length'] > 0:
+        LOGGER.warning("%d reads had index lengths different from the "
+                       "first read and were left undetermined",
+                       report['wrong_length'])
+    for name in sorted(report['counts']):
+        print('%s\t%s\t%d' % (name, barcodes[name], report['counts'][name]))
+    print('%s\t\t%d' % (UNDETERMINED, report['undetermined']))
+    if opts.report is not None:
+        with open(opts.report, 'w') as stream:
+            json.dump(report, stream, indent=1, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
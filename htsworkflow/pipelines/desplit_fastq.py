@@ -7,16 +7,16 @@ from glob import glob
 import os
 from optparse import OptionParser
 import sys
+import zlib
 
 from htsworkflow.util.version import version
 from htsworkflow.util.opener import autoopen, isurllike
+from htsworkflow.util.compression import open_compressed, ParallelCompressor
 from htsworkflow.util.conversion import parse_slice
-
-SEQ_HEADER = 0
-SEQUENCE = 1
-QUAL_HEADER = 2
-QUALITY = 3
-INVALID = -1
+from htsworkflow.util.fastqindex import IndexingWriter, \
+     SequenceIndexBuilder, save_sequence_index
+from htsworkflow.util.fastqio import read_fastq_batches, FastqWriter, \
+     BLOCK_SIZE
 
 
 def main(cmdline=None):
@@ -29,14 +29,25 @@ def main(cmdline=None):
         print (version())
         return 0
 
+    trim = parse_slice(opts.slice)
+    has_urls = any(isurllike(pattern, 'rt') for pattern in args)
+    if trim == slice(None) and opts.output is not None and not has_urls \
+       and not opts.bgzf:
+        # nothing to change in the records, just glue the files together
+        concatenate_fastqs(expand_patterns(args), opts.output,
+                           output_compression(opts), opts.threads)
+        return 0
+
     if opts.output is not None:
-        output = open_output(opts.output, opts)
+        output = open_output(opts.output, opts, binary=True)
     else:
-        output = sys.stdout
+        output = sys.stdout.buffer
 
     desplitter = DesplitFastq(file_generator(args), output)
-    desplitter.trim = parse_slice(opts.slice)
+    desplitter.trim = trim
     desplitter.run()
+    if opts.output is not None:
+        output.close()
 
     return 0
 
@@ -56,20 +67,162 @@ def make_parser():
                       help='gzip output')
     parser.add_option('--bzip', default=False, action='store_true',
                       help='bzip output')
+    parser.add_option('--bgzf', default=False, action='store_true',
+                      help='write seekable blocked gzip output with a '\
+                           'record index')
+    parser.add_option('--threads', default=1, type='int',
+                      help='number of threads to use compressing output')
     parser.add_option("--version", default=False, action="store_true",
                       help="report software version")
     return parser
 
 
-def open_output(output, opts):
+def open_output(output, opts, binary=False, lines_per_record=4):
     """Open output file with right compression library
+
+    Binary outputs save a sequence index of what was written when closed.
     """
-    if opts.bzip:
-        return bz2.open(output, 'wt')
+    mode = 'wb' if binary else 'wt'
+    stream = open_compressed(output, output_compression(opts),
+                             opts.threads, mode, lines_per_record)
+    if binary:
+        return IndexingWriter(stream, output, lines_per_record)
+    return stream
+
+
+def output_compression(opts):
+    """Return the file extension for the compression requested in opts
+    """
+    if opts.bgzf:
+        return '.bgzf'
+    elif opts.bzip:
+        return '.bz2'
     elif opts.gzip:
-        return gzip.open(output, 'wt')
+        return '.gz'
+    else:
+        return None
+
+
+def file_compression(filename):
+    """Return the compression extension of filename or None
+    """
+    ext = os.path.splitext(filename)[1]
+    if ext in ('.gz', '.bz2'):
+        return ext
+    return None
+
+
+def open_member(output, compression, threads=1):
+    """Start a new compressed member in an already open binary file
+    """
+    if compression is not None and threads > 1:
+        return ParallelCompressor(output, compression, threads, closefd=False)
+    elif compression == '.bz2':
+        return bz2.BZ2File(output, 'wb')
+    elif compression == '.gz':
+        return gzip.GzipFile(fileobj=output, mode='wb')
     else:
-        return open(output, 'w')
+        return output
+
+
+def copy_stream(source, target, builder):
+    """Copy source to target and builder a block at a time
+
+    Returns the last byte copied, or b'' if source was empty.
+    """
+    last = b''
+    for block in iter(lambda: source.read(BLOCK_SIZE), b''):
+        target.write(block)
+        builder.write(block)
+        last = block[-1:]
+    return last
+
+
+def make_decompressor(compression):
+    """Return a streaming decompressor for one gzip or bzip2 member
+    """
+    if compression == '.gz':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    return bz2.BZ2Decompressor()
+
+
+def copy_members(source, target, compression, builder):
+    """Copy the compressed members of source to target as is
+
+    The blocks we copy are also decompressed, in the same pass, for
+    builder. Returns the last decompressed byte, or b'' if source was
+    empty.
+    """
+    last = b''
+    decompressor = make_decompressor(compression)
+    for block in iter(lambda: source.read(BLOCK_SIZE), b''):
+        target.write(block)
+        while len(block) > 0:
+            data = decompressor.decompress(block)
+            if len(data) > 0:
+                builder.write(data)
+                last = data[-1:]
+            if not decompressor.eof:
+                break
+            # the next member starts in what's left of the block
+            block = decompressor.unused_data.lstrip(b'\0')
+            decompressor = make_decompressor(compression)
+    return last
+
+
+def concatenate_fastqs(filenames, output_name, compression=None, threads=1):
+    """Concatenate fastq files without looking at their records
+
+    Sources that are already compressed the way we want the output to
+    be have their compressed data copied as is, since both gzip and
+    bzip2 allow concatenating compressed members. Other sources are
+    decompressed and copied (as a new compressed member if needed).
+    A source that doesn't end with a newline gets one added so it
+    isn't joined to the next file's first header. Every source is read
+    and decompressed once, which is also used to save a sequence index
+    of the output.
+
+    Returns the number of files copied.
+    """
+    files_read = 0
+    builder = SequenceIndexBuilder()
+    with open(output_name, 'wb') as output:
+        for filename in filenames:
+            files_read += 1
+            if compression is not None and \
+               file_compression(filename) == compression:
+                with open(filename, 'rb') as source:
+                    last = copy_members(source, output, compression,
+                                        builder)
+                if last not in (b'', b'\n'):
+                    target = open_member(output, compression)
+                    target.write(b'\n')
+                    target.close()
+                    builder.write(b'\n')
+            else:
+                with autoopen(filename, 'rb') as source:
+                    target = open_member(output, compression, threads)
+                    if copy_stream(source, target, builder) not in \
+                       (b'', b'\n'):
+                        target.write(b'\n')
+                        builder.write(b'\n')
+                    if target is not output:
+                        target.close()
+
+    if files_read == 0:
+        raise RuntimeError("No files processed")
+    index = builder.finish()
+    index.set_source(output_name)
+    save_sequence_index(output_name, index)
+    return files_read
+
+
+def expand_patterns(pattern_list):
+    """Given a list of glob patterns yield matching filenames
+    """
+    for pattern in pattern_list:
+        for filename in glob(pattern):
+            yield filename
 
 
 def file_generator(pattern_list):
@@ -80,11 +233,32 @@ def file_generator(pattern_list):
             yield autoopen(pattern, 'rt')
         else:
             for filename in glob(pattern):
-                yield autoopen(filename, 'rt')
+                yield autoopen(filename, 'rb')
+
+
+def copy_blocks(stream, writer):
+    """Copy stream to a FastqWriter a block at a time
+
+    A newline is added if stream doesn't end with one.
+    """
+    last = b''
+    while True:
+        block = stream.read(BLOCK_SIZE)
+        if len(block) == 0:
+            break
+        if isinstance(block, str):
+            block = block.encode('utf-8')
+        writer.write(block)
+        last = block[-1:]
+    if last not in (b'', b'\n'):
+        writer.write(b'\n')
 
 
 class DesplitFastq(object):
-    """Merge multiple fastq files into a single file"""
+    """Merge multiple fastq files into a single file
+
+    Each of the source streams is closed once it has been copied.
+    """
     def __init__(self, sources, destination):
         self.sources = sources
         self.destination = destination
@@ -97,25 +271,25 @@ class DesplitFastq(object):
 
         This is here so we can run via threading/multiprocessing APIs
         """
-        state = SEQ_HEADER
+        writer = FastqWriter(self.destination)
+        trimming = self.trim != slice(None)
         files_read = 0
         for stream in self.sources:
             files_read += 1
-            for line in stream:
-                line = line.rstrip()
-                if state == SEQ_HEADER:
-                    self.destination.write(line)
-                    state = SEQUENCE
-                elif state == SEQUENCE:
-                    self.destination.write(line[self.trim])
-                    state = QUAL_HEADER
-                elif state == QUAL_HEADER:
-                    self.destination.write(line)
-                    state = QUALITY
-                elif state == QUALITY:
-                    self.destination.write(line[self.trim])
-                    state = SEQ_HEADER
-                self.destination.write(os.linesep)
+            try:
+                if not trimming:
+                    # records are unchanged, so pass the blocks straight
+                    # through
+                    copy_blocks(stream, writer)
+                    continue
+
+                for lines in read_fastq_batches(stream, allow_partial=True):
+                    lines[1::4] = [line[self.trim] for line in lines[1::4]]
+                    lines[3::4] = [line[self.trim] for line in lines[3::4]]
+                    writer.write_lines(lines)
+            finally:
+                stream.close()
+        writer.flush()
 
         if files_read == 0:
             raise RuntimeError("No files processed")
@@ -3,19 +3,28 @@ Analyze ELAND files
 """
 from __future__ import print_function
 
-from collections import namedtuple
+from collections import Counter, namedtuple
 from collections.abc import MutableMapping, Mapping
 from glob import glob
+import hashlib
+from itertools import islice
 import logging
+import multiprocessing
 import os
 import re
 import stat
 import sys
+import time
+
+import numpy
 
 from htsworkflow.pipelines import ElementTree
 from htsworkflow.pipelines.samplekey import SampleKey
 from htsworkflow.pipelines.genomemap import GenomeMap
+from htsworkflow.util.conversion import parse_sample
+from htsworkflow.util.makebed import create_bed_header, make_bed_line
 from htsworkflow.util.opener import autoopen
+from htsworkflow.util.sampling import sample_records
 
 LOGGER = logging.getLogger(__name__)
 
@@ -37,6 +46,14 @@ ELAND_MULTI = 1
 ELAND_EXTENDED = 2
 ELAND_EXPORT = 3
 
+# how many bytes the block based parsers read at a time
+BLOCK_SIZE = 4 * 1024 ** 2
+
+# sidecar files caching the counts for an eland file
+ELAND_SUMMARY = 'ElandSummary'
+ELAND_SUMMARY_VERSION = 1
+ELAND_SUMMARY_SUFFIX = '.summary.xml'
+
 
 class ResultLane(object):
     """
@@ -88,6 +105,11 @@ class ElandLane(ResultLane):
     XML_VERSION = 2
     LANE = "ElandLane"
     MATCH_COUNTS_RE = re.compile(r"([\d]+):([\d]+):([\d]+)")
+    # the match (10) and, if present, descriptor (13) columns of each
+    # export line, splitting on runs of whitespace like str.split does
+    EXPORT_COLUMNS_RE = re.compile(
+        br"^[ \t]*(?:[^\s]+[ \t]+){10}([^\s]+)"
+        br"(?:[ \t]+[^\s]+[ \t]+[^\s]+[ \t]+([^\s]+))?", re.M)
     DESCRIPTOR_MISMATCH_RE = re.compile(r"[AGCT]")
     DESCRIPTOR_INDEL_RE = re.compile(r"^[\dAGCT]$")
     SCORE_UNRECOGNIZED = 0
@@ -95,7 +117,8 @@ class ElandLane(ResultLane):
     SCORE_READ = 2
 
     def __init__(self, pathnames=None, sample=None, lane_id=None, end=None,
-                 genome_map=None, eland_type=None, xml=None):
+                 genome_map=None, eland_type=None, xml=None, num_jobs=1,
+                 use_cache=True, read_sample=None):
         super(ElandLane, self).__init__(pathnames, sample, lane_id, end)
 
         self._mapped_reads = None
@@ -103,6 +126,15 @@ class ElandLane(ResultLane):
         self._reads = None
         self.genome_map = GenomeMap(genome_map)
         self.eland_type = None
+        # number of worker processes to use when counting reads
+        self.num_jobs = num_jobs
+        # save/reuse per file summaries in sidecar files
+        self.use_cache = use_cache
+        # fraction or number of reads of each file to count for a quick
+        # look, sampled counts are never cached
+        self.read_sample = read_sample
+        # pathname -> (bytes counted, summary) for update_incremental
+        self._progress = {}
 
         if xml is not None:
             self.set_elements(xml)
@@ -146,58 +178,239 @@ class ElandLane(ResultLane):
             raise RuntimeError("Eland isn't done, try again later.")
 
         LOGGER.debug("summarizing results for %s" % (pathname))
-        self._match_codes = MatchCodes()
-        self._mapped_reads = MappedReads()
-        self._reads = 0
+        if self.read_sample is not None:
+            self._match_codes, self._mapped_reads, self._reads = \
+                merge_eland_summaries([self._summarize_sample(p)
+                                       for p in self.pathnames])
+            return
 
+        results = []
+        pending = []
         for pathname in self.pathnames:
-            stream = autoopen(pathname, 'rt')
-            if self.eland_type == ELAND_SINGLE:
-                result = self._update_eland_result(stream)
-            elif self.eland_type in (ELAND_MULTI, ELAND_EXTENDED):
-                result = self._update_eland_multi(stream)
-            elif self.eland_type == ELAND_EXPORT:
-                result = self._update_eland_export(stream)
+            cached = None
+            if self.use_cache:
+                cached = load_eland_summary(pathname, self.eland_type,
+                                            self.genome_map)
+            if cached is None:
+                pending.append(pathname)
             else:
-                errmsg = "Only support single/multi/extended eland files"
-                raise NotImplementedError(errmsg)
-            stream.close()
+                LOGGER.debug("using cached summary for %s" % (pathname,))
+                results.append(cached)
+
+        if len(pending) > 0:
+            if self.num_jobs is not None and self.num_jobs > 1:
+                counted = self._update_parallel(pending)
+            else:
+                counted = self._update_serial(pending)
+
+            for pathname, result in zip(pending, counted):
+                if self.use_cache:
+                    save_eland_summary(pathname, self.eland_type,
+                                       self.genome_map, result)
+                results.append(result)
+
+        self._match_codes, self._mapped_reads, self._reads = \
+            merge_eland_summaries(results)
+
+    def update_incremental(self):
+        """Count only what was added to our eland files since the last call
+
+        This is for watching eland files that GERALD is still writing.
+        Only complete lines of uncompressed files are counted, and the
+        next call picks up where this one stopped. Compressed files are
+        counted once they can be completely decompressed.
+
+        Returns the number of newly counted reads.
+        """
+        if self.pathnames is None or len(self.pathnames) == 0:
+            return 0
+        self._guess_eland_type(self.pathnames[-1])
+
+        new_reads = 0
+        for pathname in self.pathnames:
+            if not os.path.exists(pathname):
+                continue
+            info = os.stat(pathname)
+            size = info.st_size
+            # checked is the (size, mtime) compressed files were last read at
+            offset, checked, summary = self._progress.get(
+                pathname, (0, None, None))
+            if size < offset:
+                LOGGER.info("%s shrank, recounting" % (pathname,))
+                offset, checked, summary = 0, None, None
+                del self._progress[pathname]
+
+            if is_compressed(pathname):
+                # compressed files can only be counted whole, so don't
+                # read them again until they've changed
+                if checked == (size, info.st_mtime):
+                    continue
+                checked = (size, info.st_mtime)
+                try:
+                    counted = self._summarize_chunk(pathname)
+                except EOFError:
+                    LOGGER.debug("%s is incomplete" % (pathname,))
+                else:
+                    new_reads += counted[2] - (summary[2] if summary else 0)
+                    summary = counted
+                    offset = size
+            else:
+                end = find_last_newline(pathname, offset, size)
+                if end > offset:
+                    added = self._summarize_chunk(pathname, offset, end)
+                    new_reads += added[2]
+                    if summary is None:
+                        summary = added
+                    else:
+                        summary = merge_eland_summaries([summary, added])
+                    offset = end
+            self._progress[pathname] = (offset, checked, summary)
+
+        self._match_codes, self._mapped_reads, self._reads = \
+            merge_eland_summaries(
+                [summary for offset, checked, summary
+                 in self._progress.values() if summary is not None])
+        return new_reads
+
+    def _update_serial(self, pathnames):
+        """Summarize each of pathnames in this process
+        """
+        for pathname in pathnames:
+            yield self._summarize_chunk(pathname)
+
+    def _update_parallel(self, pathnames):
+        """Summarize chunks of pathnames with a pool of processes
+
+        Uncompressed files are split into newline aligned byte ranges,
+        compressed files are handed to a worker as a whole.
+        Returns one merged summary for each of pathnames.
+        """
+        genome_map = dict(self.genome_map)
+        tasks = []
+        owners = []
+        for i, pathname in enumerate(pathnames):
+            for start, end in make_eland_chunks(pathname, self.num_jobs):
+                tasks.append((self.eland_type, genome_map, pathname, start, end))
+                owners.append(i)
+
+        LOGGER.debug("summarizing %d chunks with %d processes",
+                     len(tasks), self.num_jobs)
+        pool = multiprocessing.Pool(min(self.num_jobs, len(tasks)))
+        try:
+            chunks = pool.map(_summarize_eland_chunk, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        per_file = [[] for pathname in pathnames]
+        for i, result in zip(owners, chunks):
+            per_file[i].append(result)
+        return [merge_eland_summaries(results) for results in per_file]
+
+    def _summarize_chunk(self, pathname, start=0, end=None):
+        """Count the reads in the byte range [start, end) of pathname
+
+        Export files go through the block parser, everything else is
+        read a line at a time.
+        """
+        if self.eland_type == ELAND_EXPORT:
+            blocks = read_eland_blocks(pathname, start, end)
+            name = pathname
+            if start > 0:
+                name = '%s (from byte %d)' % (pathname, start)
+            return self._update_eland_export_blocks(blocks, name)
+        return self._summarize_stream(read_eland_chunk(pathname, start, end))
+
+    def _summarize_sample(self, pathname):
+        """Count a sample of the reads in pathname
+        """
+        batches = sample_records(pathname, self.read_sample,
+                                 lines_per_record=1)
+        if self.eland_type == ELAND_EXPORT:
+            return self._update_eland_export_blocks(
+                (b'\n'.join(lines) + b'\n' for lines in batches),
+                'sample of %s' % (pathname,))
+        return self._summarize_records(
+            line.decode().split() for lines in batches for line in lines)
+
+    def _summarize_stream(self, stream):
+        """Count the reads in stream according to our eland type
+        """
+        pipeline = ElandPipeline()
+        counter = pipeline.add(CountConsumer(self))
+        pipeline.run(stream)
+        return counter.result
+
+    def _summarize_records(self, records):
+        """Count a sequence of split eland lines according to our eland type
+        """
+        if self.eland_type == ELAND_SINGLE:
+            return self._count_eland_result(records)
+        elif self.eland_type in (ELAND_MULTI, ELAND_EXTENDED):
+            return self._count_eland_multi(records)
+        elif self.eland_type == ELAND_EXPORT:
+            return self._count_eland_export(records)
+        else:
+            errmsg = "Only support single/multi/extended eland files"
+            raise NotImplementedError(errmsg)
 
-            match, mapped, reads = result
-            self._match_codes += match
-            self._mapped_reads += mapped
-            self._reads += reads
+    def _make_mapped_reads(self):
+        """Return an empty MappedReads with our genome's contigs interned
+        """
+        return MappedReads(contigs=sorted(set(self.genome_map.values())))
 
     def _update_eland_result(self, instream):
+        return self._count_eland_result(line.split() for line in instream)
+
+    def _count_eland_result(self, records):
         reads = 0
-        mapped_reads = MappedReads()
+        mapped_reads = self._make_mapped_reads()
         match_codes = MatchCodes()
+        code_slots = MatchCodes.CODE_SLOTS
+        code_counts = [0] * len(code_slots)
+        # eland chromosome name -> MappedReads slot
+        contig_slots = {}
+        contig_counts = []
 
-        for line in instream:
+        for fields in records:
             reads += 1
-            fields = line.split()
-            # code = fields[2]
-            # match_codes[code] = match_codes.setdefault(code, 0) + 1
             # the QC/NM etc codes are in the 3rd field and always present
-            match_codes[fields[2]] += 1
+            try:
+                code_counts[code_slots[fields[2]]] += 1
+            except KeyError:
+                errmsg = "Unrecognized key, allowed values are: %s"
+                raise ValueError(errmsg % (",".join(MatchCodes.CODES)))
             # ignore lines that don't have a fasta filename
             if len(fields) < 7:
                 continue
-            fasta = self.genome_map.get(fields[6], fields[6])
-            mapped_reads[fasta] = mapped_reads.setdefault(fasta, 0) + 1
+            slot = contig_slots.get(fields[6])
+            if slot is None:
+                fasta = self.genome_map.get(fields[6], fields[6])
+                slot = mapped_reads.intern(fasta)
+                contig_slots[fields[6]] = slot
+                contig_counts.extend([0] * (slot + 1 - len(contig_counts)))
+            contig_counts[slot] += 1
+
+        match_codes.add_counts(code_counts)
+        mapped_reads.add_counts(contig_counts)
         return match_codes, mapped_reads, reads
 
     def _update_eland_multi(self, instream):
         """Summarize an eland_extend."""
+        return self._count_eland_multi(line.split() for line in instream)
+
+    def _count_eland_multi(self, records):
+        """Summarize split eland_multi/extended lines."""
         MATCH_INDEX = 2
         LOCATION_INDEX = 3
         reads = 0
-        mapped_reads = MappedReads()
+        mapped_reads = self._make_mapped_reads()
         match_codes = MatchCodes()
+        # plain dictionary is faster to increment per read
+        hits = {}
 
-        for line in instream:
+        for fields in records:
             reads += 1
-            fields = line.split()
             # fields[2] = QC/NM/or number of matches
             score_type = self._score_mapped_mismatches(fields[MATCH_INDEX],
                                                        match_codes)
@@ -209,22 +422,26 @@ class ElandLane(ResultLane):
                 if len(fields) < 4 or fields[LOCATION_INDEX] == '-':
                     continue
 
-                self._count_mapped_multireads(mapped_reads, fields[LOCATION_INDEX])
+                self._count_mapped_multireads(hits, fields[LOCATION_INDEX])
 
+        mapped_reads += MappedReads(hits)
         return match_codes, mapped_reads, reads
 
     def _update_eland_export(self, instream):
         """Summarize a gerald export file."""
+        return self._count_eland_export(line.split() for line in instream)
+
+    def _count_eland_export(self, records):
+        """Summarize split gerald export lines."""
         MATCH_INDEX = 10
         LOCATION_INDEX = 10
         DESCRIPTOR_INDEX = 13
         reads = 0
-        mapped_reads = MappedReads()
+        mapped_reads = self._make_mapped_reads()
         match_codes = MatchCodes()
 
-        for line in instream:
+        for fields in records:
             reads += 1
-            fields = line.split()
             # fields[2] = QC/NM/or number of matches
             score_type = self._score_mapped_mismatches(fields[MATCH_INDEX],
                                                        match_codes)
@@ -242,9 +459,91 @@ class ElandLane(ResultLane):
 
         return match_codes, mapped_reads, reads
 
-    def _score_mapped_mismatches(self, match, match_codes):
+    def _update_eland_export_blocks(self, blocks, name='export file'):
+        """Summarize a gerald export file from an iterable of byte blocks
+
+        Instead of scoring every read, the match and
+        (location, descriptor) columns of each block are tallied and
+        each distinct value is only scored once.
+
+        Raises ValueError naming name and the line if a line is missing
+        columns.
+        """
+        reads = 0
+        mapped_reads = self._make_mapped_reads()
+        match_codes = MatchCodes()
+        match_counts = Counter()
+        hit_counts = Counter()
+
+        remainder = b''
+        for block in blocks:
+            block = remainder + block
+            end = block.rfind(b'\n') + 1
+            remainder = block[end:]
+            reads += self._tally_export_block(block[:end], match_counts,
+                                              hit_counts, name, reads)
+        reads += self._tally_export_block(remainder, match_counts, hit_counts,
+                                          name, reads)
+
+        for match, count in match_counts.items():
+            self._score_mapped_mismatches(match.decode(), match_codes, count)
+        for (chromo, descriptor), count in hit_counts.items():
+            code = self._count_mapped_export(mapped_reads,
+                                             chromo.decode(),
+                                             descriptor.decode(),
+                                             count)
+            match_codes[code] += count
+
+        return match_codes, mapped_reads, reads
+
+    def _tally_export_block(self, block, match_counts, hit_counts,
+                            name='export file', first_line=0):
+        """Count match values and unique hits for a block of export lines
+
+        The columns are pulled out of the whole block with one regular
+        expression instead of splitting each line. first_line is how
+        many lines came before the block, for error messages.
+        Returns the number of reads seen.
+        """
+        lines = block.count(b'\n')
+        if len(block) > 0 and not block.endswith(b'\n'):
+            lines += 1
+        columns = Counter(ElandLane.EXPORT_COLUMNS_RE.findall(block))
+        if sum(columns.values()) != lines:
+            # some line doesn't have a match column
+            raise self._export_line_error(block, name, first_line)
+
+        for (match, descriptor), count in columns.items():
+            match_counts[match] += count
+            if is_export_location(match):
+                if len(descriptor) == 0:
+                    raise self._export_line_error(block, name, first_line)
+                hit_counts[(match, descriptor)] += count
+        return lines
+
+    def _export_line_error(self, block, name, first_line):
+        """Return a ValueError describing the first bad line of block
+        """
+        lines = block.split(b'\n')
+        if block.endswith(b'\n'):
+            lines.pop()
+        for i, line in enumerate(lines):
+            fields = line.split()
+            if len(fields) < 11:
+                errmsg = "%s line %d: expected at least 11 columns, got %d"
+                return ValueError(errmsg % (name, first_line + i + 1,
+                                            len(fields)))
+            elif is_export_location(fields[10]) and len(fields) < 14:
+                errmsg = "%s line %d: mapped read is missing its descriptor"
+                return ValueError(errmsg % (name, first_line + i + 1))
+        return ValueError("%s: unable to parse export lines after line %d" % (
+            name, first_line))
+
+    def _score_mapped_mismatches(self, match, match_codes, count=1):
         """Update match_codes with eland map counts, or failure code.
 
+        count is how many reads had this match value.
+
         Returns True if the read mapped, false if it was an error code.
         """
         groups = ElandLane.MATCH_COUNTS_RE.match(match)
@@ -252,7 +551,7 @@ class ElandLane(ResultLane):
             # match is not of the form [\d]+:[\d]+:[\d]+
             if match in match_codes:
                 # match is one quality control codes QC/NM etc
-                match_codes[match] += 1
+                match_codes[match] += count
                 return ElandLane.SCORE_QC
             else:
                 return ElandLane.SCORE_UNRECOGNIZED
@@ -264,19 +563,19 @@ class ElandLane(ResultLane):
             two_mismatches = int(groups.group(3))
 
             if zero_mismatches == 1:
-                match_codes['U0'] += 1
+                match_codes['U0'] += count
             elif zero_mismatches < 255:
-                match_codes['R0'] += zero_mismatches
+                match_codes['R0'] += zero_mismatches * count
 
             if one_mismatches == 1:
-                match_codes['U1'] += 1
+                match_codes['U1'] += count
             elif one_mismatches < 255:
-                match_codes['R1'] += one_mismatches
+                match_codes['R1'] += one_mismatches * count
 
             if two_mismatches == 1:
-                match_codes['U2'] += 1
+                match_codes['U2'] += count
             elif two_mismatches < 255:
-                match_codes['R2'] += two_mismatches
+                match_codes['R2'] += two_mismatches * count
 
             return ElandLane.SCORE_READ
 
@@ -291,12 +590,14 @@ class ElandLane(ResultLane):
             assert fasta is not None
             mapped_reads[fasta] = mapped_reads.setdefault(fasta, 0) + 1
 
-    def _count_mapped_export(self, mapped_reads, match_string, descriptor):
+    def _count_mapped_export(self, mapped_reads, match_string, descriptor,
+                             count=1):
         """Count a read as defined in an export file
 
         match_string contains the chromosome
         descriptor contains the an ecoding of bases that match, mismatch,
                    and have indels.
+        count is how many reads had this location and descriptor
         returns the "best" match code
 
         Currently "best" match code is ignoring the possibility of in-dels
@@ -304,7 +605,7 @@ class ElandLane(ResultLane):
         chromo = match_string
         fasta = self.genome_map.get(chromo, chromo)
         assert fasta is not None
-        mapped_reads[fasta] = mapped_reads.setdefault(fasta, 0) + 1
+        mapped_reads[fasta] = mapped_reads.setdefault(fasta, 0) + count
 
         mismatch_bases = ElandLane.DESCRIPTOR_MISMATCH_RE.findall(descriptor)
         if len(mismatch_bases) == 0:
@@ -441,57 +742,84 @@ class ElandLane(ResultLane):
 class MatchCodes(MutableMapping):
     """Mapping to hold match counts -
     supports combining two match count sets together
+
+    The counts are kept in a fixed size numpy array indexed by match
+    code, so combining two sets of counts is a vector add.
     """
+    CODES = ('NM', 'QC', 'RM', 'U0', 'U1', 'U2', 'R0', 'R1', 'R2')
+    CODE_SLOTS = dict((code, slot) for slot, code in enumerate(CODES))
+
     def __init__(self, initializer=None):
-        self.match_codes = {'NM': 0, 'QC': 0, 'RM': 0,
-                            'U0': 0, 'U1': 0, 'U2': 0,
-                            'R0': 0, 'R1': 0, 'R2': 0,
-                            }
+        self.counts = numpy.zeros(len(MatchCodes.CODES), dtype=numpy.int64)
 
         if initializer is not None:
             if not isinstance(initializer, Mapping):
                 raise ValueError("Expected dictionary like class")
             for key in initializer:
-                if key not in self.match_codes:
+                if key not in MatchCodes.CODE_SLOTS:
                     errmsg = "Initializer can only contain: %s"
-                    raise ValueError(errmsg % (",".join(self.match_codes.keys())))
-                self.match_codes[key] += initializer[key]
+                    raise ValueError(errmsg % (",".join(MatchCodes.CODES)))
+                self.counts[MatchCodes.CODE_SLOTS[key]] += initializer[key]
 
     def __iter__(self):
-        return iter(self.match_codes)
+        return iter(MatchCodes.CODES)
+
+    def __contains__(self, key):
+        return key in MatchCodes.CODE_SLOTS
 
     def __delitem__(self, key):
         raise RuntimeError("delete not allowed")
 
     def __getitem__(self, key):
-        return self.match_codes[key]
+        return int(self.counts[MatchCodes.CODE_SLOTS[key]])
 
     def __setitem__(self, key, value):
-        if key not in self.match_codes:
+        slot = MatchCodes.CODE_SLOTS.get(key)
+        if slot is None:
             errmsg = "Unrecognized key, allowed values are: %s"
-            raise ValueError(errmsg % (",".join(self.match_codes.keys())))
-        self.match_codes[key] = value
+            raise ValueError(errmsg % (",".join(MatchCodes.CODES)))
+        self.counts[slot] = value
 
     def __len__(self):
-        return len(self.match_codes)
+        return len(MatchCodes.CODES)
+
+    def add_counts(self, counts):
+        """Add a sequence of counts indexed by CODE_SLOTS
+        """
+        self.counts += numpy.asarray(counts, dtype=numpy.int64)
+
+    def __iadd__(self, other):
+        if not isinstance(other, MatchCodes):
+            raise ValueError("Expected a MatchCodes, got %s", str(type(other)))
+        self.add_counts(other.counts)
+        return self
 
     def __add__(self, other):
         if not isinstance(other, MatchCodes):
             raise ValueError("Expected a MatchCodes, got %s", str(type(other)))
 
         newobj = MatchCodes(self)
-        for key, value in other.items():
-            newobj[key] = self.get(key, 0) + other[key]
-
+        newobj += other
         return newobj
 
 
 class MappedReads(MutableMapping):
     """Mapping to hold mapped reads -
     supports combining two mapped read sets together
+
+    Contig names are interned to slots in a numpy array of counts,
+    so combining read sets that interned the same contigs is a vector add.
+    Interning a contig doesn't make it a key until it has a count.
     """
-    def __init__(self, initializer=None):
-        self.mapped_reads = {}
+    def __init__(self, initializer=None, contigs=None):
+        self._slots = {}
+        self._names = []
+        self._counts = numpy.zeros(0, dtype=numpy.int64)
+        self._present = numpy.zeros(0, dtype=bool)
+
+        if contigs is not None:
+            for name in contigs:
+                self.intern(name)
 
         if initializer is not None:
             if not isinstance(initializer, Mapping):
@@ -499,29 +827,86 @@ class MappedReads(MutableMapping):
             for key in initializer:
                 self[key] = self.setdefault(key, 0) + initializer[key]
 
+    def intern(self, name):
+        """Return the array slot for contig name, allocating it if needed
+        """
+        slot = self._slots.get(name)
+        if slot is None:
+            slot = len(self._names)
+            self._slots[name] = slot
+            self._names.append(name)
+            if slot >= len(self._counts):
+                self._resize(max(16, 2 * len(self._counts)))
+        return slot
+
+    def _resize(self, size):
+        counts = numpy.zeros(size, dtype=numpy.int64)
+        counts[:len(self._counts)] = self._counts
+        present = numpy.zeros(size, dtype=bool)
+        present[:len(self._present)] = self._present
+        self._counts = counts
+        self._present = present
+
+    def add_counts(self, counts):
+        """Add a sequence of counts indexed by interned slot
+        """
+        counts = numpy.asarray(counts, dtype=numpy.int64)
+        size = len(counts)
+        self._counts[:size] += counts
+        self._present[:size] |= counts != 0
+
     def __iter__(self):
-        return iter(self.mapped_reads)
+        for slot, name in enumerate(self._names):
+            if self._present[slot]:
+                yield name
+
+    def __contains__(self, key):
+        slot = self._slots.get(key)
+        return slot is not None and bool(self._present[slot])
 
     def __delitem__(self, key):
-        del self.mapped_reads[key]
+        if key not in self:
+            raise KeyError(key)
+        slot = self._slots[key]
+        self._counts[slot] = 0
+        self._present[slot] = False
 
     def __getitem__(self, key):
-        return self.mapped_reads[key]
+        if key not in self:
+            raise KeyError(key)
+        return int(self._counts[self._slots[key]])
 
     def __setitem__(self, key, value):
-        self.mapped_reads[key] = value
+        slot = self.intern(key)
+        self._counts[slot] = value
+        self._present[slot] = True
 
     def __len__(self):
-        return len(self.mapped_reads)
+        return int(self._present.sum())
 
-    def __add__(self, other):
+    def __iadd__(self, other):
         if not isinstance(other, MappedReads):
             raise ValueError("Expected a MappedReads, got %s", str(type(other)))
 
-        newobj = MappedReads(self)
-        for key in other:
-            newobj[key] = self.get(key, 0) + other[key]
+        size = len(other._names)
+        if self._names[:size] == other._names[:len(self._names)]:
+            # one interning order extends the other
+            for name in other._names[len(self._names):]:
+                self.intern(name)
+            self._counts[:size] += other._counts[:size]
+            self._present[:size] |= other._present[:size]
+        else:
+            for key in other:
+                self[key] = self.get(key, 0) + other[key]
+        return self
 
+    def __add__(self, other):
+        if not isinstance(other, MappedReads):
+            raise ValueError("Expected a MappedReads, got %s", str(type(other)))
+
+        newobj = MappedReads(contigs=self._names)
+        newobj += self
+        newobj += other
         return newobj
 
 
@@ -634,9 +1019,13 @@ class ELAND(MutableMapping):
     SAMPLE = 'sample'
     END = 'end'
 
-    def __init__(self, xml=None):
+    def __init__(self, xml=None, num_jobs=1, read_sample=None):
         # we need information from the gerald config.xml
         self.results = {}
+        # number of processes each ElandLane may use to count reads
+        self.num_jobs = num_jobs
+        # fraction or number of reads each ElandLane should count
+        self.read_sample = read_sample
 
         if xml is not None:
             self.set_elements(xml)
@@ -699,6 +1088,36 @@ class ELAND(MutableMapping):
             key = SampleKey(lane=lane_id, read=end+1, sample=sample)
             self.results[key] = lane
 
+    def count(self, num_jobs=1):
+        """Count the reads for all of our lanes now instead of on demand
+
+        Lanes are counted concurrently on a pool of num_jobs processes.
+        Returns a dictionary of how many seconds each lane took to count.
+        """
+        keys = [key for key in self if self.results[key]._reads is None]
+        lanes = [self.results[key] for key in keys]
+        if len(lanes) == 0:
+            return {}
+
+        if num_jobs is None or num_jobs <= 1:
+            counted = [_count_lane(lane) for lane in lanes]
+        else:
+            pool = multiprocessing.Pool(min(num_jobs, len(lanes)))
+            try:
+                counted = pool.map(_count_lane_worker, lanes)
+            finally:
+                pool.close()
+                pool.join()
+
+        timings = {}
+        for key, (lane, elapsed) in zip(keys, counted):
+            if isinstance(lane, ElandLane):
+                lane.num_jobs = self.num_jobs
+            self.results[key] = lane
+            timings[key] = elapsed
+            LOGGER.info("Counted %s in %0.2f seconds" % (lane, elapsed))
+        return timings
+
     def update_result_with_eland(self, gerald, key, pathnames,
                                  genome_maps):
         # yes the lane_id is also being computed in ElandLane._update
@@ -724,7 +1143,9 @@ class ELAND(MutableMapping):
             if genome_dir is not None:
                 genome_map.scan_genome_dir(genome_dir)
 
-        lane = ElandLane(pathnames, key.sample, key.lane, key.read, genome_map)
+        lane = ElandLane(pathnames, key.sample, key.lane, key.read, genome_map,
+                         num_jobs=self.num_jobs,
+                         read_sample=self.read_sample)
 
         self.results[key] = lane
 
@@ -734,8 +1155,20 @@ class ELAND(MutableMapping):
                                          key.sample, key.lane, key.read)
 
 
-def eland(gerald_dir, gerald=None, genome_maps=None):
-    e = ELAND()
+def eland(gerald_dir, gerald=None, genome_maps=None, num_jobs=1, eager=False,
+          read_sample=None):
+    """Find and summarize the eland files in gerald_dir
+
+    num_jobs sets how many processes are used when the reads
+    for a lane are counted.
+
+    If eager is true all the lanes are counted before returning, with
+    up to num_jobs lanes being counted at once.
+
+    If read_sample is set only that fraction or number of reads of each
+    eland file is counted.
+    """
+    e = ELAND(num_jobs=num_jobs, read_sample=read_sample)
     eland_files = ElandMatches(e)
     # collect
     for path, dirnames, filenames in os.walk(gerald_dir):
@@ -744,6 +1177,8 @@ def eland(gerald_dir, gerald=None, genome_maps=None):
             eland_files.add(pathname)
     for key in eland_files:
         eland_files.count(key, gerald, genome_maps)
+    if eager:
+        e.count(num_jobs)
     return e
 
 
@@ -783,6 +1218,9 @@ class ElandMatches(MutableMapping):
         """Add pathname to our set of files
         """
         path, filename = os.path.split(pathname)
+        # don't mistake our cached summaries for eland files
+        if ELAND_SUMMARY_SUFFIX in filename:
+            return
 
         for pattern, counter, priority in self.patterns:
             rematch = re.match(pattern, filename)
@@ -873,29 +1311,469 @@ class ElandMatch(object):
         return '<ElandMatch(' + "_".join(name) + ')>'
 
 
+def make_eland_chunks(pathname, chunks):
+    """Split pathname into up to chunks newline aligned byte ranges
+
+    Returns a list of (start, end) offsets. Compressed files can't be
+    cheaply seeked into, so they are returned as a single (0, None) range.
+    """
+    if chunks is None or chunks <= 1 or is_compressed(pathname):
+        return [(0, None)]
+
+    size = os.stat(pathname)[stat.ST_SIZE]
+    boundaries = [0]
+    with open(pathname, 'rb') as stream:
+        for i in range(1, chunks):
+            offset = size * i // chunks
+            if offset <= boundaries[-1]:
+                continue
+            # reading the rest of the line containing the byte before
+            # offset leaves us at the start of a record
+            stream.seek(offset - 1)
+            stream.readline()
+            position = stream.tell()
+            if boundaries[-1] < position < size:
+                boundaries.append(position)
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def read_eland_blocks(pathname, start=0, end=None, block_size=BLOCK_SIZE):
+    """Yield blocks of bytes from the byte range [start, end) of pathname
+
+    If end is None the whole (possibly compressed) file is read.
+    """
+    if end is None:
+        stream = autoopen(pathname, 'rb')
+        remaining = None
+    else:
+        stream = open(pathname, 'rb')
+        stream.seek(start)
+        remaining = end - start
+
+    try:
+        while remaining is None or remaining > 0:
+            size = block_size if remaining is None else min(block_size,
+                                                            remaining)
+            block = stream.read(size)
+            if len(block) == 0:
+                break
+            if remaining is not None:
+                remaining -= len(block)
+            yield block
+    finally:
+        stream.close()
+
+
+def read_eland_chunk(pathname, start=0, end=None):
+    """Yield lines from the byte range [start, end) of pathname
+
+    If end is None the whole (possibly compressed) file is read.
+    """
+    if end is None:
+        stream = autoopen(pathname, 'rt')
+        try:
+            for line in stream:
+                yield line
+        finally:
+            stream.close()
+        return
+
+    with open(pathname, 'rb') as stream:
+        stream.seek(start)
+        position = start
+        for line in stream:
+            if position >= end:
+                break
+            position += len(line)
+            yield line.decode()
+
+
+def find_last_newline(pathname, start, end, block_size=64 * 1024):
+    """Return the offset just past the last newline in [start, end)
+
+    Returns start if there isn't a complete line in the range.
+    """
+    with open(pathname, 'rb') as stream:
+        position = end
+        while position > start:
+            block_start = max(start, position - block_size)
+            stream.seek(block_start)
+            block = stream.read(position - block_start)
+            newline = block.rfind(b'\n')
+            if newline != -1:
+                return block_start + newline + 1
+            position = block_start
+    return start
+
+
+def is_compressed(pathname):
+    """Does pathname have a compression extension we know how to read?
+    """
+    return os.path.splitext(pathname)[1] in ('.gz', '.bz2')
+
+
+def is_export_location(match):
+    """Is an export file match column (as bytes) the location of a unique read?
+
+    Multi-read counts contain a ':' and QC codes are in MatchCodes,
+    anything else is a location.
+    """
+    return b':' not in match and match.decode() not in MatchCodes.CODES
+
+
+def merge_eland_summaries(results):
+    """Add together a list of (MatchCodes, MappedReads, reads) tuples
+    """
+    match_codes = MatchCodes()
+    mapped_reads = MappedReads()
+    reads = 0
+    for match, mapped, count in results:
+        match_codes += match
+        mapped_reads += mapped
+        reads += count
+    return match_codes, mapped_reads, reads
+
+
+def eland_summary_pathname(pathname):
+    """Name of the sidecar file holding the cached summary of pathname
+    """
+    return pathname + ELAND_SUMMARY_SUFFIX
+
+
+def make_eland_summary_key(pathname, eland_type, genome_map):
+    """Build the attributes identifying a cached summary of pathname
+
+    If the file is replaced, or is counted as a different eland
+    type or against a different genome map the key will change.
+    """
+    info = os.stat(pathname)
+    genome = hashlib.md5()
+    for name, value in sorted(dict(genome_map).items()):
+        genome.update(("%s\t%s\n" % (name, value)).encode('utf-8'))
+    return {'filename': os.path.basename(pathname),
+            'size': str(info[stat.ST_SIZE]),
+            'mtime': repr(info.st_mtime),
+            'eland_type': str(eland_type),
+            'genome_map': genome.hexdigest()}
+
+
+def load_eland_summary(pathname, eland_type, genome_map):
+    """Return the cached (MatchCodes, MappedReads, reads) for pathname
+
+    Returns None if there isn't a cached summary or if it is stale.
+    """
+    cache_name = eland_summary_pathname(pathname)
+    if not os.path.exists(cache_name):
+        return None
+
+    try:
+        tree = ElementTree.parse(cache_name).getroot()
+    except ElementTree.ParseError as e:
+        LOGGER.warning("Unable to parse %s: %s" % (cache_name, str(e)))
+        return None
+
+    key = make_eland_summary_key(pathname, eland_type, genome_map)
+    if tree.tag != ELAND_SUMMARY or \
+       tree.attrib.get('version') != str(ELAND_SUMMARY_VERSION):
+        return None
+    for name, value in key.items():
+        if tree.attrib.get(name) != value:
+            return None
+
+    match_codes = MatchCodes()
+    mapped_reads = MappedReads()
+    reads = None
+    for element in tree:
+        tag = element.tag.lower()
+        if tag == MAPPED_READS.lower():
+            for child in element:
+                mapped_reads[child.attrib['name']] = int(child.attrib['value'])
+        elif tag == MATCH_CODES.lower():
+            for child in element:
+                match_codes[child.attrib['name']] = int(child.attrib['value'])
+        elif tag == READS.lower():
+            reads = int(element.text)
+    if reads is None:
+        return None
+    return match_codes, mapped_reads, reads
+
+
+def save_eland_summary(pathname, eland_type, genome_map, summary):
+    """Write (MatchCodes, MappedReads, reads) to the sidecar for pathname
+    """
+    match_codes, mapped_reads, reads = summary
+    key = make_eland_summary_key(pathname, eland_type, genome_map)
+    key['version'] = str(ELAND_SUMMARY_VERSION)
+    root = ElementTree.Element(ELAND_SUMMARY, key)
+    mapped = ElementTree.SubElement(root, MAPPED_READS)
+    for name, value in mapped_reads.items():
+        ElementTree.SubElement(mapped, MAPPED_ITEM,
+                               {'name': name, 'value': str(value)})
+    codes = ElementTree.SubElement(root, MATCH_CODES)
+    for name, value in match_codes.items():
+        ElementTree.SubElement(codes, MATCH_ITEM,
+                               {'name': name, 'value': str(value)})
+    count = ElementTree.SubElement(root, READS)
+    count.text = str(reads)
+
+    cache_name = eland_summary_pathname(pathname)
+    temp_name = cache_name + '.tmp'
+    try:
+        with open(temp_name, 'wb') as stream:
+            stream.write(ElementTree.tostring(root))
+        os.rename(temp_name, cache_name)
+    except (IOError, OSError) as e:
+        LOGGER.info("Unable to cache summary for %s: %s" % (pathname, str(e)))
+
+
+def _summarize_eland_chunk(task):
+    """Process pool worker to count the reads in one eland file chunk
+    """
+    eland_type, genome_map, pathname, start, end = task
+    lane = ElandLane(genome_map=genome_map)
+    lane.eland_type = eland_type
+    return lane._summarize_chunk(pathname, start, end)
+
+
+def _count_lane(lane):
+    """Count the reads in a result lane
+
+    Returns the lane and how many seconds it took.
+    """
+    start = time.time()
+    try:
+        lane._update()
+    except RuntimeError as e:
+        LOGGER.warning("Unable to count %s: %s" % (lane, str(e)))
+    return lane, time.time() - start
+
+
+def _count_lane_worker(lane):
+    """Process pool worker to count a result lane
+
+    Pool workers can't start their own pools, so the
+    lane is counted in a single process.
+    """
+    if isinstance(lane, ElandLane):
+        lane.num_jobs = 1
+    return _count_lane(lane)
+
+
+def benchmark_export_parsers(pathname):
+    """Time the line and block export parsers against pathname
+
+    Returns a list of (parser name, reads, seconds) tuples.
+    """
+    lane = ElandLane()
+    lane.eland_type = ELAND_EXPORT
+    timings = []
+
+    start = time.time()
+    stream = autoopen(pathname, 'rt')
+    match, mapped, reads = lane._update_eland_export(stream)
+    stream.close()
+    timings.append(('line', reads, time.time() - start))
+
+    start = time.time()
+    block_match, block_mapped, block_reads = lane._update_eland_export_blocks(
+        read_eland_blocks(pathname))
+    timings.append(('block', block_reads, time.time() - start))
+
+    if (dict(match), dict(mapped), reads) != \
+       (dict(block_match), dict(block_mapped), block_reads):
+        raise RuntimeError("Export parsers disagree for %s" % (pathname,))
+    return timings
+
+
 def extract_eland_sequence(instream, outstream, start, end):
     """
     Extract a chunk of sequence out of an eland file
     """
-    for line in instream:
-        record = line.split()
-        if len(record) > 1:
-            result = [record[0], record[1][start:end]]
-        else:
-            result = [record[0][start:end]]
-        outstream.write("\t".join(result))
-        outstream.write(os.linesep)
+    pipeline = ElandPipeline()
+    pipeline.add(SequenceConsumer(outstream, start, end))
+    pipeline.run(instream)
+
+
+class ElandPipeline(object):
+    """Split each line of an eland file once and share it with consumers
+
+    Lines are read and split in batches, and every registered consumer
+    is handed each batch of records (lists of whitespace separated fields).
+
+    ElandLane doesn't use a pipeline to count export files, those go
+    through _update_eland_export_blocks which tallies the columns it
+    needs from whole blocks without splitting each line.
+    """
+    def __init__(self, consumers=None, batch_size=10000):
+        self.consumers = []
+        self.batch_size = batch_size
+        if consumers is not None:
+            for consumer in consumers:
+                self.add(consumer)
+
+    def add(self, consumer):
+        """Register a consumer, returns the consumer for convenience
+        """
+        self.consumers.append(consumer)
+        return consumer
+
+    def run(self, instream):
+        """Feed every line of instream to our consumers
+        """
+        for consumer in self.consumers:
+            consumer.start()
+
+        while True:
+            lines = list(islice(instream, self.batch_size))
+            if len(lines) == 0:
+                break
+            records = [line.split() for line in lines]
+            for consumer in self.consumers:
+                consumer.consume(records)
+
+        for consumer in self.consumers:
+            consumer.finish()
+
+
+class ElandConsumer(object):
+    """Base class for something that wants to see eland records
+    """
+    def start(self):
+        """Called before the first batch of records"""
+        pass
+
+    def consume(self, records):
+        """Process a list of split eland lines"""
+        raise NotImplementedError("Consumers need to implement consume")
+
+    def finish(self):
+        """Called after the last batch of records"""
+        pass
+
+
+class CountConsumer(ElandConsumer):
+    """Count match codes and mapped reads like ElandLane does
+
+    Each batch is added to a running total, after finish() result is a
+    (MatchCodes, MappedReads, reads) tuple.
+    """
+    def __init__(self, lane):
+        self.lane = lane
+        self.result = None
+
+    def start(self):
+        self.result = merge_eland_summaries([])
+
+    def consume(self, records):
+        match_codes, mapped_reads, reads = self.result
+        match, mapped, count = self.lane._summarize_records(records)
+        match_codes += match
+        mapped_reads += mapped
+        self.result = (match_codes, mapped_reads, reads + count)
+
+
+class BedConsumer(ElandConsumer):
+    """Write eland_result records as a bed file
+    """
+    def __init__(self, outstream, name=None, description=None,
+                 chromosome_prefix='chr'):
+        self.outstream = outstream
+        self.name = name
+        self.description = description
+        self.chromosome_prefix = chromosome_prefix
+
+    def start(self):
+        self.outstream.write(create_bed_header(self.name, self.description))
+
+    def consume(self, records):
+        lines = [make_bed_line(fields, self.chromosome_prefix)
+                 for fields in records]
+        self.outstream.write("".join(line for line in lines if line))
+
+
+class SequenceConsumer(ElandConsumer):
+    """Write the [start:end] slice of each read's sequence
+    """
+    def __init__(self, outstream, start, end):
+        self.outstream = outstream
+        self.start_base = start
+        self.end_base = end
+
+    def consume(self, records):
+        start = self.start_base
+        end = self.end_base
+        lines = []
+        for record in records:
+            if len(record) > 1:
+                result = [record[0], record[1][start:end]]
+            else:
+                result = [record[0][start:end]]
+            lines.append("\t".join(result))
+            lines.append(os.linesep)
+        self.outstream.write("".join(lines))
+
+
+class HistogramConsumer(ElandConsumer):
+    """Count reads per chromosome in bins of bin_size bases
+
+    The default columns are for eland_result files, histogram is a
+    dictionary of chromosome to a Counter of bin number to reads.
+    """
+    def __init__(self, bin_size=1000000, chromosome_index=6,
+                 position_index=7):
+        self.bin_size = bin_size
+        self.chromosome_index = chromosome_index
+        self.position_index = position_index
+        self.histogram = {}
+
+    def consume(self, records):
+        chromosome_index = self.chromosome_index
+        position_index = self.position_index
+        minimum_fields = max(chromosome_index, position_index) + 1
+        hits = Counter()
+        for fields in records:
+            if len(fields) < minimum_fields:
+                continue
+            position = fields[position_index]
+            if not position.isdigit():
+                continue
+            hits[(fields[chromosome_index],
+                  int(position) // self.bin_size)] += 1
+
+        for (chromosome, bin_id), count in hits.items():
+            self.histogram.setdefault(chromosome, Counter())[bin_id] += count
 
 
 def main(cmdline=None):
     """Run eland extraction against the specified gerald directory"""
     from optparse import OptionParser
     parser = OptionParser("%prog: <gerald dir>+")
+    parser.add_option('-j', '--max-jobs', type='int', default=1,
+                      help='number of processes to use when counting reads')
+    parser.add_option('--eager', default=False, action='store_true',
+                      help='count up to --max-jobs lanes at the same time')
+    parser.add_option('--benchmark', default=False, action='store_true',
+                      help='time export file parsers on the export files '
+                           'given as arguments')
+    parser.add_option('--sample', default=None,
+                      help='only count a fraction (e.g. 0.01 or 1%) or '
+                           'number of reads from each eland file')
     opts, args = parser.parse_args(cmdline)
     logging.basicConfig(level=logging.DEBUG)
+    if opts.benchmark:
+        for a in args:
+            timings = benchmark_export_parsers(a)
+            for name, reads, seconds in timings:
+                print('%s %s: %d reads in %0.2fs (%0.0f reads/s)' % (
+                    a, name, reads, seconds, reads / max(seconds, 1e-9)))
+            print('%s block parser is %0.1fx faster' % (
+                a, timings[0][2] / max(timings[1][2], 1e-9)))
+        return
     for a in args:
         LOGGER.info("Starting scan of %s" % (a,))
-        e = eland(a)
+        e = eland(a, num_jobs=opts.max_jobs, eager=opts.eager,
+                  read_sample=parse_sample(opts.sample))
         print(ElementTree.tostring(e.get_elements()))
     return
 
@@ -2,53 +2,393 @@
 '''
 from __future__ import print_function
 
+import json
+import logging
+import multiprocessing
+from optparse import OptionParser
 import os
+import sys
+
 import numpy
 
-def summarize_hiseq_fastq(stream):
-    reads = 0
-    pass_qc = 0
-    bad_read = False
-    mean = None
-    read_length = set()
-    eol_length = len(os.linesep)
-
-    for i, line in enumerate(stream):
-        if i % 4 == 0:
-            # header  looks like this
-            # @HWI-ST0787:114:D0PMDACXX:8:1101:1605:2154 1:N:0:TAGCTT
-            # we want the :N (passed filter) or :Y (failed filter)
-            reads += 1
-            # if flag is 'N' we are not a bad read
-            bad_read = False if line[line.rfind(' ') + 3] == 'N' else True
-            if not bad_read:
-                pass_qc += 1
+from htsworkflow.pipelines.sequences import scan_for_sequences, parse_fastq
+from htsworkflow.util.conversion import parse_sample
+from htsworkflow.util.fastqio import read_fastq_batches
+from htsworkflow.util.opener import autoopen, has_record_index, open_shard
+from htsworkflow.util.sampling import sample_records
+
+LOGGER = logging.getLogger(__name__)
+
+# header  looks like this
+# @HWI-ST0787:114:D0PMDACXX:8:1101:1605:2154 1:N:0:TAGCTT
+# we want the :N (passed filter) or :Y (failed filter)
+NOT_FILTERED = ord('N')
+
+BLOCK_SIZE = 8 * 1024 ** 2
+BASES = 'ACGTN'
+# map sequence characters to their column in FastqSummary.base_counts,
+# anything we don't recognize is counted as an N
+BASE_LOOKUP = numpy.empty(256, dtype=numpy.uint8)
+BASE_LOOKUP[:] = BASES.index('N')
+for _i, _base in enumerate(BASES):
+    BASE_LOOKUP[ord(_base)] = _i
+    BASE_LOOKUP[ord(_base.lower())] = _i
+
+
+class FastqSummary(object):
+    """Per-cycle statistics of the reads in a fastq file
+
+    quality_histogram[cycle, c] counts reads with the quality character
+    c (so Q = c - 33 for Phred+33 files) at that cycle, base_counts[cycle]
+    counts each of BASES. Only reads that passed filter are included in
+    the per-cycle statistics.
+
+    Everything is kept as integer counts so summaries of separate
+    blocks, chunks or files can be added together exactly.
+    """
+    def __init__(self):
+        self.reads = 0
+        self.pass_qc = 0
+        self.read_lengths = set()
+        self.quality_histogram = numpy.zeros((0, 256), dtype=numpy.int64)
+        self.base_counts = numpy.zeros((0, len(BASES)), dtype=numpy.int64)
+
+    @property
+    def cycles(self):
+        return self.quality_histogram.shape[0]
+
+    def _resize(self, cycles):
+        """Make sure we have room for at least cycles
+        """
+        if cycles <= self.cycles:
+            return
+        extra = cycles - self.cycles
+        self.quality_histogram = numpy.vstack([
+            self.quality_histogram,
+            numpy.zeros((extra, 256), dtype=numpy.int64)])
+        self.base_counts = numpy.vstack([
+            self.base_counts,
+            numpy.zeros((extra, len(BASES)), dtype=numpy.int64)])
+
+    def add_block(self, qualities, sequences):
+        """Add reads from 2-D uint8 arrays with one read per row
+        """
+        reads, cycles = qualities.shape
+        if sequences.shape != qualities.shape:
+            raise ValueError("Sequence and quality lengths differ")
+        self._resize(cycles)
+        self.read_lengths.add(cycles)
+
+        # offset each cycle's values so one bincount fills every cycle
+        offsets = numpy.arange(cycles, dtype=numpy.int64)
+        histogram = numpy.bincount((qualities + offsets * 256).ravel(),
+                                   minlength=cycles * 256)
+        self.quality_histogram[:cycles] += histogram.reshape(cycles, 256)
+
+        bases = BASE_LOOKUP[sequences]
+        counts = numpy.bincount((bases + offsets * len(BASES)).ravel(),
+                                minlength=cycles * len(BASES))
+        self.base_counts[:cycles] += counts.reshape(cycles, len(BASES))
 
-        elif i % 4 == 3:
-            # score
-            if not bad_read:
+    def add_lines(self, lines):
+        """Add a batch of fastq lines from read_fastq_batches
+        """
+        headers = lines[0::4]
+        sequences = lines[1::4]
+        qualities = lines[3::4]
+        self.reads += len(headers)
+
+        # group the reads that passed filter by length
+        passed = {}
+        for header, sequence, quality in zip(headers, sequences, qualities):
+            # if flag is 'N' we are not a bad read
+            if header[header.rfind(b' ') + 3] != NOT_FILTERED:
                 # don't include bad reads in score
-                # score = numpy.asarray(list(line.rstrip()), dtype='c') # 3.5 min
-                #score = numpy.asarray(line[:-eol_length], dtype='c') # 2 min
-                score = numpy.asarray(line[:-eol_length], dtype='c') # 1.4 min
-                score.dtype = numpy.int8
+                continue
+            reads = passed.setdefault(len(quality), ([], []))
+            reads[0].append(quality)
+            reads[1].append(sequence)
+
+        for length, (quality, sequence) in passed.items():
+            self.pass_qc += len(quality)
+            if length == 0:
+                continue
+            quality = numpy.frombuffer(b''.join(quality), dtype=numpy.uint8)
+            sequence = numpy.frombuffer(b''.join(sequence), dtype=numpy.uint8)
+            if len(sequence) != len(quality):
+                raise ValueError("Sequence and quality lengths differ")
+            self.add_block(quality.reshape(-1, length),
+                           sequence.reshape(-1, length))
+
+    def __iadd__(self, other):
+        self.reads += other.reads
+        self.pass_qc += other.pass_qc
+        self.read_lengths.update(other.read_lengths)
+        self._resize(other.cycles)
+        self.quality_histogram[:other.cycles] += other.quality_histogram
+        self.base_counts[:other.cycles] += other.base_counts
+        return self
+
+    def __add__(self, other):
+        result = FastqSummary()
+        result += self
+        result += other
+        return result
+
+    @property
+    def mean(self):
+        """Mean quality character value at each cycle
+        """
+        if self.pass_qc == 0 or self.cycles == 0:
+            return None
+        totals = self.quality_histogram.dot(numpy.arange(256))
+        return totals / self.quality_histogram.sum(axis=1)
+
+    def to_dict(self):
+        """Return our statistics as something json can serialize
+
+        The quality histogram only lists the quality characters seen
+        at each cycle.
+        """
+        mean = self.mean
+        histogram = []
+        for counts in self.quality_histogram:
+            seen = numpy.flatnonzero(counts)
+            histogram.append(dict((chr(c), int(counts[c])) for c in seen))
+        return {
+            'reads': self.reads,
+            'pass_qc': self.pass_qc,
+            'read_lengths': sorted(self.read_lengths),
+            'mean': None if mean is None else [float(m) for m in mean],
+            'quality_histogram': histogram,
+            'bases': BASES,
+            'base_counts': self.base_counts.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Rebuild a FastqSummary from to_dict's output
+        """
+        summary = cls()
+        summary.reads = data['reads']
+        summary.pass_qc = data['pass_qc']
+        summary.read_lengths = set(data['read_lengths'])
+        summary._resize(len(data['quality_histogram']))
+        for cycle, counts in enumerate(data['quality_histogram']):
+            for c, count in counts.items():
+                summary.quality_histogram[cycle, ord(c)] = count
+        if len(data['base_counts']) > 0:
+            summary.base_counts[:] = data['base_counts']
+        return summary
+
+
+def summarize_batches(batches):
+    """Return a FastqSummary of lists of fastq lines
+    """
+    summary = FastqSummary()
+    for lines in batches:
+        summary.add_lines(lines)
+    return summary
+
+
+def summarize_fastq(stream, block_size=BLOCK_SIZE, sample=None):
+    """Return a FastqSummary of the fastq records in stream
+
+    sample is a fraction or number of reads to summarize instead of
+    every read.
+    """
+    if sample is not None:
+        return summarize_batches(sample_records(stream, sample,
+                                                block_size=block_size))
+    return summarize_batches(
+        read_fastq_batches(stream, block_size, allow_partial=True))
+
+
+def summarize_hiseq_fastq(stream, sample=None):
+    summary = summarize_fastq(stream, sample=sample)
+    return (summary.reads, summary.pass_qc, summary.mean,
+            summary.read_lengths)
+
+
+def summarize_fastq_file(pathname, sample=None):
+    """Return a FastqSummary for a (possibly compressed) fastq file
+    """
+    if sample is not None:
+        return summarize_batches(sample_records(pathname, sample))
+    with autoopen(pathname, 'rb') as instream:
+        return summarize_fastq(instream)
+
+
+def summarize_fastq_shard(task):
+    """Summarize shard of shards of a fastq file for summarize_fastq_files
+    """
+    pathname, shard, shards, sample = task
+    if shards == 1:
+        return summarize_fastq_file(pathname, sample)
+    with open_shard(pathname, shard, shards) as instream:
+        return summarize_fastq(instream)
+
+
+def summarize_fastq_files(pathnames, num_jobs=1, sample=None):
+    """Summarize many fastq files, using num_jobs processes
+
+    If we have more processes than files, files written as BGZF with a
+    record index are split into shards to use the extra processes.
+    If sample is set only that fraction or number of reads of each file
+    is summarized.
+
+    Returns a dictionary of pathname to FastqSummary
+    """
+    pathnames = list(pathnames)
+    tasks = []
+    for pathname in pathnames:
+        shards = 1
+        if num_jobs > len(pathnames) and has_record_index(pathname) and \
+           sample is None:
+            shards = num_jobs // len(pathnames)
+        tasks.extend((pathname, shard, shards, sample)
+                     for shard in range(shards))
+
+    if num_jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(num_jobs, len(tasks)))
+        try:
+            results = pool.map(summarize_fastq_shard, tasks, 1)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        results = [summarize_fastq_shard(task) for task in tasks]
+
+    summaries = {}
+    for (pathname, shard, shards, sample), summary in zip(tasks, results):
+        if pathname in summaries:
+            summaries[pathname] += summary
+        else:
+            summaries[pathname] = summary
+    return summaries
+
+
+def find_fastqs(names, create_index=False):
+    """Return SequenceFiles for fastq names and directories
+
+    Directories are searched with scan_for_sequences, fastq files
+    whose names we can't parse are returned as their pathname. If
+    create_index is set, missing sequence indexes are built.
+    """
+    fastqs = []
+    directories = []
+    for name in names:
+        if os.path.isdir(name):
+            directories.append(name)
+        else:
+            path, filename = os.path.split(os.path.abspath(name))
+            try:
+                seq = parse_fastq(path, filename)
+                if create_index:
+                    seq.load_index(create=True)
+                fastqs.append(seq)
+            except (ValueError, IndexError) as e:
+                LOGGER.info("Unable to parse fastq name %s: %s", name, e)
+                fastqs.append(name)
+    if len(directories) > 0:
+        for seq in scan_for_sequences(directories, create_index):
+            if seq.filetype in ('fastq', 'split_fastq'):
+                fastqs.append(seq)
+    return fastqs
+
+
+def get_sample_name(seq):
+    """Return the sample a SequenceFile belongs to
+    """
+    sample_dir = os.path.basename(os.path.dirname(seq.path))
+    if sample_dir.startswith('Sample_'):
+        return sample_dir
+    elif seq.project is not None and seq.index is not None:
+        return '{}_{}'.format(seq.project, seq.index)
+    return seq.project
+
+
+def rollup_summaries(fastqs, summaries):
+    """Merge per file summaries by lane, sample and library
+
+    fastqs is a list of SequenceFiles or pathnames, summaries is the
+    dictionary returned by summarize_fastq_files.
+    """
+    rollups = {'lanes': {}, 'samples': {}, 'libraries': {}}
+    for seq in fastqs:
+        if not hasattr(seq, 'path'):
+            # we don't know anything about plain pathnames
+            continue
+        summary = summaries[str(seq.path)]
+        keys = [('lanes', '{}_{}'.format(seq.flowcell, seq.lane)),
+                ('samples', get_sample_name(seq)),
+                ('libraries', seq.project)]
+        for rollup, key in keys:
+            if key is None:
+                continue
+            if key in rollups[rollup]:
+                rollups[rollup][key] += summary
+            else:
+                rollups[rollup][key] = summary + FastqSummary()
+    return rollups
+
+
+def make_summary_report(fastqs, num_jobs=1, sample=None):
+    """Summarize fastqs and return a json serializable report
+    """
+    pathnames = [str(seq) for seq in fastqs]
+    summaries = summarize_fastq_files(pathnames, num_jobs, sample)
+    report = {
+        'files': dict((p, s.to_dict()) for p, s in summaries.items())
+    }
+    if sample is not None:
+        report['sample'] = sample
+    for rollup, groups in rollup_summaries(fastqs, summaries).items():
+        report[rollup] = dict((k, s.to_dict()) for k, s in groups.items())
+    return report
+
+
+def make_parser():
+    parser = OptionParser('%prog: [options] (fastq|flowcell directory)+')
+    parser.add_option('-j', '--max-jobs', default=1, type='int',
+                      help='number of processes to summarize files with')
+    parser.add_option('-o', '--output', default=None,
+                      help='write json report to this file')
+    parser.add_option('--sample', default=None,
+                      help='only summarize a fraction (e.g. 0.01 or 1%) '
+                           'or number of reads from each file')
+    parser.add_option('--index', default=False, action='store_true',
+                      help='save a sequence index for fastqs missing one')
+    parser.add_option('-v', '--verbose', default=False, action='store_true',
+                      help='show what we are doing')
+    return parser
+
+
+def main(cmdline=None):
+    parser = make_parser()
+    opts, args = parser.parse_args(cmdline)
+
+    if opts.verbose:
+        logging.basicConfig(level=logging.INFO)
+    else:
+        logging.basicConfig(level=logging.WARN)
 
-                if mean is None:
-                    mean = numpy.zeros(len(score), dtype=numpy.float)
+    if len(args) == 0:
+        parser.error('Please specify fastq files or flowcell directories')
 
-                delta = score - mean
-                mean = mean + delta / pass_qc
-                read_length.add(len(line))
+    report = make_summary_report(find_fastqs(args, opts.index), opts.max_jobs,
+                                 parse_sample(opts.sample))
+    if opts.output is None:
+        json.dump(report, sys.stdout, indent=1, sort_keys=True)
+        print()
+    else:
+        with open(opts.output, 'w') as outstream:
+            json.dump(report, outstream, indent=1, sort_keys=True)
+    return 0
 
-    return (reads, pass_qc, mean, read_length)
 
 if __name__ == '__main__':
-    import sys
-    from htsworkflow.util.opener import autoopen
-    with autoopen(sys.argv[1], 'rt') as instream:
-        reads, pass_qc, mean_score, read_length = summarize_hiseq_fastq(instream)
-        print(sys.argv[1])
-        print('Reads: {}'.format(reads))
-        print('PassFilter: {}'.format(pass_qc))
-        print('Mean score: {}'.format(mean_score))
-        print('Read lengths: {}'.format(read_length))
+    sys.exit(main(sys.argv[1:]))
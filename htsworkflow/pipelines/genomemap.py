@@ -24,6 +24,9 @@ class GenomeMap(MutableMapping):
     def __getitem__(self, name):
         return self._contigs[name]
 
+    def get(self, name, default=None):
+        return self._contigs.get(name, default)
+
     def __setitem__(self, name, value):
         self._contigs[name] = value
 
@@ -454,7 +454,13 @@ class LaneSpecificRunParameters(MutableMapping):
         else:
             return None
 
-def gerald(pathname):
+def gerald(pathname, num_jobs=1, eager=False):
+    """Parse a GERALD/CASAVA directory and its eland results
+
+    num_jobs is how many processes are used to count the reads for
+    each lane. If eager is true every lane is counted now, up to
+    num_jobs lanes at once, instead of when its counts are first used.
+    """
     LOGGER.info("Parsing gerald config.xml")
     pathname = os.path.expanduser(pathname)
     config_pathname = os.path.join(pathname, 'config.xml')
@@ -469,17 +475,20 @@ def gerald(pathname):
         g = Gerald(pathname = pathname, tree=config_tree)
         LOGGER.info("Parsing Summary.xml")
         g.summary = SummaryGA(summary_xml)
-        g.eland_results = eland(g.pathname, g)
+        g.eland_results = eland(g.pathname, g, num_jobs=num_jobs,
+                                eager=eager)
     elif os.path.exists(summary_htm):
         g = Gerald(pathname=pathname, tree=config_tree)
         LOGGER.info("Parsing Summary.htm")
         g.summary = SummaryGA(summary_htm)
-        g.eland_results = eland(g.pathname, g)
+        g.eland_results = eland(g.pathname, g, num_jobs=num_jobs,
+                                eager=eager)
     elif os.path.isdir(report_summary):
         g = CASAVA(pathname=pathname, tree=config_tree)
         LOGGER.info("Parsing %s" % (report_summary,))
         g.summary = SummaryHiSeq(report_summary)
-        g.eland_results = eland(g.pathname, g)
+        g.eland_results = eland(g.pathname, g, num_jobs=num_jobs,
+                                eager=eager)
 
     # parse eland files
     return g
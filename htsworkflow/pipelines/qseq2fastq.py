@@ -3,16 +3,27 @@
 """
 from __future__ import print_function, unicode_literals
 from glob import glob
+from io import BytesIO
+import multiprocessing
 import os
 from optparse import OptionParser
 import numpy
+from six.moves import queue
 import sys
 import tarfile
+import threading
 
 from htsworkflow.util.version import version
 from htsworkflow.util.conversion import parse_slice
+from htsworkflow.util.fastqio import FastqWriter, BLOCK_SIZE
 from htsworkflow.pipelines.desplit_fastq import open_output
 
+# Illumina qualities are Phred+64, fastq qualities are Phred+33
+QUALITY_TABLE = bytes(bytearray((i - 31) % 256 for i in range(256)))
+QUALITY_SEPARATOR = b'\n'.translate(QUALITY_TABLE)
+SEQUENCE_TABLE = bytes.maketrans(b'.', b'N')
+PASS_FILTER_VALUES = {b'0': 0, b'1': 1}
+
 
 def main(cmdline=None):
     """Command line driver: [None, '-i', 'tarfile', '-o', 'target.fastq']
@@ -24,31 +35,50 @@ def main(cmdline=None):
         print(version())
         return 0
 
-    if opts.infile is not None:
+    parallel = opts.max_jobs > 1
+    if opts.infile is not None and parallel:
+        qseq_generator = threaded_tarfile_reader(opts.infile,
+                                                 opts.max_jobs * 2)
+    elif opts.infile is not None:
         qseq_generator = tarfile_generator(opts.infile)
+    elif len(args) > 0 and parallel:
+        qseq_generator = filename_generator(args)
     elif len(args) > 0:
         qseq_generator = file_generator(args)
     else:
-        qseq_generator = [sys.stdin]
+        # we can't split up a stream
+        parallel = False
+        qseq_generator = [sys.stdin.buffer]
 
+    lines_per_record = 2 if opts.fasta else 4
     if opts.output is not None:
-        output = open_output(opts.output, opts)
+        output = open_output(opts.output, opts, True, lines_per_record)
     else:
-        output = sys.stdout
+        output = sys.stdout.buffer
 
     if opts.nopass_output is not None:
-        nopass_output = open_output(opts.nopass_output, opts)
+        nopass_output = open_output(opts.nopass_output, opts, True,
+                                    lines_per_record)
     else:
         nopass_output = None
 
-    qseq_parser = Qseq2Fastq(qseq_generator, output, nopass_output)
+    if parallel:
+        qseq_parser = ParallelQseq2Fastq(qseq_generator, output,
+                                         nopass_output, opts.max_jobs)
+    else:
+        qseq_parser = Qseq2Fastq(qseq_generator, output, nopass_output)
     qseq_parser.fastq = not opts.fasta
     qseq_parser.flowcell_id = opts.flowcell
     qseq_parser.trim = parse_slice(opts.slice)
-    qseq_parser.reportFilter = opts.pf
+    qseq_parser.report_filter = opts.pf
 
     qseq_parser.run()
 
+    if opts.output is not None:
+        output.close()
+    if nopass_output is not None:
+        nopass_output.close()
+
 
 def make_parser():
     """Return option parser"""
@@ -71,10 +101,18 @@ def make_parser():
                       default=None)
     parser.add_option("--pf", help="report pass filter flag", default=False,
                       action="store_true")
+    parser.add_option("-j", "--max-jobs", default=1, type="int",
+                      help="number of processes to use converting "\
+                           "separate qseq files")
     parser.add_option('--gzip', default=False, action='store_true',
                       help='gzip output')
     parser.add_option('--bzip', default=False, action='store_true',
                       help='bzip output')
+    parser.add_option('--bgzf', default=False, action='store_true',
+                      help='write seekable blocked gzip output with a '\
+                           'record index')
+    parser.add_option('--threads', default=1, type='int',
+                      help='number of threads to use compressing output')
     parser.add_option("--version", default=False, action="store_true",
                       help="report software version")
 
@@ -89,6 +127,13 @@ def file_generator(pattern_list):
             yield open(filename, "rb")
 
 
+def filename_generator(pattern_list):
+    """Given a list of glob patterns yield matching filenames"""
+    for pattern in pattern_list:
+        for filename in glob(pattern):
+            yield filename
+
+
 def tarfile_generator(tarfilename):
     """Yield open streams for files inside a tarfile"""
     archive = tarfile.open(tarfilename, 'r|*')
@@ -96,6 +141,39 @@ def tarfile_generator(tarfilename):
         yield archive.extractfile(tarinfo)
 
 
+def threaded_tarfile_reader(tarfilename, max_pending=2):
+    """Yield the contents of files inside a tarfile
+
+    The archive is read once, in order, by a separate thread which stays
+    at most max_pending members ahead of us.
+    """
+    members = queue.Queue(max_pending)
+    finished = object()
+
+    def read_members():
+        try:
+            archive = tarfile.open(tarfilename, 'r|*')
+            for tarinfo in archive:
+                if tarinfo.isfile():
+                    members.put(archive.extractfile(tarinfo).read())
+            archive.close()
+            members.put(finished)
+        except Exception as e:
+            members.put(e)
+
+    reader = threading.Thread(target=read_members)
+    reader.daemon = True
+    reader.start()
+    while True:
+        member = members.get()
+        if member is finished:
+            break
+        elif isinstance(member, Exception):
+            raise member
+        yield member
+    reader.join()
+
+
 class Qseq2Fastq(object):
     """
     Convert qseq files to fastq (or fasta) files.
@@ -127,60 +205,183 @@ class Qseq2Fastq(object):
         (Used to match threading/multiprocessing API)
         """
         if self.fastq:
-            header_template = '@'
+            header_prefix = '@'
         else:
             # fasta case
-            header_template = '>'
-        header_template += self._format_flowcell_id() + \
-                           '%s_%s:%s:%s:%s:%s/%s%s%s'
+            header_prefix = '>'
+        header_prefix += self._format_flowcell_id()
+        header_prefix = header_prefix.encode('ascii')
+
+        pass_writer = FastqWriter(self.pass_destination)
+        if self.nopass_destination is self.pass_destination:
+            nopass_writer = None
+        else:
+            nopass_writer = FastqWriter(self.nopass_destination)
 
         for qstream in self.sources:
-            for line in qstream:
-                # parse line
-                record = line.decode('ascii').rstrip().split('\t')
-                machine_name = record[0]
-                run_number = record[1]
-                lane_number = record[2]
-                tile = record[3]
-                x = record[4]
-                y = record[5]
-                #index = record[6]
-                read = record[7]
-                sequence = record[8].replace('.', 'N')
-                quality = convert_illumina_quality(record[9])
-
-                # add pass qc filter if we want it
-                pass_qc = int(record[10])
-                if self.report_filter:
-                    pass_qc_msg = " pf=%s" % (pass_qc)
-                else:
-                    pass_qc_msg = ""
-
-                header = header_template % ( \
-                    machine_name,
-                    run_number,
-                    lane_number,
-                    tile,
-                    x,
-                    y,
-                    read,
-                    pass_qc_msg,
-                    os.linesep)
-
-                # if we passed the filter write to the "good" file
-                if pass_qc:
-                    destination = self.pass_destination
-                else:
-                    destination = self.nopass_destination
-
-                destination.write(header)
-                destination.write(sequence[self.trim])
-                destination.write(os.linesep)
-                if self.fastq:
-                    destination.write('+')
-                    destination.write(os.linesep)
-                    destination.write(quality[self.trim].tobytes().decode('ascii'))
-                    destination.write(os.linesep)
+            for lines in read_qseq_lines(qstream):
+                records = [line.rstrip().split(b'\t') for line in lines]
+                records = [record for record in records if len(record) > 1]
+                if len(records) == 0:
+                    continue
+                self._write_records(records, header_prefix,
+                                    pass_writer, nopass_writer)
+
+        pass_writer.flush()
+        if nopass_writer is not None:
+            nopass_writer.flush()
+
+    def _write_records(self, records, header_prefix, pass_writer,
+                       nopass_writer):
+        """Convert a batch of split qseq lines and write them out
+        """
+        pass_qc = [PASS_FILTER_VALUES[record[10]]
+                   if record[10] in PASS_FILTER_VALUES else int(record[10])
+                   for record in records]
+        if self.report_filter:
+            headers = [header_prefix +
+                       b'%s_%s:%s:%s:%s:%s/%s pf=%d' % (
+                           r[0], r[1], r[2], r[3], r[4], r[5], r[7], pf)
+                       for r, pf in zip(records, pass_qc)]
+        else:
+            headers = [header_prefix +
+                       b'%s_%s:%s:%s:%s:%s/%s' % (
+                           r[0], r[1], r[2], r[3], r[4], r[5], r[7])
+                       for r in records]
+
+        # convert all of the sequences and qualities at once
+        sequences = b'\n'.join([record[8] for record in records])
+        sequences = sequences.translate(SEQUENCE_TABLE).split(b'\n')
+        if self.trim != slice(None):
+            sequences = [sequence[self.trim] for sequence in sequences]
+
+        if self.fastq:
+            qualities = b'\n'.join([record[9] for record in records])
+            qualities = qualities.translate(QUALITY_TABLE).split(
+                QUALITY_SEPARATOR)
+            if self.trim != slice(None):
+                qualities = [quality[self.trim] for quality in qualities]
+            lines = [None] * (len(records) * 4)
+            lines[0::4] = headers
+            lines[1::4] = sequences
+            lines[2::4] = [b'+'] * len(records)
+            lines[3::4] = qualities
+            lines_per_record = 4
+        else:
+            lines = [None] * (len(records) * 2)
+            lines[0::2] = headers
+            lines[1::2] = sequences
+            lines_per_record = 2
+
+        if nopass_writer is None or all(pass_qc):
+            pass_writer.write_lines(lines)
+            return
+
+        passed = []
+        failed = []
+        for i, pf in enumerate(pass_qc):
+            record_lines = lines[i * lines_per_record:
+                                 (i + 1) * lines_per_record]
+            if pf:
+                passed.extend(record_lines)
+            else:
+                failed.extend(record_lines)
+        pass_writer.write_lines(passed)
+        nopass_writer.write_lines(failed)
+
+
+class ParallelQseq2Fastq(Qseq2Fastq):
+    """
+    Convert separate qseq files on a pool of processes.
+
+    sources are either qseq filenames or the contents of qseq files,
+    the converted files are written out in the same order as sources.
+    """
+    def __init__(self, sources, pass_destination, nopass_destination=None,
+                 num_jobs=2):
+        super(ParallelQseq2Fastq, self).__init__(
+            sources, pass_destination, nopass_destination)
+        self.num_jobs = num_jobs
+
+    def run(self):
+        """Run conversion
+        """
+        settings = {
+            'fastq': self.fastq,
+            'flowcell_id': self.flowcell_id,
+            'trim': self.trim,
+            'report_filter': self.report_filter,
+            'split': self.nopass_destination is not self.pass_destination,
+        }
+        # limit how many converted files can be waiting for us
+        slots = threading.Semaphore(self.num_jobs * 2)
+        stopped = threading.Event()
+
+        def tasks():
+            for source in self.sources:
+                while not slots.acquire(timeout=0.1):
+                    if stopped.is_set():
+                        return
+                yield (source, settings)
+
+        pool = multiprocessing.Pool(self.num_jobs)
+        try:
+            for passed, failed in pool.imap(_convert_qseq_source, tasks()):
+                self.pass_destination.write(passed)
+                if failed is not None:
+                    self.nopass_destination.write(failed)
+                slots.release()
+            pool.close()
+        except BaseException:
+            # let tasks() give up before the pool waits for it
+            stopped.set()
+            pool.terminate()
+            raise
+        finally:
+            stopped.set()
+            pool.join()
+
+
+def _convert_qseq_source(task):
+    """Convert one qseq filename or file contents for ParallelQseq2Fastq
+    """
+    source, settings = task
+    if isinstance(source, bytes):
+        stream = BytesIO(source)
+    else:
+        stream = open(source, 'rb')
+
+    passed = BytesIO()
+    failed = BytesIO() if settings['split'] else None
+    converter = Qseq2Fastq([stream], passed, failed)
+    converter.fastq = settings['fastq']
+    converter.flowcell_id = settings['flowcell_id']
+    converter.trim = settings['trim']
+    converter.report_filter = settings['report_filter']
+    converter.run()
+    stream.close()
+
+    if failed is not None:
+        failed = failed.getvalue()
+    return passed.getvalue(), failed
+
+
+def read_qseq_lines(stream, block_size=BLOCK_SIZE):
+    """Yield lists of complete lines read from stream in large blocks
+    """
+    remainder = b''
+    while True:
+        block = stream.read(block_size)
+        if len(block) == 0:
+            break
+        if isinstance(block, str):
+            block = block.encode('ascii')
+        lines = (remainder + block).split(b'\n')
+        remainder = lines.pop()
+        yield lines
+    if len(remainder) > 0:
+        yield [remainder]
+
 
 def convert_illumina_quality(illumina_quality):
     """Convert an Illumina quality score to a Phred ASCII quality score.
@@ -1,5 +1,6 @@
 """Core information needed to inspect a runfolder.
 """
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 import logging
 import os
@@ -13,6 +14,9 @@ import time
 
 LOGGER = logging.getLogger(__name__)
 
+# finished extract_results steps are recorded in this file
+JOURNAL_NAME = 'extract_results.journal'
+
 from htsworkflow.pipelines import firecrest
 from htsworkflow.pipelines import ipar
 from htsworkflow.pipelines import bustard
@@ -22,8 +26,11 @@ from htsworkflow.pipelines import ElementTree, \
                                   VERSION_RE, USER_RE, \
                                   LANES_PER_FLOWCELL, LANE_LIST
 from htsworkflow.pipelines.samplekey import LANE_SAMPLE_KEYS
+from htsworkflow.util.compression import compress_file, copy_file, \
+     checksum_file, has_checksums, write_tar, PARTIAL_SUFFIX
 from htsworkflow.util.ethelp import indent, flatten
-from htsworkflow.util.queuecommands import QueueCommands
+from htsworkflow.util.journal import Journal
+from htsworkflow.util.taskgraph import TaskGraph
 
 from htsworkflow.pipelines import srf
 
@@ -257,7 +264,7 @@ def load_pipeline_run_xml(pathname):
     run = PipelineRun(xml=tree)
     return run
 
-def get_runs(runfolder, flowcell_id=None):
+def get_runs(runfolder, flowcell_id=None, num_jobs=1, eager=False):
     """Find all runs associated with a runfolder.
 
     We end up with multiple analysis runs as we sometimes
@@ -267,6 +274,9 @@ def get_runs(runfolder, flowcell_id=None):
     For example if there are two different GERALD runs, this will
     generate two different PipelineRun objects, that differ
     in there gerald component.
+
+    num_jobs is how many processes are used to count eland results,
+    if eager is true all the lanes are counted while scanning.
     """
     datadir = os.path.join(runfolder, 'Data')
 
@@ -282,7 +292,8 @@ def get_runs(runfolder, flowcell_id=None):
             )
         else:
             scan_post_image_analysis(
-                runs, runfolder, datadir, image_analysis, firecrest_pathname, flowcell_id
+                runs, runfolder, datadir, image_analysis, firecrest_pathname, flowcell_id,
+                num_jobs, eager
             )
     # scan for IPAR directories
     ipar_dirs = glob(os.path.join(datadir, "IPAR_*"))
@@ -297,14 +308,16 @@ def get_runs(runfolder, flowcell_id=None):
             )
         else:
             scan_post_image_analysis(
-                runs, runfolder, datadir, image_analysis, ipar_pathname, flowcell_id
+                runs, runfolder, datadir, image_analysis, ipar_pathname, flowcell_id,
+                num_jobs, eager
             )
 
     return runs
 
 def scan_post_image_analysis(runs, runfolder, datadir, image_analysis,
-                             pathname, flowcell_id):
-    added = build_hiseq_runs(image_analysis, runs, datadir, runfolder, flowcell_id)
+                             pathname, flowcell_id, num_jobs=1, eager=False):
+    added = build_hiseq_runs(image_analysis, runs, datadir, runfolder, flowcell_id,
+                             num_jobs, eager)
     # If we're a multiplexed run, don't look for older run type.
     if added > 0:
         return
@@ -317,18 +330,18 @@ def scan_post_image_analysis(runs, runfolder, datadir, image_analysis,
         LOGGER.info("Found bustard directory %s" % (bustard_pathname,))
         b = bustard.bustard(bustard_pathname)
         build_gerald_runs(runs, b, image_analysis, bustard_pathname, datadir, pathname,
-                          runfolder, flowcell_id)
+                          runfolder, flowcell_id, num_jobs, eager)
 
 
 def build_gerald_runs(runs, b, image_analysis, bustard_pathname, datadir, pathname, runfolder,
-                      flowcell_id):
+                      flowcell_id, num_jobs=1, eager=False):
     start = len(runs)
     gerald_glob = os.path.join(bustard_pathname, 'GERALD*')
     LOGGER.info("Looking for gerald directories in %s" % (pathname,))
     for gerald_pathname in glob(gerald_glob):
         LOGGER.info("Found gerald directory %s" % (gerald_pathname,))
         try:
-            g = gerald.gerald(gerald_pathname)
+            g = gerald.gerald(gerald_pathname, num_jobs, eager)
             p = PipelineRun(runfolder, flowcell_id)
             p.datadir = datadir
             p.image_analysis = image_analysis
@@ -340,7 +353,8 @@ def build_gerald_runs(runs, b, image_analysis, bustard_pathname, datadir, pathna
     return len(runs) - start
 
 
-def build_hiseq_runs(image_analysis, runs, datadir, runfolder, flowcell_id):
+def build_hiseq_runs(image_analysis, runs, datadir, runfolder, flowcell_id,
+                     num_jobs=1, eager=False):
     start = len(runs)
     aligned_glob = os.path.join(runfolder, 'Aligned*')
     unaligned_glob = os.path.join(runfolder, 'Unaligned*')
@@ -363,7 +377,7 @@ def build_hiseq_runs(image_analysis, runs, datadir, runfolder, flowcell_id):
             p.image_analysis = image_analysis
             p.bustard = bustard.bustard(unaligned)
             if aligned:
-                p.gerald = gerald.gerald(aligned)
+                p.gerald = gerald.gerald(aligned, num_jobs, eager)
             runs.append(p)
         except (IOError, RuntimeError) as e:
             LOGGER.error("Exception %s", str(e))
@@ -402,13 +416,16 @@ def build_dir_dict_by_suffix(prefix, dirnames):
             by_suffix[match.group('suffix')] = absname
     return by_suffix
 
-def get_specific_run(gerald_dir):
+def get_specific_run(gerald_dir, num_jobs=1, eager=False):
     """
     Given a gerald directory, construct a PipelineRun out of its parents
 
     Basically this allows specifying a particular run instead of the previous
     get_runs which scans a runfolder for various combinations of
     firecrest/ipar/bustard/gerald runs.
+
+    num_jobs is how many processes are used to count eland results,
+    if eager is true all the lanes are counted right away.
     """
     from htsworkflow.pipelines import firecrest
     from htsworkflow.pipelines import ipar
@@ -457,7 +474,7 @@ def get_specific_run(gerald_dir):
         return None
 
     # find alignments
-    gerald_run = gerald.gerald(gerald_dir)
+    gerald_run = gerald.gerald(gerald_dir, num_jobs, eager)
     if gerald_run is None:
         LOGGER.error('%s does not contain a gerald run' % (gerald_dir,))
         return None
@@ -575,11 +592,15 @@ def save_flowcell_reports(data_dir, run_dirname):
         if os.path.exists(status_file):
             cmd_list.extend(['Status.xml', 'Status.xsl'])
         LOGGER.info("Saving reports from " + reports_dir)
-        cwd = os.getcwd()
-        os.chdir(data_dir)
-        q = QueueCommands([" ".join(cmd_list)])
-        q.run()
-        os.chdir(cwd)
+        cmd_list[2] += PARTIAL_SUFFIX
+        returncode = subprocess.call(cmd_list, cwd=data_dir)
+        if returncode != 0:
+            # don't leave a truncated archive for the next run to trust
+            if os.path.exists(cmd_list[2]):
+                os.unlink(cmd_list[2])
+            raise subprocess.CalledProcessError(returncode,
+                                                " ".join(cmd_list))
+        os.rename(cmd_list[2], reports_dest)
 
 
 def save_summary_file(pipeline, run_dirname):
@@ -618,9 +639,13 @@ def save_ivc_plot(bustard_object, run_dirname):
         LOGGER.warning('Missing IVC.html file, not archiving')
 
 
-def compress_score_files(bustard_object, run_dirname):
+def compress_score_files(bustard_object, run_dirname, compression='.bz2',
+                         threads=1, checksums=('md5',)):
     """
     Compress score files into our result directory
+
+    compression is '.bz2' for the smallest archive or '.gz' for a
+    faster one. Returns the (name, size) of each archived file.
     """
     # check for g.pathname/Temp a new feature of 1.1rc1
     scores_path = bustard_object.pathname
@@ -634,29 +659,59 @@ def compress_score_files(bustard_object, run_dirname):
         if re.match('.*_score.txt', f):
             score_files.append(f)
 
-    tar_cmd = ['tar', 'c'] + score_files
-    bzip_cmd = [ 'bzip2', '-9', '-c' ]
-    tar_dest_name = os.path.join(run_dirname, 'scores.tar.bz2')
-    tar_dest = open(tar_dest_name, 'w')
-    LOGGER.info("Compressing score files from %s" % (scores_path,))
-    LOGGER.info("Running tar: " + " ".join(tar_cmd[:10]))
-    LOGGER.info("Running bzip2: " + " ".join(bzip_cmd))
+    tar_dest_name = os.path.join(run_dirname, 'scores.tar' + compression)
+    LOGGER.info("Compressing %d score files from %s" % (
+        len(score_files), scores_path))
     LOGGER.info("Writing to %s" % (tar_dest_name,))
+    return write_tar(tar_dest_name, scores_path, score_files, compression,
+                     threads, checksums=checksums)
 
-    env = {'BZIP': '-9'}
-    tar = subprocess.Popen(tar_cmd, stdout=subprocess.PIPE, shell=False, env=env,
-                           cwd=scores_path)
-    bzip = subprocess.Popen(bzip_cmd, stdin=tar.stdout, stdout=tar_dest)
-    tar.wait()
 
+def add_journaled(graph, journal, name, function, args=(), sources=(),
+                  outputs=(), step=None):
+    """
+    Add a task to graph that is skipped if journal says it's done
 
-def compress_eland_results(gerald_object, run_dirname, num_jobs=1):
+    outputs are names relative to the run directory.
     """
-    Compress eland result files into the archive directory
+    if journal is None:
+        return graph.add(name, function, args, step=step)
+    return graph.add(name, journal.run,
+                     (name, sources, outputs, function) + tuple(args),
+                     step=step)
+
+
+def run_command(cmd, cwd=None):
+    """Run a single shell command, as one task of a TaskGraph
+
+    Raises CalledProcessError if the command fails, so the task isn't
+    journaled as done.
+    """
+    LOGGER.info("Running %s", cmd)
+    subprocess.check_call(cmd, shell=True, cwd=cwd)
+
+
+def command_output(cmd):
+    """Return the file written by a srf or qseq archiving command
     """
-    # copy & bzip eland files
-    bz_commands = []
+    args = cmd.split()
+    if '-o' in args:
+        return args[args.index('-o') + 1]
+    # tar cjf dest pattern
+    return args[2]
 
+
+def add_eland_tasks(graph, gerald_object, run_dirname, prefix='',
+                    checksums=('md5',), executor=None, threads=1,
+                    journal=None):
+    """
+    Add tasks compressing eland result files into the archive directory
+
+    Checksum sidecars are written along with each archived file. Pass
+    an executor to share compression threads with other tasks.
+    Returns the names of the added tasks.
+    """
+    tasks = []
     for key in gerald_object.eland_results:
         eland_lane = gerald_object.eland_results[key]
         for source_name in eland_lane.pathnames:
@@ -669,26 +724,116 @@ def compress_eland_results(gerald_object, run_dirname, num_jobs=1):
               LOGGER.info("Saving eland file %s to %s" % \
                          (source_name, dest_name))
 
+              task_name = prefix + 'eland ' + name
               if is_compressed(name):
                 LOGGER.info('Already compressed, Saving to %s' % (dest_name,))
-                shutil.copy(source_name, dest_name)
+                tasks.append(add_journaled(
+                    graph, journal, task_name, copy_file,
+                    (source_name, dest_name, checksums),
+                    [source_name], [name], prefix + 'eland'))
               else:
                 # not compressed
                 dest_name += '.bz2'
-                args = ['bzip2', '-9', '-c', source_name, '>', dest_name ]
-                bz_commands.append(" ".join(args))
-                #LOGGER.info('Running: %s' % ( " ".join(args) ))
-                #bzip_dest = open(dest_name, 'w')
-                #bzip = subprocess.Popen(args, stdout=bzip_dest)
-                #LOGGER.info('Saving to %s' % (dest_name, ))
-                #bzip.wait()
+                tasks.append(add_journaled(
+                    graph, journal, task_name, compress_file,
+                    (source_name, dest_name, '.bz2', threads, 9, checksums,
+                     executor),
+                    [source_name], [name + '.bz2'], prefix + 'eland'))
+    return tasks
+
+
+def split_jobs(num_jobs):
+    """
+    Split num_jobs into (task graph workers, compression threads)
 
-    if len(bz_commands) > 0:
-      q = QueueCommands(bz_commands, num_jobs)
-      q.run()
+    Tasks compressing files mostly wait for the shared compression
+    threads, so the two pools together keep about num_jobs busy.
+    """
+    num_jobs = max(num_jobs, 1)
+    graph_jobs = max(num_jobs // 2, 1)
+    return graph_jobs, max(num_jobs - graph_jobs, 1)
 
 
-def extract_results(runs, output_base_dir=None, site="individual", num_jobs=1, raw_format=None):
+def compress_eland_results(gerald_object, run_dirname, num_jobs=1,
+                           checksums=('md5',)):
+    """
+    Compress eland result files into the archive directory
+    """
+    graph_jobs, threads = split_jobs(num_jobs)
+    with ThreadPoolExecutor(threads) as executor:
+        graph = TaskGraph(graph_jobs)
+        add_eland_tasks(graph, gerald_object, run_dirname, '', checksums,
+                        executor, threads)
+        graph.run()
+
+
+def add_checksum_tasks(graph, run_dirname, prefix='', checksums=('md5',)):
+    """
+    Add tasks writing checksums of archive files that don't have them
+
+    Files we compressed or copied ourselves already have theirs.
+    """
+    for pathname in srf.find_archive_files(run_dirname):
+        if has_checksums(pathname, checksums):
+            continue
+        name = os.path.basename(pathname)
+        graph.add(prefix + 'checksum ' + name, checksum_file,
+                  (pathname, checksums), step=prefix + 'checksum')
+
+
+def add_run_tasks(graph, run, run_dirname, site="individual",
+                  raw_format=None, checksums=('md5',), executor=None,
+                  threads=1, journal=None):
+    """
+    Add the tasks archiving one run to graph
+
+    The reports, plots, raw data and eland files are independent of
+    each other, the checksum pass waits for all of them. Tasks the
+    journal says are done are skipped.
+    """
+    prefix = '%s %s: ' % (run.flowcell_id, run.run_dirname)
+    tasks = []
+
+    # save illumina flowcell status report
+    data_dir = os.path.join(run.image_analysis.pathname, '..')
+    tasks.append(add_journaled(
+        graph, journal, prefix + 'flowcell reports', save_flowcell_reports,
+        (data_dir, run_dirname), [os.path.join(data_dir, 'reports')],
+        ['flowcell-reports.tar.bz2']))
+
+    # save stuff from bustard
+    # grab IVC plot
+    tasks.append(add_journaled(
+        graph, journal, prefix + 'ivc plot', save_ivc_plot,
+        (run.bustard, run_dirname),
+        [os.path.join(run.bustard.pathname, 'IVC.htm')], ['IVC.htm']))
+
+    # build base call saving commands
+    if site is not None:
+        tasks.extend(add_raw_data_tasks(graph, run, site, raw_format,
+                                        run_dirname, prefix, journal))
+
+    # save stuff from GERALD
+    # copy stuff out of the main run
+    if run.gerald:
+        # save summary file
+        tasks.append(add_journaled(
+            graph, journal, prefix + 'summary', save_summary_file,
+            (run, run_dirname),
+            [os.path.join(run.gerald.pathname, 'Summary.htm')],
+            ['Summary.htm']))
+
+        # compress eland result files
+        tasks.extend(add_eland_tasks(graph, run.gerald, run_dirname, prefix,
+                                     checksums, executor, threads, journal))
+
+    # checksum the rest of the compressed files once we're done
+    graph.add(prefix + 'checksums', add_checksum_tasks,
+              (graph, run_dirname, prefix, checksums), depends=tasks)
+
+
+def extract_results(runs, output_base_dir=None, site="individual", num_jobs=1, raw_format=None,
+                    checksums=('md5',), resume=False):
     """
     Iterate over runfolders in runs extracting the most useful information.
       * run parameters (in run-*.xml)
@@ -696,10 +841,22 @@ def extract_results(runs, output_base_dir=None, site="individual", num_jobs=1, r
       * score files
       * Summary.htm
       * srf files (raw sequence & qualities)
+
+    The steps of all the runs and their compression share num_jobs
+    worker threads, steps run as soon as the steps they depend on are
+    done. Each archived file gets
+    a <name>.<checksum> sidecar for each of checksums.
+
+    Finished steps are recorded in a journal in each run directory. If
+    resume is set, existing run directories are finished instead of
+    skipped, redoing only the steps that aren't in the journal.
     """
     if output_base_dir is None:
         output_base_dir = os.getcwd()
 
+    graph_jobs, threads = split_jobs(num_jobs)
+    graph = TaskGraph(graph_jobs)
+    executor = ThreadPoolExecutor(threads)
     for r in runs:
         result_dir = os.path.join(output_base_dir, r.flowcell_id)
         LOGGER.info("Using %s as result directory" % (result_dir,))
@@ -711,42 +868,33 @@ def extract_results(runs, output_base_dir=None, site="individual", num_jobs=1, r
         run_dirname = os.path.join(result_dir, r.run_dirname)
         run_dirname = os.path.abspath(run_dirname)
         if os.path.exists(run_dirname):
-            LOGGER.error("%s already exists, not overwriting" % (run_dirname,))
-            continue
+            if not resume:
+                LOGGER.error("%s already exists, not overwriting" % (run_dirname,))
+                continue
+            LOGGER.info("Resuming %s" % (run_dirname,))
         else:
             os.mkdir(run_dirname)
 
         # save run file
         r.save(run_dirname)
 
-        # save illumina flowcell status report
-        save_flowcell_reports(os.path.join(r.image_analysis.pathname, '..'),
-                              run_dirname)
-
-        # save stuff from bustard
-        # grab IVC plot
-        save_ivc_plot(r.bustard, run_dirname)
-
-        # build base call saving commands
-        if site is not None:
-            save_raw_data(num_jobs, r, site, raw_format, run_dirname)
+        journal = Journal(os.path.join(run_dirname, JOURNAL_NAME))
+        add_run_tasks(graph, r, run_dirname, site, raw_format, checksums,
+                      executor, threads, journal)
 
-        # save stuff from GERALD
-        # copy stuff out of the main run
-        if r.gerald:
-            g = r.gerald
+    try:
+        graph.run()
+    finally:
+        executor.shutdown()
 
-            # save summary file
-            save_summary_file(r, run_dirname)
 
-            # compress eland result files
-            compress_eland_results(g, run_dirname, num_jobs)
-
-        # md5 all the compressed files once we're done
-        md5_commands = srf.make_md5_commands(run_dirname)
-        srf.run_commands(run_dirname, md5_commands, num_jobs)
+def add_raw_data_tasks(graph, r, site, raw_format, run_dirname, prefix='',
+                       journal=None):
+    """
+    Add tasks converting or copying the raw reads of a run
 
-def save_raw_data(num_jobs, r, site, raw_format, run_dirname):
+    Returns the names of the added tasks.
+    """
     lanes = []
     if r.gerald:
         for lane in r.gerald.lanes:
@@ -767,14 +915,37 @@ def save_raw_data(num_jobs, r, site, raw_format, run_dirname):
         LOGGER.info("Reading fastq files from %s", r.bustard.pathname)
         rawpath = os.path.join(r.pathname, r.bustard.pathname)
         LOGGER.info("raw data = %s" % (rawpath,))
-        srf.copy_hiseq_project_fastqs(run_name, rawpath, site, run_dirname)
+        fastqs = srf.find_hiseq_project_fastqs(rawpath)
+        sources = [pathname for project, pathname in fastqs]
+        outputs = [os.path.join(project, os.path.basename(pathname))
+                   for project, pathname in fastqs]
+        return [add_journaled(graph, journal, prefix + 'raw fastq',
+                              srf.copy_hiseq_project_fastqs,
+                              (run_name, rawpath, site, run_dirname),
+                              sources, outputs)]
     elif raw_format == 'qseq':
         seq_cmds = srf.make_qseq_commands(run_name, r.bustard.pathname, lanes, site, run_dirname)
     elif raw_format == 'srf':
         seq_cmds = srf.make_srf_commands(run_name, r.bustard.pathname, lanes, site, run_dirname, 0)
     else:
         raise ValueError('Unknown --raw-format=%s' % (raw_format))
-    srf.run_commands(r.bustard.pathname, seq_cmds, num_jobs)
+
+    tasks = []
+    for i, cmd in enumerate(seq_cmds):
+        # the commands write their outputs directly, if one was
+        # interrupted it's rerun since it didn't make it to the journal
+        output = os.path.relpath(command_output(cmd), run_dirname)
+        tasks.append(add_journaled(
+            graph, journal, '%sraw %s %d' % (prefix, raw_format, i + 1),
+            run_command, (cmd, r.bustard.pathname), outputs=[output],
+            step=prefix + 'raw ' + raw_format))
+    return tasks
+
+
+def save_raw_data(num_jobs, r, site, raw_format, run_dirname):
+    graph = TaskGraph(num_jobs)
+    add_raw_data_tasks(graph, r, site, raw_format, run_dirname)
+    graph.run()
 
 def rm_list(files, dry_run=True):
     for f in files:
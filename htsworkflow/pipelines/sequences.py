@@ -19,12 +19,20 @@ from encoded_client.rdfhelp import (
     strip_namespace,
 )
 
+from htsworkflow.pipelines.eland import ELAND_SUMMARY_SUFFIX
+from htsworkflow.util.compression import CHECKSUMS
+from htsworkflow.util.fastqindex import load_sequence_index, \
+     get_sequence_index
+
 
 LOGGER = logging.getLogger(__name__)
 
 eland_re = re.compile('s_(?P<lane>\d)(_(?P<read>\d))?_eland_')
 raw_seq_re = re.compile('woldlab_[0-9]{6}_[^_]+_[\d]+_[\dA-Za-z]+')
 qseq_re = re.compile('woldlab_[0-9]{6}_[^_]+_[\d]+_[\dA-Za-z]+_l[\d]_r[\d].tar.bz2')
+# files written next to sequence files that aren't sequences themselves
+SIDECAR_SUFFIXES = tuple('.' + name for name in CHECKSUMS) + \
+    (ELAND_SUMMARY_SUFFIX,)
 
 SEQUENCE_TABLE_NAME = "sequences"
 def create_sequence_table(cursor):
@@ -46,6 +54,8 @@ CREATE TABLE %(table)s (
 
 FlowcellPath = collections.namedtuple('FlowcellPath',
                                       'flowcell start stop project')
+# sequence types we can keep a fastqindex.SequenceIndex for
+INDEXED_TYPES = ('fastq', 'split_fastq')
 
 class SequenceFile(object):
     """
@@ -117,6 +127,18 @@ class SequenceFile(object):
     def __repr__(self):
         return u"<%s %s %s %s>" % (self.filetype, self.flowcell, self.lane, self.path)
 
+    def load_index(self, create=False):
+        """Return the SequenceIndex for our file
+
+        Returns None if there isn't an up to date index, unless create
+        is set in which case the file is read to make one.
+        """
+        if self.filetype not in INDEXED_TYPES:
+            return None
+        if create:
+            return get_sequence_index(self.path)
+        return load_sequence_index(self.path)
+
     def make_target_name(self, root):
         """
         Create target name for where we need to link this sequence too
@@ -185,6 +207,11 @@ class SequenceFile(object):
         add_lit(model, fileNode, libNS['passed_filter'], self.pf)
         add(model, fileNode, libNS['file_type'], libNS[self.filetype])
 
+        index = self.load_index()
+        if index is not None:
+            add_lit(model, fileNode, libNS['read_count'], index.reads)
+            add_lit(model, fileNode, libNS['read_length'], index.read_length)
+
         if base_url is not None:
             flowcell = URIRef("{base}/flowcell/{flowcell}/".format(
                 base=base_url,
@@ -375,11 +402,15 @@ def parse_eland(path, filename, eland_match=None):
         read = None
     return SequenceFile('eland', fullpath, flowcell, lane, read, cycle=stop)
 
-def scan_for_sequences(dirs):
+def scan_for_sequences(dirs, create_index=False):
     """
     Scan through a list of directories for sequence like files
+
+    If create_index is set, fastqs without an up to date sequence index
+    are read to make one, otherwise we just count them.
     """
     sequences = []
+    unindexed = 0
     if isinstance(dirs, six.string_types):
         raise ValueError("You probably want a list or set, not a string")
 
@@ -393,7 +424,7 @@ def scan_for_sequences(dirs):
             for f in filenames:
                 seq = None
                 # find sequence files
-                if f.endswith('.md5'):
+                if f.endswith(SIDECAR_SUFFIXES):
                     continue
                 elif f.endswith('.srf') or f.endswith('.srf.bz2'):
                     seq = parse_srf(path, f)
@@ -405,13 +436,21 @@ def scan_for_sequences(dirs):
                     seq = parse_fastq(path, f)
                 eland_match = eland_re.match(f)
                 if eland_match:
-                    if f.endswith('.md5'):
-                        continue
                     seq = parse_eland(path, f, eland_match)
                 if seq:
                     sequences.append(seq)
                     LOGGER.debug("Found sequence at %s" % (f,))
-
+                    if seq.filetype in INDEXED_TYPES and \
+                       load_sequence_index(seq.path) is None:
+                        if create_index:
+                            LOGGER.info("Indexing %s", seq.path)
+                            seq.load_index(create=True)
+                        else:
+                            LOGGER.debug("%s has no sequence index", seq.path)
+                            unindexed += 1
+
+    if unindexed > 0:
+        LOGGER.warning("%d sequence files have no sequence index", unindexed)
     return sequences
 
 
@@ -171,41 +171,51 @@ def copy_hiseq_project_fastqs(run_name, basecall_dir, site_name, destdir):
     # clean up pathname
     LOGGER.info("run_name %s" % (run_name,))
 
-    cmd_list = []
-    project_dirs = glob(os.path.join(basecall_dir, 'Project_*'))
-    for project_dir in project_dirs:
-        _, project_name = os.path.split(project_dir)
-        sample_files = glob(os.path.join(project_dir, 'Sample*', '*.fastq*'))
+    for project_name, fastq_file in find_hiseq_project_fastqs(basecall_dir):
         project_dest = os.path.join(destdir, project_name)
         if not os.path.exists(project_dest):
             LOGGER.info("Making: %s" % (project_dest))
             os.mkdir(project_dest)
+        shutil.copy(fastq_file, project_dest)
+
 
-        for fastq_file in sample_files:
-            shutil.copy(fastq_file, project_dest)
+def find_hiseq_project_fastqs(basecall_dir):
+    """
+    Return (project name, fastq pathname) for the HiSeq sample fastqs
+
+    copy_hiseq_project_fastqs saves each fastq as project name/file name
+    """
+    fastqs = []
+    project_dirs = glob(os.path.join(basecall_dir, 'Project_*'))
+    for project_dir in project_dirs:
+        _, project_name = os.path.split(project_dir)
+        sample_files = glob(os.path.join(project_dir, 'Sample*', '*.fastq*'))
+        fastqs.extend((project_name, f) for f in sample_files)
+    return fastqs
 
 
 def run_commands(new_dir, cmd_list, num_jobs):
-    LOGGER.info("chdir to %s" % (new_dir,))
-    curdir = os.getcwd()
-    os.chdir(new_dir)
-    q = queuecommands.QueueCommands(cmd_list, num_jobs)
+    LOGGER.info("running commands in %s" % (new_dir,))
+    q = queuecommands.QueueCommands(cmd_list, num_jobs, cwd=new_dir)
     q.run()
-    os.chdir(curdir)
 
-def make_md5_commands(destdir):
+def find_archive_files(destdir):
   """
-  Scan the cycle dir and create md5s for the contents
+  Return the compressed and srf files in destdir that need checksums
   """
-  cmd_list = []
   destdir = os.path.abspath(destdir)
   bz2s = glob(os.path.join(destdir, "*.bz2"))
   gzs = glob(os.path.join(destdir, "*gz"))
   srfs = glob(os.path.join(destdir, "*.srf"))
 
-  file_list = bz2s + gzs + srfs
+  return bz2s + gzs + srfs
 
-  for f in file_list:
+def make_md5_commands(destdir):
+  """
+  Scan the cycle dir and create md5s for the contents
+  """
+  cmd_list = []
+  for f in find_archive_files(destdir):
       cmd = " ".join(['md5sum', f, '>', f + '.md5'])
       LOGGER.info('generated command: ' + cmd)
       cmd_list.append(cmd)
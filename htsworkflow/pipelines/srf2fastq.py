@@ -8,17 +8,15 @@ import os
 from subprocess import Popen, PIPE
 import sys
 
+from htsworkflow.util.compression import open_compressed
+from htsworkflow.util.fastqindex import IndexingWriter
+from htsworkflow.util.fastqio import read_fastq_batches, FastqWriter, \
+     ThreadedReader
 from htsworkflow.util.opener import autoopen
 from htsworkflow.util.version import version
 
 LOGGER = logging.getLogger(__name__)
 
-# constants for our fastq finite state machine
-FASTQ_HEADER = 0
-FASTQ_SEQUENCE = 1
-FASTQ_SEQUENCE_HEADER = 2
-FASTQ_QUALITY = 3
-
 def main(cmdline=None):
     parser = make_parser()
     opts, args = parser.parse_args(cmdline)
@@ -41,21 +39,28 @@ def main(cmdline=None):
         header = ''
 
     if opts.single:
-        left = open_write(opts.single, opts.force)
+        left = open_write(opts.single, opts.force, opts.threads, opts.bgzf)
     else:
-        left = open_write(opts.left, opts.force)
-        right = open_write(opts.right, opts.force)
+        left = open_write(opts.left, opts.force, opts.threads, opts.bgzf)
+        right = open_write(opts.right, opts.force, opts.threads, opts.bgzf)
 
     # open the srf, fastq, or compressed fastq
     if is_srf(args[0]):
         source = srf_open(args[0], opts.srf2fastq, opts.cnf1)
     else:
-        source = autoopen(args[0])
+        source = ThreadedReader(autoopen(args[0], 'rb'))
 
-    if opts.single:
-        convert_single_to_fastq(source, left, header)
-    else:
-        convert_single_to_two_fastq(source, left, right, opts.mid, header)
+    try:
+        if opts.single:
+            convert_single_to_fastq(source, left, header)
+            left.close()
+        else:
+            convert_single_to_two_fastq(source, left, right, opts.mid, header)
+            left.close()
+            right.close()
+    finally:
+        # stops the reader thread and srf2fastq if we gave up early
+        source.close()
 
     return 0
 
@@ -85,6 +90,12 @@ You can also force the flowcell ID to be added to the header.""")
                       help="Force cnf1 mode in srf2fastq")
     parser.add_option('--srf2fastq', default='srf2fastq',
                       help='specify srf2fastq command')
+    parser.add_option('--bgzf', default=False, action='store_true',
+                      help='write seekable blocked gzip targets with a '\
+                           'record index')
+    parser.add_option('--threads', default=1, type='int',
+                      help='number of threads to use compressing .gz or '\
+                           '.bz2 targets')
     return parser
 
 
@@ -101,34 +112,20 @@ def srf_open(filename, srf2fastq_cmd, cnf1=False):
 
     LOGGER.info('srf command: %s' % (" ".join(cmd),))
     p = Popen(cmd, stdout=PIPE)
-    return p.stdout
+    # drain the pipe on another thread so srf2fastq doesn't wait on us
+    return ThreadedReader(p.stdout, process=p)
 
 
 def convert_single_to_fastq(instream, target1, header=''):
-    state = FASTQ_HEADER
-    for line in instream:
-        line = line.strip()
-        # sequence header
-        if state == FASTQ_HEADER:
-            write_header(target1, header, line)
-            state = FASTQ_SEQUENCE
-        # sequence
-        elif state == FASTQ_SEQUENCE:
-            write_sequence(target1, line)
-            state = FASTQ_SEQUENCE_HEADER
-        # quality header
-        elif state == FASTQ_SEQUENCE_HEADER:
-            # the sequence header isn't really sequence, but
-            # we're just passing it through
-            write_sequence(target1, line)
-            state = FASTQ_QUALITY
-        # sequence or quality data
-        elif state == FASTQ_QUALITY:
-            write_sequence(target1, line)
-            state = FASTQ_HEADER
-        else:
-            raise RuntimeError("Unrecognized STATE in fastq split")
-
+    """
+    Copy a fastq file, optionally adding a prefix to the read names.
+    """
+    prefix = b'@' + header.encode('ascii')
+    writer = FastqWriter(target1)
+    for lines in read_fastq_batches(instream):
+        lines[0::4] = [prefix + line[1:] for line in lines[0::4]]
+        writer.write_lines(lines)
+    writer.flush()
 
 
 def convert_single_to_two_fastq(instream, target1, target2, mid=None, header=''):
@@ -142,52 +139,28 @@ def convert_single_to_two_fastq(instream, target1, target2, mid=None, header='')
     if mid is not None:
         mid = int(mid)
 
-    state = FASTQ_HEADER
-    for line in instream:
-        line = line.strip()
-        # sequence header
-        if state == FASTQ_HEADER:
-            write_header(target1, header, line, "/1")
-            write_header(target2, header, line, "/2")
-            state = FASTQ_SEQUENCE
-        # sequence
-        elif state == FASTQ_SEQUENCE:
-            if mid is None:
-                mid = len(line) // 2
-            write_split_sequence(target1, target2, line, mid)
-            state = FASTQ_SEQUENCE_HEADER
-        # quality header
-        elif state == FASTQ_SEQUENCE_HEADER:
-            # the sequence header isn't really sequence, but
-            # we're just passing it through
-            write_sequence(target1, line)
-            write_sequence(target2, line)
-
-            state = FASTQ_QUALITY
-        # sequence or quality data
-        elif state == FASTQ_QUALITY:
-            write_split_sequence(target1, target2, line, mid)
-            state = FASTQ_HEADER
-        else:
-            raise RuntimeError("Unrecognized STATE in fastq split")
-
-def write_header(target, prefix, line, suffix=''):
-    target.write('@')
-    target.write(prefix)
-    target.write(line[1:])
-    target.write(suffix)
-    target.write(os.linesep)
+    prefix = b'@' + header.encode('ascii')
+    writer1 = FastqWriter(target1)
+    writer2 = FastqWriter(target2)
+    for lines in read_fastq_batches(instream):
+        headers = [prefix + line[1:] for line in lines[0::4]]
+        sequences = lines[1::4]
+        quality_headers = lines[2::4]
+        qualities = lines[3::4]
+        if mid is None:
+            mid = len(sequences[0]) // 2
+
+        writer1.write_records([line + b'/1' for line in headers],
+                              [line[:mid] for line in sequences],
+                              quality_headers,
+                              [line[:mid] for line in qualities])
+        writer2.write_records([line + b'/2' for line in headers],
+                              [line[mid:] for line in sequences],
+                              quality_headers,
+                              [line[mid:] for line in qualities])
+    writer1.flush()
+    writer2.flush()
 
-def write_sequence(target, line):
-    target.write(line)
-    target.write(os.linesep)
-
-def write_split_sequence(target1, target2, line, mid):
-    target1.write(line[:mid])
-    target1.write(os.linesep)
-
-    target2.write(line[mid:])
-    target2.write(os.linesep)
 
 def is_srf(filename):
     """
@@ -225,15 +198,25 @@ def is_cnf1(filename):
     else:
         return True
 
-def open_write(filename, force=False):
+def open_write(filename, force=False, threads=1, bgzf=False):
     """
     Open a file, but throw an exception if it already exists
+
+    Filenames ending in .gz or .bz2 are compressed using threads,
+    if bgzf is set the file is written as BGZF with a record index.
+    A sequence index is saved when the file is closed.
     """
     if not force:
         if os.path.exists(filename):
             raise RuntimeError("%s exists" % (filename,))
 
-    return open(filename, 'w')
+    compression = os.path.splitext(filename)[1]
+    if bgzf:
+        compression = '.bgzf'
+    elif compression not in ('.gz', '.bz2'):
+        compression = None
+    return IndexingWriter(open_compressed(filename, compression, threads),
+                          filename)
 
 def foo():
     path, name = os.path.split(filename)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+from contextlib import redirect_stdout
+from io import BytesIO, StringIO
+import gzip
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from htsworkflow.pipelines import demultiplex
+
+BARCODES = {'11111_index1': 'ATCACG', '11111_index2': 'CGATGT'}
+
+
+def make_fastq(barcodes):
+    records = []
+    for i, barcode in enumerate(barcodes):
+        records.append(b'@HWI-ST0787:114:D0PMDACXX:8:1101:1605:%d '
+                       b'1:N:0:%s\nACGT\n+\nIIII\n' % (i, barcode))
+    return b''.join(records)
+
+
+class TestDemultiplex(TestCase):
+    def setUp(self):
+        self.outputs = {}
+
+    def open_output(self, name):
+        stream = BytesIO()
+        stream.close = lambda: None
+        self.outputs[name] = stream
+        return stream
+
+    def test_expand_barcode(self):
+        expanded = demultiplex.expand_barcode(b'ACGT', 1)
+        self.assertEqual(len(expanded), 1 + 4 * 4)
+        self.assertIn(b'ACNT', expanded)
+        self.assertEqual(len(demultiplex.expand_barcode(b'ACGT', 0)), 1)
+        self.assertEqual(len(demultiplex.expand_barcode(b'ACGT', 2)),
+                         1 + 4 * 4 + 6 * 16)
+
+    def test_barcode_collisions(self):
+        table, lengths = demultiplex.make_barcode_table(BARCODES, 2)
+        self.assertEqual(lengths, (6,))
+        self.assertEqual(table[b'ATCACG'], '11111_index1')
+        self.assertEqual(table[b'CGATGA'], '11111_index2')
+
+        close = {'a': 'ACGTAC', 'b': 'ACGTTT'}
+        demultiplex.make_barcode_table(close, 0)
+        self.assertRaises(ValueError, demultiplex.make_barcode_table,
+                          close, 1)
+        self.assertRaises(ValueError, demultiplex.make_barcode_table,
+                          {'a': 'ACGTAC', 'b': 'ACGT'})
+
+    def test_dual_index(self):
+        table, lengths = demultiplex.make_barcode_table(
+            {'a': 'ACGTAC-TTTTTT', 'b': 'ACGTAC-GGGGGG'}, 1)
+        self.assertEqual(lengths, (6, 6))
+        self.assertEqual(table[b'ACGTAA+TTTTTT'], 'a')
+        self.assertEqual(table[b'ACGTAA+GGGGGA'], 'b')
+
+    def test_read_barcode(self):
+        self.assertEqual(demultiplex.get_read_barcode(
+            b'@HWI-ST0787:114:D0PMDACXX:8:1101:1605:2154 1:N:0:TAGCTT'),
+            b'TAGCTT')
+        self.assertEqual(demultiplex.get_read_barcode(
+            b'@HWI-EAS229:1:1:1:1#ACGTAC/1'), b'ACGTAC')
+        self.assertEqual(demultiplex.get_read_barcode(
+            b'@HWI-EAS229:1:1:1:1#ACGTAC'), b'ACGTAC')
+
+    def test_demultiplex(self):
+        # the reads have an extra index cycle
+        fastq = make_fastq([b'ATCACGA', b'CGATGTA', b'ATCACTA',
+                            b'GGGGGGA', b'ATCACGA', b'NTCACGA'])
+        demultiplexer = demultiplex.Demultiplexer(BARCODES,
+                                                  self.open_output, 1)
+        demultiplexer.run(BytesIO(fastq))
+        demultiplexer.close()
+
+        lines = fastq.split(b'\n')
+        index1 = self.outputs['11111_index1'].getvalue().split(b'\n')
+        self.assertEqual(index1[0::4][:4],
+                         [lines[0], lines[8], lines[16], lines[20]])
+        self.assertEqual(len(self.outputs['11111_index2'].getvalue()
+                             .split(b'\n')), 5)
+
+        report = demultiplexer.report()
+        self.assertEqual(report['counts'],
+                         {'11111_index1': 4, '11111_index2': 1})
+        self.assertEqual(report['undetermined'], 1)
+        self.assertEqual(report['top_undetermined'], [('GGGGGGA', 1)])
+
+    def test_wrong_length_barcodes(self):
+        # ATCACG and ATCACGAT would otherwise be trimmed into index1
+        fastq = make_fastq([b'ATCACGA', b'ATCACG', b'ATCACGAT',
+                            b'CGATGTA'])
+        demultiplexer = demultiplex.Demultiplexer(BARCODES,
+                                                  self.open_output, 1)
+        demultiplexer.run(BytesIO(fastq))
+        demultiplexer.close()
+        report = demultiplexer.report()
+        self.assertEqual(report['counts'],
+                         {'11111_index1': 1, '11111_index2': 1})
+        self.assertEqual(report['undetermined'], 2)
+        self.assertEqual(report['wrong_length'], 2)
+
+    def test_wrong_layout_dual_index(self):
+        barcodes = {'a': 'ACGTAC-TTTTTT', 'b': 'ACGTAC-GGGGGG'}
+        fastq = make_fastq([b'ACGTACA+TTTTTTA', b'ACGTAC+TTTTTTAA',
+                            b'ACGTACA+GGGGGGA', b'ACGTACAT+TTTTTT'])
+        demultiplexer = demultiplex.Demultiplexer(barcodes,
+                                                  self.open_output, 1)
+        demultiplexer.run(BytesIO(fastq))
+        demultiplexer.close()
+        report = demultiplexer.report()
+        self.assertEqual(report['counts'], {'a': 1, 'b': 1})
+        self.assertEqual(report['wrong_length'], 2)
+
+    def test_pooled_barcodes(self):
+        from django.core.exceptions import ImproperlyConfigured
+        try:
+            from htsworkflow.pipelines import retrieve_config
+        except ImproperlyConfigured:
+            self.skipTest('Need django settings to test pooled_barcodes')
+
+        flowcell_info = {'lane_set': {'1': [
+            {'library_id': '11111',
+             'index_sequence': {'1': 'ATCACG', '2': 'CGATGT'}},
+            {'library_id': '12345'},
+        ]}}
+        self.assertEqual(demultiplex.pooled_barcodes(flowcell_info, 1),
+                         BARCODES)
+        self.assertEqual(demultiplex.pooled_barcodes(flowcell_info, 2), {})
+
+    def test_main(self):
+        tempdir = tempfile.mkdtemp(prefix='demultiplex_test')
+        try:
+            barcodes = os.path.join(tempdir, 'barcodes.txt')
+            with open(barcodes, 'w') as stream:
+                stream.write('# name\tindex\n')
+                for name in sorted(BARCODES):
+                    stream.write('%s\t%s\n' % (name, BARCODES[name]))
+            source = os.path.join(tempdir, 'undetermined.fastq.gz')
+            with gzip.open(source, 'wb') as stream:
+                stream.write(make_fastq([b'ATCACG', b'CGATGT', b'AAAAAA']))
+
+            report = os.path.join(tempdir, 'report.json')
+            output = StringIO()
+            with redirect_stdout(output):
+                demultiplex.main(['-b', barcodes, '-o', tempdir, '--gzip',
+                                  '--threads', '2',
+                                  '--report', report, source])
+            self.assertIn('11111_index1\tATCACG\t1', output.getvalue())
+            with open(report) as stream:
+                self.assertEqual(json.load(stream)['undetermined'], 1)
+            for name in ['11111_index1', '11111_index2', 'Undetermined']:
+                pathname = os.path.join(tempdir, name + '.fastq.gz')
+                with gzip.open(pathname, 'rb') as stream:
+                    self.assertEqual(len(stream.read().split(b'\n')), 5)
+        finally:
+            shutil.rmtree(tempdir)
+
+
+def suite():
+    from unittest import TestSuite, defaultTestLoader
+    suite = TestSuite()
+    suite.addTests(defaultTestLoader.loadTestsFromTestCase(TestDemultiplex))
+    return suite
+
+
+if __name__ == "__main__":
+    from unittest import main
+    main(defaultTest="suite")
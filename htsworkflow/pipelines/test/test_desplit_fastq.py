@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+import bz2
+import gzip
+import hashlib
+from io import BytesIO
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from htsworkflow.pipelines import desplit_fastq
+from htsworkflow.util.fastqindex import load_sequence_index
+from htsworkflow.util.opener import open_record
+
+FASTQ1 = b"""@read1
+AGCTTTTT
++
+IIIIB+++
+"""
+FASTQ2 = b"""@read2
+GGGGCCCC
++
+IIIIIIII
+"""
+
+
+class TestDesplitFastq(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='desplit_test')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def make_file(self, name, data):
+        pathname = os.path.join(self.tempdir, name)
+        if name.endswith('.gz'):
+            stream = gzip.open(pathname, 'wb')
+        elif name.endswith('.bz2'):
+            stream = bz2.open(pathname, 'wb')
+        else:
+            stream = open(pathname, 'wb')
+        with stream:
+            stream.write(data)
+        return pathname
+
+    def read_file(self, pathname):
+        with desplit_fastq.autoopen(pathname, 'rb') as stream:
+            return stream.read()
+
+    def read_raw(self, pathname):
+        with open(pathname, 'rb') as stream:
+            return stream.read()
+
+    def test_concatenate_compressed_members(self):
+        sources = [self.make_file('a.fastq.gz', FASTQ1),
+                   self.make_file('b.fastq.gz', FASTQ2)]
+        output = os.path.join(self.tempdir, 'out.fastq.gz')
+        self.assertEqual(
+            desplit_fastq.concatenate_fastqs(sources, output, '.gz'), 2)
+
+        # the compressed members should have been copied verbatim
+        raw = b''.join(self.read_raw(s) for s in sources)
+        self.assertEqual(self.read_raw(output), raw)
+        self.assertEqual(self.read_file(output), FASTQ1 + FASTQ2)
+
+    def test_concatenate_mixed_compression(self):
+        sources = [self.make_file('a.fastq.bz2', FASTQ1),
+                   self.make_file('b.fastq', FASTQ2),
+                   self.make_file('c.fastq.gz', FASTQ1)]
+        output = os.path.join(self.tempdir, 'out.fastq.bz2')
+        desplit_fastq.concatenate_fastqs(sources, output, '.bz2')
+        self.assertEqual(self.read_file(output),
+                         FASTQ1 + FASTQ2 + FASTQ1)
+
+        output = os.path.join(self.tempdir, 'out.fastq')
+        desplit_fastq.concatenate_fastqs(sources, output)
+        self.assertEqual(self.read_raw(output),
+                         FASTQ1 + FASTQ2 + FASTQ1)
+
+    def test_concatenate_missing_newline(self):
+        unterminated = FASTQ1.rstrip(b'\n')
+        for compression in [None, '.gz', '.bz2']:
+            extension = compression or ''
+            sources = [self.make_file('a.fastq' + extension, unterminated),
+                       self.make_file('b.fastq', FASTQ2),
+                       self.make_file('c.fastq.gz', unterminated)]
+            output = os.path.join(self.tempdir, 'out.fastq' + extension)
+            desplit_fastq.concatenate_fastqs(sources, output, compression)
+            with desplit_fastq.autoopen(output, 'rb') as stream:
+                self.assertEqual(stream.read(), FASTQ1 + FASTQ2 + FASTQ1)
+            index = load_sequence_index(output)
+            self.assertEqual(index.reads, 3)
+            self.assertEqual(index.size, len(FASTQ1 + FASTQ2 + FASTQ1))
+            self.assertEqual(index.md5, hashlib.md5(
+                FASTQ1 + FASTQ2 + FASTQ1).hexdigest())
+
+        output = BytesIO()
+        desplitter = desplit_fastq.DesplitFastq(
+            [BytesIO(unterminated), BytesIO(FASTQ2)], output)
+        desplitter.run()
+        self.assertEqual(output.getvalue(), FASTQ1 + FASTQ2)
+
+    def test_concatenate_multiple_members(self):
+        block_size = desplit_fastq.BLOCK_SIZE
+        desplit_fastq.BLOCK_SIZE = 7
+        try:
+            for compression, module in [('.gz', gzip), ('.bz2', bz2)]:
+                source = os.path.join(self.tempdir, 'a.fastq' + compression)
+                with open(source, 'wb') as stream:
+                    stream.write(module.compress(FASTQ1))
+                    stream.write(module.compress(FASTQ2.rstrip(b'\n')))
+                output = os.path.join(self.tempdir, 'out.fastq' + compression)
+                desplit_fastq.concatenate_fastqs([source, source], output,
+                                                 compression)
+                expected = (FASTQ1 + FASTQ2) * 2
+                with module.open(output, 'rb') as stream:
+                    self.assertEqual(stream.read(), expected)
+                index = load_sequence_index(output)
+                self.assertEqual(index.reads, 4)
+                self.assertEqual(index.md5,
+                                 hashlib.md5(expected).hexdigest())
+        finally:
+            desplit_fastq.BLOCK_SIZE = block_size
+
+    def test_concatenate_nothing(self):
+        output = os.path.join(self.tempdir, 'out.fastq')
+        self.assertRaises(RuntimeError,
+                          desplit_fastq.concatenate_fastqs, [], output)
+
+    def test_main_matches_trimmed_path(self):
+        self.make_file('a_1.fastq.gz', FASTQ1)
+        self.make_file('a_2.fastq.gz', FASTQ2)
+        pattern = os.path.join(self.tempdir, 'a_*.fastq.gz')
+
+        fast = os.path.join(self.tempdir, 'fast.fastq.gz')
+        desplit_fastq.main(['--gzip', '-o', fast, pattern])
+        slow = os.path.join(self.tempdir, 'slow.fastq.gz')
+        desplit_fastq.main(['--gzip', '-s', '0:100', '-o', slow, pattern])
+
+        self.assertEqual(self.read_file(fast),
+                         self.read_file(slow))
+
+    def test_main_threads(self):
+        self.make_file('a_1.fastq', FASTQ1)
+        self.make_file('a_2.fastq.bz2', FASTQ2)
+        pattern = os.path.join(self.tempdir, 'a_*.fastq*')
+
+        for args in [[], ['-s', '0:100']]:
+            output = os.path.join(self.tempdir, 'threads.fastq.gz')
+            desplit_fastq.main(
+                ['--gzip', '--threads', '2', '-o', output, pattern] + args)
+            self.assertEqual(sorted(self.read_file(output).split()),
+                             sorted((FASTQ1 + FASTQ2).split()))
+
+    def test_main_bgzf(self):
+        self.make_file('a_1.fastq.gz', FASTQ1)
+        self.make_file('a_2.fastq.gz', FASTQ2)
+        pattern = os.path.join(self.tempdir, 'a_*.fastq.gz')
+        output = os.path.join(self.tempdir, 'out.fastq.gz')
+        desplit_fastq.main(['--bgzf', '-o', output, pattern])
+
+        self.assertEqual(sorted(self.read_file(output).split()),
+                         sorted((FASTQ1 + FASTQ2).split()))
+        with open_record(output, 1) as stream:
+            self.assertEqual(len(stream.read().split()), 4)
+
+    def test_run_untrimmed_streams(self):
+        output = BytesIO()
+        sources = [BytesIO(FASTQ1), BytesIO(FASTQ2)]
+        desplitter = desplit_fastq.DesplitFastq(sources, output)
+        desplitter.run()
+        self.assertEqual(output.getvalue(), FASTQ1 + FASTQ2)
+        self.assertTrue(all(source.closed for source in sources))
+
+    def test_run_trimmed(self):
+        output = BytesIO()
+        desplitter = desplit_fastq.DesplitFastq([BytesIO(FASTQ1)], output)
+        desplitter.trim = slice(0, 4)
+        desplitter.run()
+        lines = output.getvalue().split()
+        self.assertEqual(lines, [b'@read1', b'AGCT', b'+', b'IIII'])
+
+
+def suite():
+    from unittest import TestSuite, defaultTestLoader
+    suite = TestSuite()
+    suite.addTests(defaultTestLoader.loadTestsFromTestCase(TestDesplitFastq))
+    return suite
+
+
+if __name__ == "__main__":
+    from unittest import main
+    main(defaultTest="suite")
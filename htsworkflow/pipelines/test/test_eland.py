@@ -1,11 +1,25 @@
 #!/usr/bin/env python
 """More direct synthetic test cases for the eland output file processing
 """
+import os
+import shutil
 from six.moves import StringIO
+import tempfile
 from unittest import TestCase
 
 from htsworkflow.pipelines.eland import ELAND, ElandLane, ElandMatches, \
-     SampleKey, MatchCodes, MappedReads
+     SampleKey, MatchCodes, MappedReads, make_eland_chunks, read_eland_chunk, \
+     read_eland_blocks, benchmark_export_parsers, eland_summary_pathname, \
+     load_eland_summary, eland, ElandPipeline, CountConsumer, BedConsumer, \
+     SequenceConsumer, HistogramConsumer, ELAND_SINGLE
+from htsworkflow.util.makebed import make_bed_from_eland_stream
+
+EXPORT_LINES = [
+    "ILLUMINA-33A494\t1\t1\t1\t3291\t1036\t0\t1\tGANNTCC\t\\XBB]^^\tQC\n",
+    "ILLUMINA-33A494\t1\t1\t1\t2678\t1045\t0\t1\tAAGGTGA\t]]WW[[W\tchrX.fa\t\t148341829\tF\t38\t45\n",
+    "ILLUMINA-33A494\t1\t1\t1\t2678\t1045\t0\t1\tAAGGTGA\t]]WW[[W\tchr2.fa\t\t148341829\tF\t18AA15G1T\t45\n",
+    "ILLUMINA-33A494\t1\t1\t1\t4405\t1046\t0\t1\tGTGGTTT\t``````_\t9:2:1\n",
+]
 
 class MatchCodeTests(TestCase):
     def test_initializer(self):
@@ -37,6 +51,23 @@ class MatchCodeTests(TestCase):
         self.assertEqual(mc1['QC'], 10)
         self.assertEqual(mc1['U0'], 100)
 
+        mc3 = mc1 + mc2
+        self.assertEqual(mc3['NM'], 15)
+        self.assertEqual(mc1['NM'], 10)
+        self.assertRaises(ValueError, mc3.__setitem__, 'foo', 1)
+
+    def test_array_counts(self):
+        mc = MatchCodes({'U1': 2})
+        mc.add_counts([1] * len(MatchCodes.CODES))
+        self.assertEqual(mc.counts.dtype.kind, 'i')
+        self.assertEqual(mc['U1'], 3)
+        self.assertEqual(type(mc['NM']), int)
+
+    def test_unrecognized_result_code(self):
+        lane = ElandLane()
+        records = [['>read1', 'ACGT', 'U0'], ['>read2', 'ACGT', 'XX']]
+        self.assertRaises(ValueError, lane._count_eland_result, records)
+
 
 class TestMappedReads(TestCase):
     def test_initializer(self):
@@ -73,6 +104,30 @@ class TestMappedReads(TestCase):
         mr3['Lambda3'] = 2
         self.assertEqual(mr3['Lambda3'], 2)
 
+    def test_interned_contigs(self):
+        contigs = ['hg19/chr1.fa', 'hg19/chr2.fa']
+        mr1 = MappedReads(contigs=contigs)
+        self.assertEqual(len(mr1), 0)
+        self.assertEqual(mr1.intern('hg19/chr2.fa'), 1)
+        mr1.add_counts([3, 0])
+        self.assertEqual(list(mr1.items()), [('hg19/chr1.fa', 3)])
+        self.assertFalse('hg19/chr2.fa' in mr1)
+
+        mr2 = MappedReads(contigs=contigs)
+        mr2.add_counts([1, 4])
+        mr2['Lambda1'] = 2
+        mr1 += mr2
+        self.assertEqual(dict(mr1), {'hg19/chr1.fa': 4,
+                                     'hg19/chr2.fa': 4,
+                                     'Lambda1': 2})
+        # different interning orders still add up
+        mr3 = MappedReads({'Lambda1': 1, 'hg19/chr2.fa': 1}) + mr1
+        self.assertEqual(mr3['Lambda1'], 3)
+        self.assertEqual(mr3['hg19/chr2.fa'], 5)
+        del mr3['Lambda1']
+        self.assertEqual(len(mr3), 2)
+        self.assertRaises(KeyError, mr3.__getitem__, 'Lambda1')
+
 class ElandTests(TestCase):
     """Test specific Eland modules
     """
@@ -275,6 +330,226 @@ class TestElandMatches(TestCase):
         self.assertEqual(len(em[key11111]), 3)
         self.assertEqual(len(em[key11112]), 2)
 
+class TestElandChunks(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='eland_chunks_')
+        self.pathname = os.path.join(self.tempdir,
+                                     '11111_CCAATT_L001_R1_001_export.txt')
+        with open(self.pathname, 'wt') as stream:
+            for i in range(50):
+                stream.writelines(EXPORT_LINES)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_chunks_cover_file(self):
+        chunks = make_eland_chunks(self.pathname, 7)
+        self.assertEqual(len(chunks), 7)
+        self.assertEqual(chunks[0][0], 0)
+        self.assertEqual(chunks[-1][1], os.path.getsize(self.pathname))
+        lines = []
+        for start, end in chunks:
+            lines.extend(read_eland_chunk(self.pathname, start, end))
+        self.assertEqual(lines, EXPORT_LINES * 50)
+
+    def test_export_blocks_match_lines(self):
+        eland = ElandLane()
+        with open(self.pathname, 'rt') as stream:
+            expected = eland._update_eland_export(stream)
+        # use a tiny block size so reads are split across blocks
+        blocks = read_eland_blocks(self.pathname, block_size=37)
+        result = eland._update_eland_export_blocks(blocks)
+        self.assertEqual(dict(result[0]), dict(expected[0]))
+        self.assertEqual(dict(result[1]), dict(expected[1]))
+        self.assertEqual(result[2], expected[2])
+        self.assertEqual(result[1]['chr2.fa'], 50)
+        self.assertEqual(result[0]['U2'], 100)
+        self.assertEqual(result[0]['R0'], 450)
+
+    def test_export_blocks_bad_lines(self):
+        eland = ElandLane()
+        truncated = EXPORT_LINES[1].split('\t', 5)[0] + '\n'
+        missing_descriptor = EXPORT_LINES[1].rsplit('\t', 3)[0] + '\n'
+        for bad, message in [(truncated, 'line 2: expected at least 11'),
+                             (missing_descriptor, 'line 2: mapped read')]:
+            data = (EXPORT_LINES[0] + bad + EXPORT_LINES[2]).encode()
+            with self.assertRaises(ValueError) as context:
+                eland._update_eland_export_blocks([data], 'a_export.txt')
+            self.assertIn('a_export.txt ' + message, str(context.exception))
+
+    def test_benchmark_export_parsers(self):
+        timings = benchmark_export_parsers(self.pathname)
+        self.assertEqual([t[0] for t in timings], ['line', 'block'])
+        self.assertEqual([t[1] for t in timings], [200, 200])
+
+    def test_summary_cache(self):
+        lane = ElandLane([self.pathname], '11111', 1, 1)
+        self.assertEqual(lane.reads, 200)
+        cache_name = eland_summary_pathname(self.pathname)
+        self.assertTrue(os.path.exists(cache_name))
+
+        cached = load_eland_summary(self.pathname, lane.eland_type,
+                                    lane.genome_map)
+        self.assertEqual(dict(cached[0]), dict(lane.match_codes))
+        self.assertEqual(dict(cached[1]), dict(lane.mapped_reads))
+        self.assertEqual(cached[2], 200)
+
+        # a different genome map invalidates the summary
+        self.assertIsNone(load_eland_summary(self.pathname, lane.eland_type,
+                                             {'chrX.fa': 'hg19/chrX.fa'}))
+        # so does changing the file
+        with open(self.pathname, 'at') as stream:
+            stream.write(EXPORT_LINES[0])
+        self.assertIsNone(load_eland_summary(self.pathname, lane.eland_type,
+                                             lane.genome_map))
+        lane = ElandLane([self.pathname], '11111', 1, 1)
+        self.assertEqual(lane.reads, 201)
+
+    def test_summary_cache_ignored_by_matches(self):
+        em = ElandMatches(ELAND())
+        em.add(eland_summary_pathname(self.pathname))
+        self.assertEqual(len(em), 0)
+
+    def test_eager_lane_counts(self):
+        second = os.path.join(self.tempdir,
+                              '11112_AAGGTT_L002_R1_001_export.txt')
+        shutil.copy(self.pathname, second)
+        e = eland(self.tempdir, num_jobs=2, eager=True)
+        self.assertEqual(len(e), 2)
+        for key in e:
+            self.assertEqual(e[key]._reads, 200)
+            self.assertEqual(e[key].mapped_reads['chrX.fa'], 50)
+
+        timings = e.count(2)
+        self.assertEqual(timings, {})
+
+    def test_update_incremental(self):
+        growing = os.path.join(self.tempdir, 's_2_export.txt')
+        lane = ElandLane([growing], 's', 2, 1)
+        open(growing, 'wt').close()
+        self.assertEqual(lane.update_incremental(), 0)
+        self.assertEqual(lane.reads, 0)
+
+        with open(growing, 'at') as stream:
+            stream.writelines(EXPORT_LINES[:2])
+            stream.write(EXPORT_LINES[2][:20])
+        self.assertEqual(lane.update_incremental(), 2)
+        self.assertEqual(lane.reads, 2)
+        self.assertEqual(lane.match_codes['QC'], 1)
+        self.assertEqual(lane.mapped_reads['chrX.fa'], 1)
+
+        with open(growing, 'at') as stream:
+            stream.write(EXPORT_LINES[2][20:])
+            stream.writelines(EXPORT_LINES[3:] + EXPORT_LINES)
+        self.assertEqual(lane.update_incremental(), 6)
+        self.assertEqual(lane.update_incremental(), 0)
+
+        complete = ElandLane([growing], 's', 2, 1, use_cache=False)
+        self.assertEqual(lane.reads, complete.reads)
+        self.assertEqual(dict(lane.match_codes), dict(complete.match_codes))
+        self.assertEqual(dict(lane.mapped_reads), dict(complete.mapped_reads))
+
+    def test_update_incremental_truncated(self):
+        growing = os.path.join(self.tempdir, 's_2_export.txt')
+        lane = ElandLane([growing], 's', 2, 1)
+        with open(growing, 'wt') as stream:
+            stream.writelines(EXPORT_LINES)
+        self.assertEqual(lane.update_incremental(), 4)
+        open(growing, 'wt').close()
+        self.assertEqual(lane.update_incremental(), 0)
+        self.assertEqual(lane.reads, 0)
+        self.assertEqual(dict(lane.mapped_reads), {})
+
+    def test_update_incremental_compressed(self):
+        import bz2
+        compressed = os.path.join(self.tempdir, 's_2_export.txt.bz2')
+        lane = ElandLane([compressed], 's', 2, 1)
+        with open(compressed, 'wb') as stream:
+            stream.write(bz2.compress(''.join(EXPORT_LINES).encode())[:20])
+        summarize = lane._summarize_chunk
+        calls = []
+        def count_calls(*args):
+            calls.append(args)
+            return summarize(*args)
+        lane._summarize_chunk = count_calls
+
+        # an incomplete file is only read again once it changes
+        self.assertEqual(lane.update_incremental(), 0)
+        self.assertEqual(lane.update_incremental(), 0)
+        self.assertEqual(len(calls), 1)
+
+        with open(compressed, 'wb') as stream:
+            stream.write(bz2.compress(''.join(EXPORT_LINES).encode()))
+        self.assertEqual(lane.update_incremental(), 4)
+        self.assertEqual(lane.update_incremental(), 0)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(lane.reads, 4)
+
+    def test_compressed_not_chunked(self):
+        self.assertEqual(make_eland_chunks('s_1_export.txt.bz2', 4),
+                         [(0, None)])
+
+    def test_parallel_matches_serial(self):
+        serial = ElandLane([self.pathname], '11111', 1, 1)
+        parallel = ElandLane([self.pathname], '11111', 1, 1, num_jobs=3)
+        self.assertEqual(parallel.reads, 200)
+        self.assertEqual(serial.reads, parallel.reads)
+        self.assertEqual(dict(serial.match_codes), dict(parallel.match_codes))
+        self.assertEqual(dict(serial.mapped_reads),
+                         dict(parallel.mapped_reads))
+        self.assertEqual(parallel.mapped_reads['chrX.fa'], 50)
+
+
+    def test_sampled_counts(self):
+        sampled = ElandLane([self.pathname], '11111', 1, 1, read_sample=10)
+        self.assertTrue(0 < sampled.reads <= 10)
+        self.assertFalse(os.path.exists(
+            eland_summary_pathname(self.pathname)))
+
+        everything = ElandLane([self.pathname], '11111', 1, 1,
+                               read_sample=1.0)
+        self.assertEqual(everything.reads, 200)
+        self.assertEqual(everything.mapped_reads['chrX.fa'], 50)
+
+
+class TestElandPipeline(TestCase):
+    RESULT = """>HWI-EAS229_1_1_1_1\tAGCTTTACGAAGCT\tU0\t1\t0\t0\tchr1.fa\t1500\tF\t..
+>HWI-EAS229_1_1_1_2\tGGGGTTTTCCCCAA\tNM\t0\t0\t0
+>HWI-EAS229_1_1_1_3\tACGTACGTACGTAC\tU1\t0\t1\t0\tchr2.fa\t2500000\tR\t..
+>HWI-EAS229_1_1_1_4\tACGTACGTACGTAC\tU0\t1\t0\t0\tchr1.fa\t1700\tR\t..
+"""
+    def test_single_pass_consumers(self):
+        lane = ElandLane(genome_map={'chr1.fa': 'hg19/chr1.fa'})
+        lane.eland_type = ELAND_SINGLE
+        bed = StringIO()
+        sequences = StringIO()
+        pipeline = ElandPipeline(batch_size=3)
+        counter = pipeline.add(CountConsumer(lane))
+        pipeline.add(BedConsumer(bed, 'name', 'description'))
+        pipeline.add(SequenceConsumer(sequences, 0, 4))
+        histogram = pipeline.add(HistogramConsumer(bin_size=1000000))
+        pipeline.run(StringIO(self.RESULT))
+
+        match_codes, mapped_reads, reads = counter.result
+        self.assertEqual(reads, 4)
+        self.assertEqual(match_codes['U0'], 2)
+        self.assertEqual(match_codes['NM'], 1)
+        self.assertEqual(dict(mapped_reads), {'hg19/chr1.fa': 2,
+                                              'chr2.fa': 1})
+
+        expected_bed = StringIO()
+        make_bed_from_eland_stream(StringIO(self.RESULT), expected_bed,
+                                   'name', 'description')
+        self.assertEqual(bed.getvalue(), expected_bed.getvalue())
+
+        lines = sequences.getvalue().splitlines()
+        self.assertEqual(lines[0], '>HWI-EAS229_1_1_1_1\tAGCT')
+        self.assertEqual(len(lines), 4)
+
+        self.assertEqual(dict(histogram.histogram['chr1.fa']), {0: 2})
+        self.assertEqual(dict(histogram.histogram['chr2.fa']), {2: 1})
+
+
 def suite():
     from unittest import TestSuite, defaultTestLoader
     suite = TestSuite()
@@ -282,6 +557,8 @@ def suite():
     suite.addTests(defaultTestLoader.loadTestsFromTestCase(TestMappedReads))
     suite.addTests(defaultTestLoader.loadTestsFromTestCase(ElandTests))
     suite.addTests(defaultTestLoader.loadTestsFromTestCase(TestElandMatches))
+    suite.addTests(defaultTestLoader.loadTestsFromTestCase(TestElandChunks))
+    suite.addTests(defaultTestLoader.loadTestsFromTestCase(TestElandPipeline))
     return suite
 
 
@@ -2,11 +2,14 @@
 from __future__ import absolute_import
 
 from datetime import datetime, date
+import hashlib
 import logging
 import os
 import tempfile
 import shutil
+import subprocess
 import sys
+import tarfile
 from unittest import TestCase
 
 from htsworkflow.pipelines import eland
@@ -15,6 +18,7 @@ from htsworkflow.pipelines import bustard
 from htsworkflow.pipelines import gerald
 from htsworkflow.pipelines import runfolder
 from htsworkflow.pipelines import ElementTree
+from htsworkflow.util.journal import Journal
 
 from .simulate_runfolder import *
 
@@ -79,9 +83,201 @@ class RunfolderExtractTests(TestCase):
         self.assertEqual(len(runs), 1)
         runfolder.extract_results(runs, self.temp_dir, site='asite')
         archive = os.listdir(os.path.join(self.temp_dir, '4286GAAXX', 'C1-38'))
-        self.assertEqual(len(archive), 34)
+        self.assertEqual(len(archive), 35)
         self.assertTrue('asite_090608_HWI-EAS229_0117_4286GAAXX_l6_r1.tar.bz2' in archive)
 
+    def test_get_runs_num_jobs(self):
+        runs = runfolder.get_runs(self.runfolder_dir, num_jobs=2)
+        eland_results = runs[0].gerald.eland_results
+        self.assertEqual(eland_results.num_jobs, 2)
+        serial = runfolder.get_runs(self.runfolder_dir)[0].gerald.eland_results
+        for key in eland_results:
+            if isinstance(eland_results[key], eland.ElandLane):
+                self.assertEqual(eland_results[key].num_jobs, 2)
+                self.assertEqual(eland_results[key].reads,
+                                 serial[key].reads)
+
+    def test_get_runs_eager(self):
+        runs = runfolder.get_runs(self.runfolder_dir, num_jobs=2, eager=True)
+        eland_results = runs[0].gerald.eland_results
+        for key in eland_results:
+            if isinstance(eland_results[key], eland.ElandLane):
+                # counted while scanning instead of on first use
+                self.assertNotEqual(eland_results[key]._reads, None)
+
+    def test_extract_results_parallel(self):
+        runs = runfolder.get_runs(self.runfolder_dir)
+        runfolder.extract_results(runs, self.temp_dir, site='asite',
+                                  num_jobs=4)
+        archive = os.listdir(os.path.join(self.temp_dir, '4286GAAXX', 'C1-38'))
+        self.assertEqual(len(archive), 35)
+        # every compressed file got its md5
+        for name in archive:
+            if name.endswith('.bz2'):
+                self.assertTrue(name + '.md5' in archive)
+
+    def test_split_jobs(self):
+        self.assertEqual(runfolder.split_jobs(0), (1, 1))
+        self.assertEqual(runfolder.split_jobs(1), (1, 1))
+        self.assertEqual(runfolder.split_jobs(4), (2, 2))
+        self.assertEqual(runfolder.split_jobs(5), (2, 3))
+
+    def test_extract_results_checksums(self):
+        runs = runfolder.get_runs(self.runfolder_dir)
+        runfolder.extract_results(runs, self.temp_dir, site='asite',
+                                  num_jobs=2, checksums=('md5', 'sha256'))
+        run_dirname = os.path.join(self.temp_dir, '4286GAAXX', 'C1-38')
+        for name in ['s_1_eland_multi.txt.bz2',
+                     'asite_090608_HWI-EAS229_0117_4286GAAXX_l1_r1.tar.bz2']:
+            pathname = os.path.join(run_dirname, name)
+            with open(pathname, 'rb') as stream:
+                data = stream.read()
+            for checksum in ['md5', 'sha256']:
+                with open(pathname + '.' + checksum) as stream:
+                    digest, filename = stream.read().split()
+                self.assertEqual(digest,
+                                 hashlib.new(checksum, data).hexdigest())
+                self.assertEqual(filename, pathname)
+
+    def test_resume(self):
+        runs = runfolder.get_runs(self.runfolder_dir)
+        runfolder.extract_results(runs, self.temp_dir, site='asite')
+        run_dirname = os.path.join(self.temp_dir, '4286GAAXX', 'C1-38')
+        archive = sorted(os.listdir(run_dirname))
+        mtimes = dict((name, os.path.getmtime(os.path.join(run_dirname, name)))
+                      for name in archive)
+
+        # pretend we died while compressing s_2
+        lost = os.path.join(run_dirname, 's_2_eland_multi.txt.bz2')
+        os.rename(lost, lost + '.partial')
+        os.unlink(lost + '.md5')
+        with open(os.path.join(run_dirname, runfolder.JOURNAL_NAME),
+                  'a') as stream:
+            stream.write('{"task": "half a line')
+
+        runfolder.extract_results(runs, self.temp_dir, site='asite')
+        self.assertFalse(os.path.exists(lost))
+
+        runfolder.extract_results(runs, self.temp_dir, site='asite',
+                                  resume=True)
+        # the partial file was rewritten and renamed into place
+        self.assertEqual(sorted(os.listdir(run_dirname)), archive)
+        for name in archive:
+            pathname = os.path.join(run_dirname, name)
+            if name.startswith('s_2_eland') or \
+               name.startswith('run_') or name == runfolder.JOURNAL_NAME:
+                continue
+            self.assertEqual(os.path.getmtime(pathname), mtimes[name],
+                             name + ' was redone')
+        with open(lost, 'rb') as stream:
+            data = stream.read()
+        with open(lost + '.md5') as stream:
+            self.assertEqual(stream.read().split()[0],
+                             hashlib.md5(data).hexdigest())
+
+    def test_raw_data_journal(self):
+        runs = runfolder.get_runs(self.runfolder_dir)
+        runfolder.extract_results(runs, self.temp_dir, site='asite')
+        run_dirname = os.path.join(self.temp_dir, '4286GAAXX', 'C1-38')
+        journal = Journal(os.path.join(run_dirname, runfolder.JOURNAL_NAME))
+        raw = [entry for task, entry in journal.entries.items()
+               if ': raw qseq ' in task]
+        self.assertTrue(len(raw) > 0)
+        for entry in raw:
+            self.assertEqual(len(entry['outputs']), 1)
+            name = list(entry['outputs'])[0]
+            self.assertTrue(name.endswith('.tar.bz2'))
+            self.assertTrue(os.path.exists(os.path.join(run_dirname, name)))
+
+    def test_raw_fastq_journal(self):
+        runs = runfolder.get_runs(self.runfolder_dir)
+        sample_dir = os.path.join(self.bustard_dir, 'Project_a', 'Sample_1')
+        os.makedirs(sample_dir)
+        source = os.path.join(sample_dir, '1_ATCACG_L001_R1_001.fastq.gz')
+        with open(source, 'wb') as stream:
+            stream.write(b'reads')
+        run_dirname = os.path.join(self.temp_dir, 'archive')
+        os.mkdir(run_dirname)
+        copied = os.path.join(run_dirname, 'Project_a',
+                              os.path.basename(source))
+
+        def archive():
+            journal = Journal(os.path.join(run_dirname,
+                                           runfolder.JOURNAL_NAME))
+            graph = runfolder.TaskGraph(1)
+            runfolder.add_raw_data_tasks(graph, runs[0], 'asite', 'fastq',
+                                         run_dirname, journal=journal)
+            graph.run()
+            return journal
+
+        journal = archive()
+        entry = journal.entries['raw fastq']
+        self.assertEqual(list(entry['sources']), [source])
+        self.assertEqual(list(entry['outputs']),
+                         [os.path.join('Project_a', os.path.basename(source))])
+
+        # a deleted copy is made again
+        os.unlink(copied)
+        archive()
+        self.assertTrue(os.path.exists(copied))
+
+        # and so is one whose source changed
+        with open(source, 'wb') as stream:
+            stream.write(b'more reads')
+        archive()
+        with open(copied, 'rb') as stream:
+            self.assertEqual(stream.read(), b'more reads')
+
+    def test_run_command_failure(self):
+        self.assertRaises(subprocess.CalledProcessError,
+                          runfolder.run_command, 'exit 1', self.temp_dir)
+        self.assertEqual(
+            runfolder.command_output('tar cjf /a/b.tar.bz2 s_1_*_qseq.txt'),
+            '/a/b.tar.bz2')
+        self.assertEqual(
+            runfolder.command_output('illumina2srf -o /a/b.srf s_1_*'),
+            '/a/b.srf')
+
+    def test_save_flowcell_reports(self):
+        reports_dir = os.path.join(self.data_dir, 'reports')
+        os.mkdir(reports_dir)
+        with open(os.path.join(reports_dir, 'index.html'), 'w') as stream:
+            stream.write('<html></html>')
+        dest = os.path.join(self.temp_dir, 'flowcell-reports.tar.bz2')
+        runfolder.save_flowcell_reports(self.data_dir, self.temp_dir)
+        with tarfile.open(dest) as archive:
+            self.assertIn('reports/index.html', archive.getnames())
+        os.unlink(dest)
+
+        # tar fails since Status.xsl is missing
+        with open(os.path.join(self.data_dir, 'Status.xml'), 'w') as stream:
+            stream.write('<Status/>')
+        self.assertRaises(subprocess.CalledProcessError,
+                          runfolder.save_flowcell_reports,
+                          self.data_dir, self.temp_dir)
+        self.assertFalse(os.path.exists(dest))
+        self.assertFalse(os.path.exists(dest + runfolder.PARTIAL_SUFFIX))
+
+    def test_compress_score_files(self):
+        runs = runfolder.get_runs(self.runfolder_dir)
+        score_dir = os.path.join(self.bustard_dir, 'Temp')
+        score_files = sorted(f for f in os.listdir(score_dir)
+                             if f.endswith('_score.txt'))
+        for compression in ['.bz2', '.gz']:
+            manifest = runfolder.compress_score_files(
+                runs[0].bustard, self.temp_dir, compression, threads=2)
+            self.assertEqual([name for name, size in manifest], score_files)
+
+            dest = os.path.join(self.temp_dir, 'scores.tar' + compression)
+            with tarfile.open(dest) as archive:
+                members = archive.getmembers()
+            self.assertEqual([m.name for m in members], score_files)
+            self.assertEqual([(m.name, m.size) for m in members], manifest)
+            with open(dest + '.manifest') as stream:
+                self.assertEqual(stream.readline().split('\t'),
+                                 [score_files[0], '%d\n' % (manifest[0][1],)])
+            self.assertTrue(os.path.exists(dest + '.md5'))
+
 
 def suite():
     from unittest import TestSuite, defaultTestLoader
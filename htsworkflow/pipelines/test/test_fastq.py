@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+import gzip
+from io import BytesIO
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy
+
+from htsworkflow.pipelines import fastq
+
+FASTQ = b"""@HWI-ST0787:114:D0PMDACXX:8:1101:1605:2154 1:N:0:TAGCTT
+ACGT
++
+ABCD
+@HWI-ST0787:114:D0PMDACXX:8:1101:1605:2155 1:Y:0:TAGCTT
+NNNN
++
+####
+@HWI-ST0787:114:D0PMDACXX:8:1101:1605:2156 1:N:0:TAGCTT
+AAGN
++
+CDEF
+@HWI-ST0787:114:D0PMDACXX:8:1101:1605:2157 1:N:0:TAGCTT
+TTTTT.
++
+EEEEEE
+"""
+
+
+class TestFastqSummary(TestCase):
+    def test_summarize_hiseq_fastq(self):
+        reads, pass_qc, mean, read_lengths = fastq.summarize_hiseq_fastq(
+            BytesIO(FASTQ))
+        self.assertEqual(reads, 4)
+        self.assertEqual(pass_qc, 3)
+        self.assertEqual(read_lengths, set([4, 6]))
+        expected = [(ord('A') + ord('C') + ord('E')) / 3.0,
+                    (ord('B') + ord('D') + ord('E')) / 3.0,
+                    (ord('C') + ord('E') + ord('E')) / 3.0,
+                    (ord('D') + ord('F') + ord('E')) / 3.0,
+                    ord('E'),
+                    ord('E')]
+        self.assertTrue(numpy.allclose(mean, expected))
+
+    def test_histogram_and_bases(self):
+        summary = fastq.summarize_fastq(BytesIO(FASTQ))
+        self.assertEqual(summary.cycles, 6)
+        # cycle 1 saw one each of A, C and E
+        first = summary.quality_histogram[0]
+        self.assertEqual(first.sum(), 3)
+        for c in 'ACE':
+            self.assertEqual(first[ord(c)], 1)
+        self.assertEqual(list(summary.quality_histogram.sum(axis=1)),
+                         [3, 3, 3, 3, 1, 1])
+
+        bases = dict(zip(fastq.BASES, summary.base_counts[3]))
+        self.assertEqual(bases, {'A': 0, 'C': 0, 'G': 0, 'T': 2, 'N': 1})
+        # unrecognized bases are counted as N
+        self.assertEqual(summary.base_counts[5][fastq.BASES.index('N')], 1)
+
+    def test_merge_blocks(self):
+        whole = fastq.summarize_fastq(BytesIO(FASTQ))
+        records = FASTQ.splitlines(True)
+        first = fastq.summarize_fastq(BytesIO(b''.join(records[:8])))
+        second = fastq.summarize_fastq(BytesIO(b''.join(records[8:])))
+        # the shorter summary has fewer cycles so merge in both orders
+        for merged in (first + second, second + first):
+            self.assertEqual(merged.reads, whole.reads)
+            self.assertEqual(merged.pass_qc, whole.pass_qc)
+            self.assertEqual(merged.read_lengths, whole.read_lengths)
+            self.assertTrue(numpy.array_equal(merged.quality_histogram,
+                                              whole.quality_histogram))
+            self.assertTrue(numpy.array_equal(merged.base_counts,
+                                              whole.base_counts))
+
+    def test_empty(self):
+        summary = fastq.summarize_fastq(BytesIO(b''))
+        self.assertEqual(summary.reads, 0)
+        self.assertEqual(summary.mean, None)
+
+    def test_dict_round_trip(self):
+        summary = fastq.summarize_fastq(BytesIO(FASTQ))
+        data = json.loads(json.dumps(summary.to_dict()))
+        self.assertEqual(data['quality_histogram'][4], {'E': 1})
+        copy = fastq.FastqSummary.from_dict(data)
+        self.assertEqual(copy.to_dict(), summary.to_dict())
+
+
+class TestFastqSummaryReport(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='fastq_summary_test')
+        project = os.path.join(self.tempdir, '42JUUAAXX', 'C1-38',
+                               'Project_11111')
+        os.makedirs(project)
+        self.filenames = []
+        for lane, split in [(1, 1), (1, 2), (2, 1)]:
+            filename = os.path.join(
+                project, '11111_AAGGCC_L00%d_R1_00%d.fastq.gz' % (lane, split))
+            with gzip.open(filename, 'wb') as stream:
+                stream.write(FASTQ)
+            self.filenames.append(filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_report(self):
+        fastqs = fastq.find_fastqs([self.tempdir])
+        self.assertEqual(len(fastqs), 3)
+        report = fastq.make_summary_report(fastqs, num_jobs=2)
+
+        self.assertEqual(len(report['files']), 3)
+        self.assertEqual(report['files'][self.filenames[0]]['reads'], 4)
+        self.assertEqual(report['lanes']['42JUUAAXX_1']['reads'], 8)
+        self.assertEqual(report['lanes']['42JUUAAXX_2']['reads'], 4)
+        self.assertEqual(report['samples']['11111_AAGGCC']['pass_qc'], 9)
+        self.assertEqual(report['libraries']['11111']['reads'], 12)
+
+    def test_bgzf_shards(self):
+        from htsworkflow.util.compression import open_compressed
+        pathname = os.path.join(self.tempdir, 'indexed.fastq.gz')
+        with open_compressed(pathname, '.bgzf') as stream:
+            stream.write(FASTQ * 5000)
+        whole = fastq.summarize_fastq_files([pathname])[pathname]
+        sharded = fastq.summarize_fastq_files([pathname], 3)[pathname]
+        self.assertEqual(sharded.to_dict(), whole.to_dict())
+        self.assertEqual(sharded.reads, 20000)
+
+    def test_sampled_report(self):
+        fastqs = fastq.find_fastqs([self.tempdir])
+        report = fastq.make_summary_report(fastqs, sample=2)
+        self.assertEqual(report['sample'], 2)
+        self.assertEqual(report['libraries']['11111']['reads'], 6)
+
+        reads, pass_qc, mean, read_lengths = fastq.summarize_hiseq_fastq(
+            BytesIO(FASTQ), sample=1.0)
+        self.assertEqual((reads, pass_qc), (4, 3))
+
+    def test_main(self):
+        output = os.path.join(self.tempdir, 'report.json')
+        fastq.main(['-o', output, '--sample', '4', self.filenames[0]])
+        with open(output) as stream:
+            report = json.load(stream)
+        self.assertEqual(list(report['files']), [self.filenames[0]])
+        self.assertEqual(report['lanes']['42JUUAAXX_1']['pass_qc'], 3)
+        self.assertEqual(report['sample'], 4)
+
+    def test_main_index(self):
+        from htsworkflow.util.fastqindex import load_sequence_index
+        output = os.path.join(self.tempdir, 'report.json')
+        fastq.main(['-o', output, '--index', self.tempdir])
+        for filename in self.filenames:
+            self.assertEqual(load_sequence_index(filename).reads, 4)
+
+
+def suite():
+    from unittest import TestSuite, defaultTestLoader
+    suite = TestSuite()
+    suite.addTests(defaultTestLoader.loadTestsFromTestCase(TestFastqSummary))
+    suite.addTests(
+        defaultTestLoader.loadTestsFromTestCase(TestFastqSummaryReport))
+    return suite
+
+
+if __name__ == "__main__":
+    from unittest import main
+    main(defaultTest="suite")
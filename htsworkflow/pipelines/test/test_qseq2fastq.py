@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+from io import BytesIO
+import os
+import shutil
+import tarfile
+import tempfile
+from unittest import TestCase
+
+from htsworkflow.pipelines import qseq2fastq
+
+QSEQ = b"""HWI-ST0787\t102\t1\t1101\t1224\t2112\t0\t1\tAG.T\tBCDh\t1
+HWI-ST0787\t102\t1\t1101\t1245\t2127\t0\t1\tTTTA\thhhB\t0
+"""
+
+
+class TestQseq2Fastq(TestCase):
+    def convert(self, source, split=False, **kwargs):
+        passed = BytesIO()
+        failed = BytesIO()
+        converter = qseq2fastq.Qseq2Fastq([BytesIO(source)], passed,
+                                          failed if split else None)
+        for key, value in kwargs.items():
+            setattr(converter, key, value)
+        converter.run()
+        return passed.getvalue().split(), failed.getvalue().split()
+
+    def test_fastq(self):
+        passed, failed = self.convert(QSEQ, flowcell_id='FC12')
+        self.assertEqual(passed, [
+            b'@FC12_HWI-ST0787_102:1:1101:1224:2112/1', b'AGNT',
+            b'+', b'#$%I',
+            b'@FC12_HWI-ST0787_102:1:1101:1245:2127/1', b'TTTA',
+            b'+', b'III#'])
+        self.assertEqual(failed, [])
+
+    def test_quality_matches_numpy(self):
+        quality = bytes(bytearray(range(64, 105)))
+        record = QSEQ.split(b'\n')[0].split(b'\t')
+        record[8] = b'A' * len(quality)
+        record[9] = quality
+        passed, failed = self.convert(b'\t'.join(record))
+        expected = qseq2fastq.convert_illumina_quality(
+            quality.decode('ascii')).tobytes()
+        self.assertEqual(passed[3], expected)
+
+    def test_nopass_split_and_pf(self):
+        passed, failed = self.convert(QSEQ, split=True, report_filter=True,
+                                      trim=slice(0, 2))
+        self.assertEqual(passed, [
+            b'@HWI-ST0787_102:1:1101:1224:2112/1', b'pf=1', b'AG',
+            b'+', b'#$'])
+        self.assertEqual(failed, [
+            b'@HWI-ST0787_102:1:1101:1245:2127/1', b'pf=0', b'TT',
+            b'+', b'II'])
+
+    def test_fasta(self):
+        passed, failed = self.convert(QSEQ, fastq=False)
+        self.assertEqual(passed, [
+            b'>HWI-ST0787_102:1:1101:1224:2112/1', b'AGNT',
+            b'>HWI-ST0787_102:1:1101:1245:2127/1', b'TTTA'])
+
+    def test_small_blocks(self):
+        lines = list(qseq2fastq.read_qseq_lines(BytesIO(QSEQ.rstrip()), 5))
+        lines = [line for block in lines for line in block]
+        self.assertEqual(lines, QSEQ.rstrip().split(b'\n'))
+
+
+class TestParallelQseq2Fastq(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='qseq2fastq_test')
+        self.filenames = []
+        for tile in range(1, 6):
+            filename = os.path.join(self.tempdir,
+                                    's_1_1_%04d_qseq.txt' % (tile,))
+            with open(filename, 'wb') as stream:
+                stream.write(QSEQ.replace(b'\t1101\t', b'\t%d\t' % tile))
+            self.filenames.append(filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def serial(self, sources, split):
+        passed = BytesIO()
+        failed = BytesIO() if split else None
+        converter = qseq2fastq.Qseq2Fastq(sources, passed, failed)
+        converter.report_filter = True
+        converter.run()
+        return passed.getvalue(), failed.getvalue() if split else None
+
+    def parallel(self, sources, split):
+        passed = BytesIO()
+        failed = BytesIO() if split else None
+        converter = qseq2fastq.ParallelQseq2Fastq(sources, passed, failed, 2)
+        converter.report_filter = True
+        converter.run()
+        return passed.getvalue(), failed.getvalue() if split else None
+
+    def test_files_in_order(self):
+        for split in (False, True):
+            streams = [open(f, 'rb') for f in self.filenames]
+            expected = self.serial(streams, split)
+            for stream in streams:
+                stream.close()
+            self.assertEqual(self.parallel(self.filenames, split), expected)
+
+    def test_tarfile(self):
+        tarname = os.path.join(self.tempdir, 'qseq.tar.bz2')
+        with tarfile.open(tarname, 'w:bz2') as archive:
+            for filename in self.filenames:
+                archive.add(filename, os.path.basename(filename))
+
+        members = list(qseq2fastq.threaded_tarfile_reader(tarname, 1))
+        self.assertEqual(len(members), len(self.filenames))
+        expected = self.serial(qseq2fastq.tarfile_generator(tarname), True)
+        self.assertEqual(self.parallel(members, True), expected)
+
+        expected = self.serial(qseq2fastq.tarfile_generator(tarname), False)
+        output = os.path.join(self.tempdir, 'out.fastq')
+        qseq2fastq.main(['-j', '2', '-i', tarname, '-o', output, '--pf'])
+        with open(output, 'rb') as stream:
+            self.assertEqual(stream.read(), expected[0])
+
+    def test_missing_tarfile(self):
+        reader = qseq2fastq.threaded_tarfile_reader(
+            os.path.join(self.tempdir, 'missing.tar'))
+        self.assertRaises(IOError, list, reader)
+
+
+def suite():
+    from unittest import TestSuite, defaultTestLoader
+    suite = TestSuite()
+    suite.addTests(defaultTestLoader.loadTestsFromTestCase(TestQseq2Fastq))
+    suite.addTests(
+        defaultTestLoader.loadTestsFromTestCase(TestParallelQseq2Fastq))
+    return suite
+
+
+if __name__ == "__main__":
+    from unittest import main
+    main(defaultTest="suite")
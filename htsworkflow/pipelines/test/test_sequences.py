@@ -529,6 +529,36 @@ class SequenceFileTests(TestCase):
         # a string
         self.assertRaises(ValueError, sequences.scan_for_sequences, '/tmp')
 
+    def test_scan_reports_missing_index(self):
+        import gzip
+        logging.disable(logging.NOTSET)
+        with SimulateHiSeqTree() as tree:
+            seqs = sequences.scan_for_sequences([tree.root])
+            indexed = seqs[0]
+            with gzip.open(indexed.path, 'wb') as stream:
+                stream.write(b'@read\nACGT\n+\nIIII\n')
+            self.assertEqual(indexed.load_index(), None)
+            index = indexed.load_index(create=True)
+            self.assertEqual(index.reads, 1)
+            self.assertEqual(index.read_length, 4)
+
+            with self.assertLogs(sequences.LOGGER, 'WARNING') as logs:
+                seqs = sequences.scan_for_sequences([tree.root])
+            self.assertEqual(len(seqs), 12)
+            # one summary instead of a warning per file
+            self.assertEqual(len(logs.output), 1)
+            self.assertIn('11 sequence files', logs.output[0])
+            self.assertEqual(indexed.load_index().to_dict(),
+                             index.to_dict())
+
+            for seq in seqs:
+                if seq.path != indexed.path:
+                    with gzip.open(seq.path, 'wb') as stream:
+                        stream.write(b'@read\nACGT\n+\nIIII\n')
+            sequences.scan_for_sequences([tree.root], create_index=True)
+            for seq in seqs:
+                self.assertEqual(seq.load_index().reads, 1)
+
 class SimulateTree(object):
     def __enter__(self):
         return self
@@ -602,6 +632,9 @@ class SimulateSimpleTree(SimulateTree):
             'woldlab_090622_HWI-EAS229_0120_42BW9AAXX_l3_r2_nopass.fastq.bz2',
             's_1_eland_extended.txt.bz2',
             's_1_eland_extended.txt.bz2.md5',
+            's_1_eland_extended.txt.bz2.summary.xml',
+            's_1_eland_extended.txt.bz2.sha256',
+            'woldlab_090622_HWI-EAS229_0120_42BW9AAXX_2.srf.sha256',
             ]
         for f in files:
             self.mkfile(fc, f)
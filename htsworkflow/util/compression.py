@@ -0,0 +1,485 @@
+"""
+Compress output streams using several threads.
+
+Both gzip and bzip2 allow a file to be a series of independently
+compressed members, so we can compress large blocks of the output
+at the same time and write the members out in order. zlib and bz2
+release the GIL while compressing so a thread pool is enough.
+"""
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import bz2
+import gzip
+import hashlib
+import io
+import logging
+import os
+import shutil
+import struct
+import tarfile
+import zlib
+
+LOGGER = logging.getLogger(__name__)
+
+BLOCK_SIZE = 4 * 1024 ** 2
+COMPRESSIONS = ('.gz', '.bz2')
+
+# BGZF is gzip made of small members that record their compressed size,
+# so a (compressed offset, uncompressed offset) "virtual offset" can be
+# seeked to. 0xff00 is the uncompressed block size samtools uses.
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_HEADER = struct.Struct('<4BIBBH2sHH')
+BGZF_EOF = bytes(bytearray([
+    0x1f, 0x8b, 0x08, 0x04, 0x00, 0x00, 0x00, 0x00, 0x00, 0xff, 0x06, 0x00,
+    0x42, 0x43, 0x02, 0x00, 0x1b, 0x00, 0x03, 0x00, 0x00, 0x00, 0x00, 0x00,
+    0x00, 0x00, 0x00, 0x00]))
+RECORD_INDEX_SUFFIX = '.fqidx'
+RECORD_INDEX_HEADER = '#htsworkflow record index'
+# checksums we can write sidecars for, named by their hashlib name
+CHECKSUMS = ('md5', 'sha256')
+# files are written under this suffix and renamed once they're complete
+PARTIAL_SUFFIX = '.partial'
+MANIFEST_SUFFIX = '.manifest'
+
+
+def compress_block(data, compression, level=9):
+    """Compress data into a single gzip or bzip2 member
+    """
+    if compression == '.gz':
+        # wbits=31 makes zlib write a gzip header with a zero mtime
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+    elif compression == '.bz2':
+        return bz2.compress(data, level)
+    else:
+        raise ValueError("Unrecognized compression %s" % (compression,))
+
+
+def compress_bgzf_block(data, level=6):
+    """Compress at most BGZF_BLOCK_SIZE bytes into one BGZF block
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    # BSIZE is the size of the whole block minus 1
+    header = BGZF_HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, b'BC', 2,
+                              len(compressed) + BGZF_HEADER.size + 7)
+    return header + compressed + struct.pack(
+        '<II', zlib.crc32(data) & 0xffffffff, len(data))
+
+
+def compress_bgzf_blocks(chunks, level=6):
+    """Compress a list of chunks into a list of BGZF blocks
+    """
+    return [compress_bgzf_block(chunk, level) for chunk in chunks]
+
+
+class ParallelCompressor(io.BufferedIOBase):
+    """Write-only stream that compresses blocks on a thread pool
+
+    The compressed members are written to stream in the same order as
+    the data was written to us. Several compressors can share one
+    executor to limit the total number of compressing threads.
+    """
+    def __init__(self, stream, compression='.gz', threads=2, level=9,
+                 block_size=BLOCK_SIZE, closefd=True, executor=None):
+        super(ParallelCompressor, self).__init__()
+        if compression not in COMPRESSIONS:
+            raise ValueError(
+                "Unrecognized compression %s" % (compression,))
+        self.stream = stream
+        self.compression = compression
+        self.level = level
+        self.block_size = block_size
+        self.closefd = closefd
+        self._own_executor = executor is None
+        if executor is None:
+            executor = ThreadPoolExecutor(max(threads, 1))
+        self._executor = executor
+        # bound how many compressed blocks can be waiting to be written
+        self._max_pending = max(threads, 1) * 2
+        self._pending = deque()
+        self._pieces = []
+        self._buffered = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed file")
+        data = bytes(data)
+        self._pieces.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.block_size:
+            self._submit()
+        return len(data)
+
+    def _submit(self):
+        """Queue what we've buffered to be compressed
+
+        Large writes are split into block_size pieces so they can be
+        compressed in parallel too.
+        """
+        data = b''.join(self._pieces)
+        self._pieces = []
+        self._buffered = 0
+        for start in range(0, len(data), self.block_size):
+            block = data[start:start + self.block_size]
+            self._pending.append(self._executor.submit(
+                compress_block, block, self.compression, self.level))
+            while len(self._pending) > self._max_pending:
+                self._write_next()
+
+    def _write_next(self):
+        self.stream.write(self._pending.popleft().result())
+
+    def flush(self):
+        """Compress and write everything we've been given so far
+        """
+        if self.closed:
+            return
+        if self._buffered > 0:
+            self._submit()
+        while len(self._pending) > 0:
+            self._write_next()
+        self.stream.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            # IOBase.close flushes us before marking us closed
+            super(ParallelCompressor, self).close()
+        finally:
+            if self._own_executor:
+                self._executor.shutdown()
+            if self.closefd:
+                self.stream.close()
+
+
+class HashingWriter(object):
+    """Compute checksums of everything written through us to stream
+    """
+    def __init__(self, stream, checksums=('md5',)):
+        for name in checksums:
+            if name not in CHECKSUMS:
+                raise ValueError("Unrecognized checksum %s" % (name,))
+        self.stream = stream
+        self.hashes = OrderedDict((name, hashlib.new(name))
+                                  for name in checksums)
+        self.size = 0
+        self.closed = False
+
+    def write(self, data):
+        for digest in self.hashes.values():
+            digest.update(data)
+        self.size += len(data)
+        return self.stream.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.stream.close()
+
+    def hexdigests(self):
+        return OrderedDict((name, digest.hexdigest())
+                           for name, digest in self.hashes.items())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def write_checksums(pathname, digests):
+    """Write <pathname>.<checksum> sidecars in md5sum's format
+    """
+    for name, digest in digests.items():
+        sidecar = pathname + '.' + name
+        with open(sidecar + PARTIAL_SUFFIX, 'w') as stream:
+            stream.write('%s  %s\n' % (digest, pathname))
+        os.rename(sidecar + PARTIAL_SUFFIX, sidecar)
+
+
+def has_checksums(pathname, checksums=('md5',)):
+    """Are there checksum sidecars at least as new as pathname?
+    """
+    mtime = os.path.getmtime(pathname)
+    for name in checksums:
+        sidecar = pathname + '.' + name
+        if not os.path.exists(sidecar) or os.path.getmtime(sidecar) < mtime:
+            return False
+    return True
+
+
+def compress_file(source, dest, compression='.bz2', threads=1, level=9,
+                  checksums=('md5',), executor=None, block_size=BLOCK_SIZE):
+    """Compress source into dest and write checksum sidecars for dest
+
+    The checksums are computed as the compressed data is written so
+    dest never has to be read back. dest only appears once it's
+    complete. Returns the hex digests.
+    """
+    hashing = HashingWriter(open(dest + PARTIAL_SUFFIX, 'wb'), checksums)
+    with ParallelCompressor(hashing, compression, threads, level,
+                            block_size, executor=executor) as writer:
+        with open(source, 'rb') as stream:
+            for block in iter(lambda: stream.read(block_size), b''):
+                writer.write(block)
+    os.rename(dest + PARTIAL_SUFFIX, dest)
+    digests = hashing.hexdigests()
+    write_checksums(dest, digests)
+    return digests
+
+
+def copy_file(source, dest, checksums=('md5',), block_size=BLOCK_SIZE):
+    """Copy source to dest and write checksum sidecars for dest
+    """
+    with HashingWriter(open(dest + PARTIAL_SUFFIX, 'wb'),
+                       checksums) as hashing:
+        with open(source, 'rb') as stream:
+            shutil.copyfileobj(stream, hashing, block_size)
+    shutil.copymode(source, dest + PARTIAL_SUFFIX)
+    os.rename(dest + PARTIAL_SUFFIX, dest)
+    digests = hashing.hexdigests()
+    write_checksums(dest, digests)
+    return digests
+
+
+def checksum_file(pathname, checksums=('md5',), block_size=BLOCK_SIZE):
+    """Write checksum sidecars for a file something else wrote
+    """
+    hashes = OrderedDict((name, hashlib.new(name)) for name in checksums)
+    with open(pathname, 'rb') as stream:
+        for block in iter(lambda: stream.read(block_size), b''):
+            for digest in hashes.values():
+                digest.update(block)
+    digests = OrderedDict((name, digest.hexdigest())
+                          for name, digest in hashes.items())
+    write_checksums(pathname, digests)
+    return digests
+
+
+def write_tar(dest, directory, names, compression='.bz2', threads=1,
+              level=9, checksums=('md5',), executor=None):
+    """Stream the files names in directory into a compressed tar file
+
+    Members are added in sorted order and the tar stream is compressed
+    a block at a time, so memory use doesn't depend on the number or
+    size of the files. Next to dest we write checksum sidecars and a
+    <dest>.manifest listing the name and size of each member, which is
+    also returned as a list of (name, size).
+    """
+    manifest = []
+    hashing = HashingWriter(open(dest + PARTIAL_SUFFIX, 'wb'), checksums)
+    with ParallelCompressor(hashing, compression, threads, level,
+                            executor=executor) as writer:
+        with tarfile.open(fileobj=writer, mode='w|') as archive:
+            for name in sorted(names):
+                pathname = os.path.join(directory, name)
+                archive.add(pathname, arcname=name, recursive=False)
+                manifest.append((name, os.path.getsize(pathname)))
+    os.rename(dest + PARTIAL_SUFFIX, dest)
+    write_checksums(dest, hashing.hexdigests())
+
+    with open(dest + MANIFEST_SUFFIX + PARTIAL_SUFFIX, 'w') as stream:
+        for name, size in manifest:
+            stream.write('%s\t%d\n' % (name, size))
+    os.rename(dest + MANIFEST_SUFFIX + PARTIAL_SUFFIX, dest + MANIFEST_SUFFIX)
+    return manifest
+
+
+class BgzfWriter(ParallelCompressor):
+    """Write-only stream producing BGZF (blocked gzip) output
+
+    If index is a filename, a record index is written to it when we're
+    closed, listing the record number and virtual offset of the first
+    record starting in each block. Records are lines_per_record lines
+    long (4 for fastq, 2 for fasta).
+    """
+    def __init__(self, stream, threads=1, level=6, index=None,
+                 lines_per_record=4, closefd=True):
+        super(BgzfWriter, self).__init__(
+            stream, '.gz', threads, level, BGZF_BLOCK_SIZE * 64, closefd)
+        self.index = index
+        self.lines_per_record = lines_per_record
+        self.entries = []
+        self._lines = 0
+        self._at_line_start = True
+        self._compressed_offset = 0
+
+    def _find_record_start(self, chunk):
+        """Return (record number, offset) of the first record in chunk
+
+        or None if no record starts in chunk.
+        """
+        # the first line that starts in this chunk and where it starts
+        if self._at_line_start:
+            line, offset = self._lines, 0
+        else:
+            offset = chunk.find(b'\n') + 1
+            if offset == 0:
+                return None
+            line = self._lines + 1
+        while line % self.lines_per_record != 0:
+            offset = chunk.find(b'\n', offset) + 1
+            if offset == 0:
+                return None
+            line += 1
+        if offset >= len(chunk):
+            return None
+        return line // self.lines_per_record, offset
+
+    def _submit(self):
+        """Split what we've buffered into BGZF blocks to be compressed
+        """
+        data = b''.join(self._pieces)
+        self._pieces = []
+        self._buffered = 0
+        chunks = []
+        starts = []
+        for start in range(0, len(data), BGZF_BLOCK_SIZE):
+            chunk = data[start:start + BGZF_BLOCK_SIZE]
+            chunks.append(chunk)
+            starts.append(self._find_record_start(chunk))
+            self._lines += chunk.count(b'\n')
+            self._at_line_start = chunk.endswith(b'\n')
+        if len(chunks) == 0:
+            return
+        future = self._executor.submit(compress_bgzf_blocks, chunks,
+                                       self.level)
+        self._pending.append((future, starts))
+        while len(self._pending) > self._max_pending:
+            self._write_next()
+
+    def _write_next(self):
+        future, starts = self._pending.popleft()
+        for block, start in zip(future.result(), starts):
+            if start is not None:
+                record, offset = start
+                self.entries.append(
+                    (record, (self._compressed_offset << 16) | offset))
+            self.stream.write(block)
+            self._compressed_offset += len(block)
+
+    @property
+    def records(self):
+        """Number of records written so far
+        """
+        lines = self._lines + (0 if self._at_line_start else 1)
+        return -(-lines // self.lines_per_record)
+
+    def close(self):
+        if self.closed:
+            return
+        self.flush()
+        self.stream.write(BGZF_EOF)
+        self.stream.flush()
+        super(BgzfWriter, self).close()
+        if self.index is not None:
+            # after the stream is closed, so we see its final size and mtime
+            source = getattr(self.stream, 'name', None)
+            if not isinstance(source, str):
+                source = None
+            save_record_index(self.index, self.entries, self.records,
+                              self.lines_per_record, source)
+
+
+def save_record_index(pathname, entries, records, lines_per_record=4,
+                      source=None):
+    """Write a record index of (record, virtual offset) entries
+
+    If source is the filename of the indexed file, its size and mtime
+    are recorded so record_index_is_current can spot a stale index.
+    """
+    temp_pathname = pathname + '.tmp'
+    with open(temp_pathname, 'w') as outstream:
+        outstream.write(RECORD_INDEX_HEADER + os.linesep)
+        outstream.write('#lines_per_record\t%d%s' % (
+            lines_per_record, os.linesep))
+        outstream.write('#records\t%d%s' % (records, os.linesep))
+        if source is not None:
+            stat = os.stat(source)
+            outstream.write('#source_size\t%d%s' % (
+                stat.st_size, os.linesep))
+            outstream.write('#source_mtime\t%d%s' % (
+                int(stat.st_mtime), os.linesep))
+        for record, offset in entries:
+            outstream.write('%d\t%d%s' % (record, offset, os.linesep))
+    os.rename(temp_pathname, pathname)
+
+
+def load_record_index(pathname):
+    """Read a record index written by save_record_index
+
+    Returns (entries, records, lines_per_record)
+    """
+    entries, settings = _read_record_index(pathname)
+    return entries, settings['records'], settings['lines_per_record']
+
+
+def record_index_is_current(filename):
+    """Does filename have a record index made from its current contents?
+
+    Indexes that don't record their source's size and mtime, or whose
+    source was rewritten since, aren't current.
+    """
+    try:
+        stat = os.stat(filename)
+        entries, settings = _read_record_index(filename + RECORD_INDEX_SUFFIX)
+    except (OSError, IOError, ValueError):
+        return False
+    return settings.get('source_size') == stat.st_size and \
+        settings.get('source_mtime') == int(stat.st_mtime)
+
+
+def _read_record_index(pathname):
+    """Return the entries and settings dictionary of a record index
+    """
+    entries = []
+    settings = {}
+    with open(pathname, 'r') as instream:
+        header = instream.readline().rstrip()
+        if header != RECORD_INDEX_HEADER:
+            raise ValueError("%s is not a record index" % (pathname,))
+        for line in instream:
+            name, value = line.rstrip().split('\t')
+            if name.startswith('#'):
+                settings[name[1:]] = int(value)
+            else:
+                entries.append((int(name), int(value)))
+    return entries, settings
+
+
+def open_compressed(filename, compression=None, threads=1, mode='wb',
+                    lines_per_record=4, executor=None):
+    """Open filename for writing with compression using threads
+
+    compression is one of '.gz', '.bz2', '.bgzf' or None for no
+    compression. BGZF output also gets a record index sidecar.
+    gzip and bzip2 writers compress on executor if one is given.
+    """
+    if compression == '.bgzf':
+        writer = BgzfWriter(open(filename, 'wb'), threads,
+                            index=filename + RECORD_INDEX_SUFFIX,
+                            lines_per_record=lines_per_record)
+        if 'b' in mode:
+            return writer
+        return io.TextIOWrapper(writer)
+    elif compression is None:
+        return open(filename, mode)
+    elif threads <= 1:
+        if compression == '.gz':
+            return gzip.open(filename, mode)
+        else:
+            return bz2.open(filename, mode)
+
+    writer = ParallelCompressor(open(filename, 'wb'), compression, threads,
+                                executor=executor)
+    if 'b' in mode:
+        return writer
+    return io.TextIOWrapper(writer)
@@ -43,3 +43,16 @@ def parse_slice(slice_text):
     return slice(*slice_data)
 
 
+def parse_sample(sample_text):
+    """Parse a --sample option
+
+    Values with a decimal point or ending in % are a fraction of the
+    records, anything else is a number of records.
+    """
+    if sample_text is None or len(sample_text) == 0:
+        return None
+    if sample_text.endswith('%'):
+        return float(sample_text[:-1]) / 100
+    elif '.' in sample_text:
+        return float(sample_text)
+    return int(sample_text)
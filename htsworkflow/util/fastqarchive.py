@@ -0,0 +1,432 @@
+"""
+Compact archive format for fastq files.
+
+Each block of records is split into separate streams that are each
+compressed with lzma:
+
+  * headers are split into text and number tokens, headers with the same
+    text as the previous header (e.g. the same flowcell) only store how
+    much each number (lane, tile, x, y) changed.
+  * bases are packed 2 bits each, anything other than A, C, G or T is
+    stored separately by position.
+  * qualities are optionally binned to Illumina's 8 levels.
+
+Everything except binned qualities round trips exactly. Use autoopen
+on a .fqa file to read it back as fastq.
+"""
+from __future__ import print_function
+
+import bz2
+import io
+import logging
+import lzma
+from optparse import OptionParser
+import os
+import re
+import struct
+import sys
+import time
+
+import numpy
+
+LOGGER = logging.getLogger(__name__)
+
+MAGIC = b'HTSFQA\x01\n'
+ARCHIVE_SUFFIX = '.fqa'
+BLOCK_SIZE = 16 * 1024 ** 2
+BLOCK_HEADER = struct.Struct('<II')
+STREAM_HEADER = struct.Struct('<I')
+STREAMS = ('flags', 'literals', 'changes', 'numbers', 'lengths', 'bases',
+           'exception_positions', 'exception_bases', 'qualities', 'plus')
+BINNED = 1
+
+NUMBER_RE = re.compile(br'(\d+)')
+# int64 deltas need to stay well clear of overflowing
+MAX_DIGITS = 18
+
+BASES = b'ACGT'
+OTHER_BASE = 4
+BASE_CODES = numpy.empty(256, dtype=numpy.uint8)
+BASE_CODES[:] = OTHER_BASE
+for _i, _base in enumerate(BASES):
+    BASE_CODES[_base] = _i
+BASE_VALUES = numpy.frombuffer(BASES, dtype=numpy.uint8)
+
+
+def _make_quality_bins(offset=33):
+    """Return a translate table binning qualities to Illumina's 8 levels
+    """
+    bins = [(0, 1, 0), (2, 9, 6), (10, 19, 15), (20, 24, 22),
+            (25, 29, 27), (30, 34, 33), (35, 39, 37), (40, 93, 40)]
+    table = bytearray(range(256))
+    for low, high, value in bins:
+        for q in range(low, high + 1):
+            if q + offset < 256:
+                table[q + offset] = value + offset
+    return bytes(table)
+
+QUALITY_BINS = _make_quality_bins()
+
+
+def _is_canonical(number):
+    """Will int(number) turn back into the same text?
+    """
+    return len(number) <= MAX_DIGITS and \
+        (number == b'0' or not number.startswith(b'0'))
+
+
+def _is_delta(token, previous):
+    """Can token be stored as a change from the previous number token?
+
+    Unchanged tokens are copied as is, so they keep any leading zeros.
+    """
+    return token == previous or \
+        (_is_canonical(token) and int(token) != _number(previous))
+
+
+def _number(token):
+    """Value of a previous number token to take a delta against
+    """
+    return int(token) if len(token) <= MAX_DIGITS else 0
+
+
+def encode_headers(headers):
+    """Tokenize headers against the previous header
+
+    Headers with the same number of tokens as the previous header are
+    stored as how much each number changed plus any text tokens that
+    are different, anything else is stored as a literal. A change of
+    zero means the number token is copied from the previous header.
+
+    Returns (flags, literals, changes, numbers), where flags is 0 for
+    literals or 1 plus the number of changed text tokens, changes holds
+    the index of each changed text token and literals holds both the
+    literal headers and changed text tokens.
+    """
+    flags = bytearray(len(headers))
+    literals = []
+    changes = bytearray()
+    numbers = []
+    previous = None
+    for i, header in enumerate(headers):
+        tokens = NUMBER_RE.split(header)
+        text = tokens[0::2]
+        values = tokens[1::2]
+        changed = []
+        if previous is not None and len(tokens) == len(previous):
+            changed = [j for j, token in enumerate(text)
+                       if token != previous[j * 2]]
+        if previous is not None and len(tokens) == len(previous) and \
+           len(text) < 255 and all(_is_delta(v, p) for v, p in
+                                   zip(values, previous[1::2])):
+            numbers.extend(int(v) - _number(p) if v != p else 0
+                           for v, p in zip(values, previous[1::2]))
+            flags[i] = len(changed) + 1
+            changes.extend(changed)
+            literals.extend(text[j] for j in changed)
+        else:
+            literals.append(header)
+        previous = tokens
+    return (bytes(flags), b'\n'.join(literals), bytes(changes),
+            numpy.array(numbers, dtype=numpy.int64).tobytes())
+
+
+def decode_headers(flags, literals, changes, numbers):
+    """Reverse encode_headers
+    """
+    literals = iter(literals.split(b'\n'))
+    changes = iter(bytearray(changes))
+    numbers = iter(numpy.frombuffer(numbers, dtype=numpy.int64).tolist())
+    headers = []
+    previous = None
+    for flag in bytearray(flags):
+        if flag:
+            tokens = list(previous)
+            for j in range(flag - 1):
+                tokens[next(changes) * 2] = next(literals)
+            for j in range(1, len(tokens), 2):
+                delta = next(numbers)
+                if delta != 0:
+                    tokens[j] = b'%d' % (_number(previous[j]) + delta,)
+            header = b''.join(tokens)
+        else:
+            header = next(literals)
+            tokens = NUMBER_RE.split(header)
+        headers.append(header)
+        previous = tokens
+    return headers
+
+
+def encode_bases(sequence):
+    """Pack a string of bases 2 bits per base
+
+    Returns (packed, exception positions, exception bases)
+    """
+    values = numpy.frombuffer(sequence, dtype=numpy.uint8)
+    codes = BASE_CODES[values]
+    others = codes == OTHER_BASE
+    positions = numpy.flatnonzero(others).astype(numpy.uint32)
+    exceptions = values[others].tobytes()
+    codes[others] = 0
+    padding = -len(codes) % 4
+    if padding:
+        codes = numpy.concatenate([codes,
+                                   numpy.zeros(padding, dtype=numpy.uint8)])
+    codes = codes.reshape(-1, 4)
+    packed = (codes[:, 0] << 6) | (codes[:, 1] << 4) | \
+             (codes[:, 2] << 2) | codes[:, 3]
+    return packed.astype(numpy.uint8).tobytes(), positions.tobytes(), \
+        exceptions
+
+
+def decode_bases(packed, positions, exceptions, length):
+    """Reverse encode_bases
+    """
+    packed = numpy.frombuffer(packed, dtype=numpy.uint8)
+    codes = numpy.empty((len(packed), 4), dtype=numpy.uint8)
+    codes[:, 0] = packed >> 6
+    codes[:, 1] = (packed >> 4) & 3
+    codes[:, 2] = (packed >> 2) & 3
+    codes[:, 3] = packed & 3
+    values = BASE_VALUES[codes.ravel()[:length]]
+    positions = numpy.frombuffer(positions, dtype=numpy.uint32)
+    values[positions] = numpy.frombuffer(exceptions, dtype=numpy.uint8)
+    return values.tobytes()
+
+
+def _split(data, lengths):
+    """Split data into pieces of lengths
+    """
+    ends = numpy.cumsum(lengths).tolist()
+    starts = [0] + ends[:-1]
+    return [data[start:end] for start, end in zip(starts, ends)]
+
+
+def encode_block(lines, bin_qualities=True):
+    """Encode a list of fastq lines (as from read_fastq_batches)
+    """
+    if len(lines) % 4 != 0:
+        raise ValueError("Incomplete fastq record")
+    headers = lines[0::4]
+    sequences = lines[1::4]
+    plus = lines[2::4]
+    qualities = lines[3::4]
+
+    lengths = list(map(len, sequences))
+    if lengths != list(map(len, qualities)):
+        raise ValueError("Sequence and quality lengths differ")
+    quality = b''.join(qualities)
+    if bin_qualities:
+        quality = quality.translate(QUALITY_BINS)
+
+    flags, literals, changes, numbers = encode_headers(headers)
+    packed, positions, exceptions = encode_bases(b''.join(sequences))
+    streams = [flags, literals, changes, numbers,
+               numpy.array(lengths, dtype=numpy.uint32).tobytes(),
+               packed, positions, exceptions, quality,
+               b'\n'.join([line[1:] for line in plus])]
+
+    block = [BLOCK_HEADER.pack(len(headers), BINNED if bin_qualities else 0)]
+    for stream in streams:
+        if len(stream) > 0:
+            stream = lzma.compress(stream)
+        block.append(STREAM_HEADER.pack(len(stream)))
+        block.append(stream)
+    return b''.join(block)
+
+
+def read_block(instream):
+    """Read and decode the next block, returning a list of fastq lines
+
+    Returns None at the end of the archive.
+    """
+    header = instream.read(BLOCK_HEADER.size)
+    if len(header) == 0:
+        return None
+    elif len(header) != BLOCK_HEADER.size:
+        raise ValueError("Truncated fastq archive")
+    records, flags = BLOCK_HEADER.unpack(header)
+
+    streams = {}
+    for name in STREAMS:
+        size = STREAM_HEADER.unpack(instream.read(STREAM_HEADER.size))[0]
+        data = instream.read(size)
+        if len(data) != size:
+            raise ValueError("Truncated fastq archive")
+        streams[name] = lzma.decompress(data) if size > 0 else b''
+
+    headers = decode_headers(streams['flags'], streams['literals'],
+                             streams['changes'], streams['numbers'])
+    lengths = numpy.frombuffer(streams['lengths'], dtype=numpy.uint32)
+    sequence = decode_bases(streams['bases'],
+                            streams['exception_positions'],
+                            streams['exception_bases'],
+                            int(lengths.sum()))
+    plus = [b'+' + line for line in streams['plus'].split(b'\n')]
+
+    lines = [None] * (records * 4)
+    lines[0::4] = headers
+    lines[1::4] = _split(sequence, lengths)
+    lines[2::4] = plus
+    lines[3::4] = _split(streams['qualities'], lengths)
+    return lines
+
+
+def encode_fastq(instream, outstream, bin_qualities=True,
+                 block_size=BLOCK_SIZE):
+    """Encode a fastq stream into an archive stream
+
+    Returns the number of records written.
+    """
+    from htsworkflow.util.fastqio import read_fastq_batches
+
+    records = 0
+    outstream.write(MAGIC)
+    for lines in read_fastq_batches(instream, block_size):
+        outstream.write(encode_block(lines, bin_qualities))
+        records += len(lines) // 4
+    return records
+
+
+class FastqArchiveReader(io.BufferedIOBase):
+    """Read an archive stream back as fastq
+    """
+    def __init__(self, stream):
+        super(FastqArchiveReader, self).__init__()
+        self.stream = stream
+        if stream.read(len(MAGIC)) != MAGIC:
+            raise ValueError("Not a fastq archive")
+        # the decoded block we're reading from and how far into it we are
+        self._block = b''
+        self._offset = 0
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        """Decode the next block once the current one is used up
+
+        Returns False at the end of the archive.
+        """
+        while self._offset == len(self._block):
+            if self._eof:
+                return False
+            lines = read_block(self.stream)
+            if lines is None:
+                self._eof = True
+                self._block = b''
+            else:
+                self._block = b'\n'.join(lines) + b'\n'
+            self._offset = 0
+        return True
+
+    def read(self, size=-1):
+        pieces = []
+        if size is None or size < 0:
+            while self._fill():
+                pieces.append(self._block[self._offset:])
+                self._offset = len(self._block)
+            return b''.join(pieces)
+
+        while size > 0 and self._fill():
+            piece = self._block[self._offset:self._offset + size]
+            self._offset += len(piece)
+            size -= len(piece)
+            pieces.append(piece)
+        return b''.join(pieces)
+
+    def read1(self, size=-1):
+        if not self._fill():
+            return b''
+        if size is None or size < 0:
+            size = len(self._block) - self._offset
+        data = self._block[self._offset:self._offset + size]
+        self._offset += len(data)
+        return data
+
+    def peek(self, size=0):
+        if not self._fill():
+            return b''
+        return self._block[self._offset:]
+
+    def close(self):
+        if not self.closed:
+            self.stream.close()
+        super(FastqArchiveReader, self).close()
+
+
+def open_archive(filename, mode='rb'):
+    """Open a fastq archive for reading as fastq
+    """
+    reader = FastqArchiveReader(open(filename, 'rb'))
+    if 'b' in mode:
+        return reader
+    return io.TextIOWrapper(reader)
+
+
+def benchmark(pathname, bin_qualities=True):
+    """Compare our archive format to bzip2 -9 on a fastq file
+
+    Returns a list of (name, compressed size, seconds to decode)
+    """
+    from htsworkflow.util.opener import autoopen
+
+    with autoopen(pathname, 'rb') as instream:
+        data = instream.read()
+
+    archive = io.BytesIO()
+    encode_fastq(io.BytesIO(data), archive, bin_qualities)
+    archive = archive.getvalue()
+    start = time.time()
+    FastqArchiveReader(io.BytesIO(archive)).read()
+    archive_seconds = time.time() - start
+
+    compressed = bz2.compress(data, 9)
+    start = time.time()
+    bz2.decompress(compressed)
+    bzip2_seconds = time.time() - start
+
+    return [('fastq', len(data), 0.0),
+            ('bzip2 -9', len(compressed), bzip2_seconds),
+            ('fqa', len(archive), archive_seconds)]
+
+
+def make_parser():
+    parser = OptionParser("""%prog: [options] encode <fastq> <archive>
+       %prog: [options] decode <archive> <fastq>
+       %prog: [options] benchmark <fastq>+""")
+    parser.add_option('--lossless', default=False, action='store_true',
+                      help="don't bin quality scores")
+    return parser
+
+
+def main(cmdline=None):
+    parser = make_parser()
+    opts, args = parser.parse_args(cmdline)
+    from htsworkflow.util.opener import autoopen
+
+    if len(args) == 3 and args[0] == 'encode':
+        with autoopen(args[1], 'rb') as instream:
+            with open(args[2], 'wb') as outstream:
+                encode_fastq(instream, outstream, not opts.lossless)
+    elif len(args) == 3 and args[0] == 'decode':
+        with open_archive(args[1]) as instream:
+            with open(args[2], 'wb') as outstream:
+                while True:
+                    block = instream.read1()
+                    if len(block) == 0:
+                        break
+                    outstream.write(block)
+    elif len(args) > 1 and args[0] == 'benchmark':
+        for pathname in args[1:]:
+            for name, size, seconds in benchmark(pathname, not opts.lossless):
+                print('%s %s: %d bytes, decoded in %0.2fs' % (
+                    pathname, name, size, seconds))
+    else:
+        parser.error("Please specify encode, decode or benchmark")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,250 @@
+"""
+Small sidecar index of the things people keep opening fastqs to learn
+
+The index is saved next to the fastq as <name>.seqidx and holds the
+read count, the set of read lengths, how many reads passed filter, and
+the decompressed size and md5. The size and mtime of the fastq are
+recorded too so an index left behind by an older file is ignored.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+
+from htsworkflow.util.fastqio import read_fastq_batches
+from htsworkflow.util.opener import autoopen
+
+LOGGER = logging.getLogger(__name__)
+
+SEQUENCE_INDEX_SUFFIX = '.seqidx'
+BLOCK_SIZE = 4 * 1024 ** 2
+# HiSeq headers look like
+# @HWI-ST0787:114:D0PMDACXX:8:1101:1605:2154 1:N:0:TAGCTT
+# where :Y: marks a read that failed filter
+FAILED_FILTER_RE = re.compile(br' \d+:Y:')
+
+
+class SequenceIndex(object):
+    """Read count, read lengths, pass filter count, size and md5 of a fastq
+    """
+    def __init__(self):
+        self.reads = 0
+        self.pass_qc = 0
+        self.read_lengths = set()
+        self.size = 0
+        self.md5 = None
+        self.source_size = None
+        self.source_mtime = None
+
+    @property
+    def read_length(self):
+        """The read length if all reads are the same length, else None
+        """
+        if len(self.read_lengths) == 1:
+            return next(iter(self.read_lengths))
+        return None
+
+    def add_lines(self, lines, lines_per_record=4):
+        """Count a batch of fastq lines from read_fastq_batches
+        """
+        headers = lines[0::lines_per_record]
+        self.reads += len(headers)
+        self.pass_qc += len(headers) - len(
+            FAILED_FILTER_RE.findall(b'\n'.join(headers)))
+        self.read_lengths.update(map(len, lines[1::lines_per_record]))
+
+    def is_current(self, pathname):
+        """Was this index made from the file currently at pathname?
+        """
+        try:
+            stat = os.stat(pathname)
+        except OSError:
+            return False
+        return self.source_size == stat.st_size and \
+            self.source_mtime == int(stat.st_mtime)
+
+    def set_source(self, pathname):
+        """Remember which version of pathname this index describes
+        """
+        stat = os.stat(pathname)
+        self.source_size = stat.st_size
+        self.source_mtime = int(stat.st_mtime)
+
+    def to_dict(self):
+        return {
+            'reads': self.reads,
+            'pass_qc': self.pass_qc,
+            'read_lengths': sorted(self.read_lengths),
+            'size': self.size,
+            'md5': self.md5,
+            'source_size': self.source_size,
+            'source_mtime': self.source_mtime,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        index = cls()
+        index.reads = data['reads']
+        index.pass_qc = data['pass_qc']
+        index.read_lengths = set(data['read_lengths'])
+        index.size = data['size']
+        index.md5 = data['md5']
+        index.source_size = data.get('source_size')
+        index.source_mtime = data.get('source_mtime')
+        return index
+
+
+class HashingReader(object):
+    """Track the size and md5 of everything read from a stream
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.size = 0
+        self.md5 = hashlib.md5()
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.size += len(data)
+        self.md5.update(data)
+        return data
+
+
+class SequenceIndexBuilder(object):
+    """Build a SequenceIndex of uncompressed fastq data written to us
+    """
+    def __init__(self, lines_per_record=4):
+        self.lines_per_record = lines_per_record
+        self.index = SequenceIndex()
+        self._md5 = hashlib.md5()
+        self._remainder = b''
+        self._pending = []
+
+    def write(self, data):
+        self._md5.update(data)
+        self.index.size += len(data)
+        lines = (self._remainder + data).split(b'\n')
+        self._remainder = lines.pop()
+        if self._pending:
+            lines = self._pending + lines
+        complete = len(lines) - len(lines) % self.lines_per_record
+        self._pending = lines[complete:]
+        del lines[complete:]
+        self.index.add_lines(lines, self.lines_per_record)
+        return len(data)
+
+    def finish(self):
+        """Count whatever is left and return the index
+        """
+        if len(self._remainder) > 0:
+            # the last line didn't end with a newline
+            self._pending.append(self._remainder)
+            self._remainder = b''
+        self.index.add_lines(self._pending, self.lines_per_record)
+        self._pending = []
+        self.index.md5 = self._md5.hexdigest()
+        return self.index
+
+
+class IndexingWriter(SequenceIndexBuilder):
+    """Build a SequenceIndex of the uncompressed fastq written through us
+
+    When closed the wrapped stream is closed and the index is saved for
+    pathname.
+    """
+    def __init__(self, stream, pathname, lines_per_record=4):
+        super(IndexingWriter, self).__init__(lines_per_record)
+        self.stream = stream
+        self.pathname = pathname
+        self.closed = False
+
+    def write(self, data):
+        self.stream.write(data)
+        return super(IndexingWriter, self).write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.stream.close()
+        index = self.finish()
+        index.set_source(self.pathname)
+        save_sequence_index(self.pathname, index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def make_sequence_index(pathname, lines_per_record=4):
+    """Read a (possibly compressed) fastq and build its SequenceIndex
+    """
+    index = SequenceIndex()
+    with autoopen(pathname, 'rb') as stream:
+        reader = HashingReader(stream)
+        for lines in read_fastq_batches(reader, BLOCK_SIZE):
+            index.add_lines(lines, lines_per_record)
+    index.size = reader.size
+    index.md5 = reader.md5.hexdigest()
+    index.set_source(pathname)
+    return index
+
+
+def sequence_index_name(pathname):
+    return pathname + SEQUENCE_INDEX_SUFFIX
+
+
+def has_sequence_index(pathname):
+    """Is there an up to date index for pathname?
+    """
+    return load_sequence_index(pathname) is not None
+
+
+def save_sequence_index(pathname, index):
+    """Save index next to pathname, replacing any old one
+    """
+    index_name = sequence_index_name(pathname)
+    temporary = index_name + '.tmp'
+    with open(temporary, 'w') as stream:
+        json.dump(index.to_dict(), stream, indent=1, sort_keys=True)
+    os.rename(temporary, index_name)
+
+
+def load_sequence_index(pathname):
+    """Return the SequenceIndex for pathname or None if it's missing or stale
+    """
+    index_name = sequence_index_name(pathname)
+    if not os.path.exists(index_name):
+        return None
+    try:
+        with open(index_name, 'r') as stream:
+            index = SequenceIndex.from_dict(json.load(stream))
+    except (ValueError, KeyError) as e:
+        LOGGER.warning("Unable to read %s: %s", index_name, str(e))
+        return None
+    if not index.is_current(pathname):
+        LOGGER.info("Ignoring out of date index %s", index_name)
+        return None
+    return index
+
+
+def get_sequence_index(pathname):
+    """Return the SequenceIndex for pathname, building it if needed
+
+    A newly built index is saved if we're allowed to write next to the
+    fastq.
+    """
+    index = load_sequence_index(pathname)
+    if index is None:
+        index = make_sequence_index(pathname)
+        try:
+            save_sequence_index(pathname, index)
+        except (IOError, OSError) as e:
+            LOGGER.warning("Unable to save index for %s: %s",
+                           pathname, str(e))
+    return index
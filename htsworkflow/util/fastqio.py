@@ -0,0 +1,291 @@
+"""
+Read and write fastq files a large block at a time.
+
+Fastq records are handed around as lists of lines (bytes without the
+line ending) where every four lines make up one record, so the headers
+of a batch are batch[0::4], the sequences batch[1::4] and so on.
+"""
+from __future__ import print_function
+
+import io
+import logging
+from optparse import OptionParser
+import os
+from six.moves import queue
+import sys
+import threading
+import time
+
+from htsworkflow.util.opener import autoopen
+
+LOGGER = logging.getLogger(__name__)
+
+BLOCK_SIZE = 1024 ** 2
+LINESEP = os.linesep.encode('ascii')
+
+
+def read_fastq_batches(stream, block_size=BLOCK_SIZE, allow_partial=False,
+                       lines_per_record=4):
+    """Yield lists of fastq lines read from stream in blocks
+
+    Each list holds a whole number of records. If the stream ends in
+    the middle of a record a ValueError is raised, unless allow_partial
+    is set, in which case the remaining lines are yielded as the last
+    batch. Set lines_per_record to batch other line oriented records,
+    e.g. 2 for fasta or 1 for eland.
+
+    Text streams are accepted and encoded to utf-8.
+    """
+    remainder = b''
+    pending = []
+    crlf = False
+    while True:
+        block = stream.read(block_size)
+        if len(block) == 0:
+            break
+        if isinstance(block, str):
+            block = block.encode('utf-8')
+        crlf = crlf or b'\r' in block
+        lines = (remainder + block).split(b'\n')
+        remainder = lines.pop()
+        if crlf:
+            lines = [line.rstrip(b'\r') for line in lines]
+        if pending:
+            lines = pending + lines
+        complete = len(lines) - len(lines) % lines_per_record
+        pending = lines[complete:]
+        if complete > 0:
+            del lines[complete:]
+            yield lines
+
+    if len(remainder) > 0:
+        # the last line didn't end with a newline
+        pending.append(remainder.rstrip(b'\r'))
+    if len(pending) > 0:
+        if len(pending) % lines_per_record != 0 and not allow_partial:
+            raise ValueError("Incomplete fastq record at end of stream")
+        yield pending
+
+
+def iter_fastq_records(stream, block_size=BLOCK_SIZE):
+    """Yield (header, sequence, quality header, quality) tuples from stream
+    """
+    for lines in read_fastq_batches(stream, block_size):
+        for record in zip(lines[0::4], lines[1::4], lines[2::4], lines[3::4]):
+            yield record
+
+
+class FastqWriter(object):
+    """Collect output into large buffers before writing it to a stream
+
+    Text streams are written to by decoding the buffered bytes.
+    """
+    def __init__(self, stream, buffer_size=BLOCK_SIZE):
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self._text = isinstance(stream, io.TextIOBase)
+        self._pieces = []
+        self._buffered = 0
+
+    def write(self, data):
+        """Buffer a bytes string
+        """
+        self._pieces.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def write_lines(self, lines):
+        """Buffer a list of lines, adding line endings
+        """
+        if len(lines) > 0:
+            self.write(LINESEP.join(lines) + LINESEP)
+
+    def write_records(self, headers, sequences, quality_headers, qualities):
+        """Buffer fastq records from parallel lists of their lines
+        """
+        lines = [None] * (len(headers) * 4)
+        lines[0::4] = headers
+        lines[1::4] = sequences
+        lines[2::4] = quality_headers
+        lines[3::4] = qualities
+        self.write_lines(lines)
+
+    def flush(self):
+        """Write everything we've buffered to our stream
+        """
+        if len(self._pieces) == 0:
+            return
+        data = b''.join(self._pieces)
+        self._pieces = []
+        self._buffered = 0
+        if self._text:
+            self.stream.write(data.decode('utf-8'))
+        else:
+            self.stream.write(data)
+
+    def close(self):
+        """Flush our buffer and close our stream
+        """
+        self.flush()
+        self.stream.close()
+
+
+class ThreadedReader(object):
+    """Read a stream into a bounded queue of blocks on a separate thread
+
+    This keeps a producer such as a subprocess pipe or a decompressor
+    running while we're busy with the data we've already read.
+    If process is given it's the Popen writing to stream, and is waited
+    for when we're closed.
+    """
+    def __init__(self, stream, block_size=BLOCK_SIZE, max_blocks=16,
+                 process=None):
+        self.stream = stream
+        self.block_size = block_size
+        self.process = process
+        self._blocks = queue.Queue(max_blocks)
+        self._buffer = b''
+        self._eof = False
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._fill)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        """Queue item, giving up if we're closed while the queue is full
+
+        Returns False if we gave up.
+        """
+        while not self._stopped.is_set():
+            try:
+                self._blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _fill(self):
+        try:
+            while not self._stopped.is_set():
+                block = self.stream.read(self.block_size)
+                if not self._put(block) or len(block) == 0:
+                    break
+        except Exception as e:
+            self._put(e)
+
+    def _next_block(self):
+        block = self._blocks.get()
+        if isinstance(block, Exception):
+            raise block
+        if len(block) == 0:
+            self._eof = True
+        return block
+
+    def read(self, size=-1):
+        """Read up to size bytes, or everything if size is negative
+        """
+        if len(self._buffer) == 0 and not self._eof and \
+           size == self.block_size:
+            # the common case of being read in the same sized blocks
+            return self._next_block()
+
+        pieces = [self._buffer]
+        available = len(self._buffer)
+        while not self._eof and (size < 0 or available < size):
+            block = self._next_block()
+            pieces.append(block)
+            available += len(block)
+        data = b''.join(pieces)
+        if size < 0:
+            self._buffer = b''
+            return data
+        self._buffer = data[size:]
+        return data[:size]
+
+    def close(self):
+        """Stop the reader thread, close the stream and wait for process
+
+        Blocks that weren't read are dropped so the thread isn't left
+        waiting for room in the queue.
+        """
+        self._stopped.set()
+        while True:
+            try:
+                self._blocks.get_nowait()
+            except queue.Empty:
+                break
+        self._thread.join()
+        self.stream.close()
+        if self.process is not None:
+            self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def copy_fastq_lines(instream, outstream):
+    """Copy a fastq file the way our tools used to, a line at a time.
+
+    Returns the number of records copied.
+    """
+    lines = 0
+    for line in instream:
+        outstream.write(line.rstrip())
+        outstream.write(os.linesep)
+        lines += 1
+    return lines // 4
+
+
+def copy_fastq_batches(instream, outstream):
+    """Copy a fastq file using read_fastq_batches and FastqWriter
+
+    Returns the number of records copied.
+    """
+    records = 0
+    writer = FastqWriter(outstream)
+    for lines in read_fastq_batches(instream, allow_partial=True):
+        writer.write_lines(lines)
+        records += len(lines) // 4
+    writer.flush()
+    return records
+
+
+def benchmark(pathname):
+    """Time copying pathname line by line and block by block
+
+    Returns a list of (method name, records, seconds) tuples.
+    """
+    timings = []
+    for name, mode, copier in [('lines', 't', copy_fastq_lines),
+                               ('batches', 'b', copy_fastq_batches)]:
+        start = time.time()
+        with autoopen(pathname, 'r' + mode) as instream:
+            with open(os.devnull, 'w' + mode) as outstream:
+                records = copier(instream, outstream)
+        timings.append((name, records, time.time() - start))
+    return timings
+
+
+def main(cmdline=None):
+    parser = OptionParser("%prog: --benchmark <fastq>+")
+    parser.add_option('--benchmark', default=False, action='store_true',
+                      help='report records/sec when copying each fastq')
+    opts, args = parser.parse_args(cmdline)
+
+    if not opts.benchmark:
+        parser.error("Nothing to do, did you want --benchmark?")
+
+    for pathname in args:
+        for name, records, seconds in benchmark(pathname):
+            print('%s %s: %d records in %0.2fs (%0.0f records/s)' % (
+                pathname, name, records, seconds,
+                records / max(seconds, 1e-9)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,118 @@
+"""Remember which tasks finished writing their outputs
+
+A journal is a file of json lines, one per finished task, recording
+the size and mtime of what the task read and the size (and md5 if
+there's a sidecar) of what it wrote. A task is done if it's in the
+journal, its sources haven't changed and its outputs are still there,
+anything else has to be redone.
+"""
+import json
+import logging
+import os
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+
+def stat_sources(sources):
+    """Return pathname to [size, mtime] for the sources that exist
+    """
+    stats = {}
+    for pathname in sources:
+        if os.path.exists(pathname):
+            info = os.stat(pathname)
+            stats[pathname] = [info.st_size, info.st_mtime]
+    return stats
+
+
+def read_md5(pathname):
+    """Return the digest from pathname's .md5 sidecar or None
+    """
+    sidecar = pathname + '.md5'
+    if not os.path.exists(sidecar):
+        return None
+    with open(sidecar) as stream:
+        return stream.read().split(' ')[0]
+
+
+class Journal(object):
+    """Append only record of the tasks finished for one output directory
+    """
+    def __init__(self, pathname):
+        self.pathname = pathname
+        self.entries = {}
+        self._lock = threading.Lock()
+        # start a new line after one that was cut off
+        self._separator = ''
+        if os.path.exists(pathname):
+            self.load()
+
+    def load(self):
+        with open(self.pathname) as stream:
+            for line in stream:
+                if not line.endswith('\n'):
+                    self._separator = '\n'
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # we died while writing the last line
+                    LOGGER.warning("Ignoring incomplete entry in %s",
+                                   self.pathname)
+                    continue
+                self.entries[entry['task']] = entry
+
+    def is_done(self, task, sources=()):
+        """Has task already written its outputs from these sources?
+        """
+        entry = self.entries.get(task)
+        if entry is None:
+            return False
+        if entry['sources'] != stat_sources(sources):
+            LOGGER.info("Sources of %s changed", task)
+            return False
+        directory = os.path.dirname(self.pathname)
+        for name, output in entry['outputs'].items():
+            pathname = os.path.join(directory, name)
+            if not os.path.exists(pathname) or \
+               os.path.getsize(pathname) != output['size']:
+                LOGGER.info("Output %s of %s is missing", name, task)
+                return False
+        return True
+
+    def record(self, task, sources=(), outputs=()):
+        """Note that task finished writing outputs
+        """
+        directory = os.path.dirname(self.pathname)
+        entry = {
+            'task': task,
+            'sources': stat_sources(sources),
+            'outputs': {},
+        }
+        for name in outputs:
+            pathname = os.path.join(directory, name)
+            if not os.path.exists(pathname):
+                # not every task always has something to write
+                continue
+            entry['outputs'][name] = {
+                'size': os.path.getsize(pathname),
+                'md5': read_md5(pathname),
+            }
+        line = json.dumps(entry, sort_keys=True) + '\n'
+        with self._lock:
+            with open(self.pathname, 'a') as stream:
+                stream.write(self._separator + line)
+                self._separator = ''
+                stream.flush()
+                os.fsync(stream.fileno())
+            self.entries[task] = entry
+
+    def run(self, task, sources, outputs, function, *args):
+        """Call function unless task is already done, then record it
+
+        outputs are names relative to the journal's directory.
+        """
+        if self.is_done(task, sources):
+            LOGGER.info("Skipping finished %s", task)
+            return
+        function(*args)
+        self.record(task, sources, outputs)
@@ -52,33 +52,47 @@ def make_bed_from_eland_generator(instream, name, description, chromosome_prefix
 
     :Return: generator which yields lines of bedfile
     """
+    yield create_bed_header(name, description)
+
+    for line in instream:
+        bed_line = make_bed_line(line.split(), chromosome_prefix)
+        if bed_line is not None:
+            yield bed_line
+
+
+def make_bed_line(fields, chromosome_prefix='chr'):
+    """
+    Convert the fields of an eland_result.txt line into a bed line
+
+    :Parameters:
+    - `fields`: whitespace split eland_result line
+    - `chromosome_prefix`: only convert fasta records that start with this pattern
+
+    :Return: bed line, or None if the read doesn't map to a chromosome
+    """
     # indexes into fields in eland_result.txt file
     SEQ = 1
     CHR = 6
     START = 7
     SENSE = 8
 
-    yield create_bed_header(name, description)
-    prefix_len = len(chromosome_prefix)
-
-    for line in instream:
-        fields = line.split()
-        # we need more than the CHR field, and it needs to match a chromosome
-        if len(fields) <= CHR or fields[CHR][:prefix_len] != chromosome_prefix:
-            continue
-        start = fields[START]
-        stop = int(start) + len(fields[SEQ])
-        # strip off filename extension
-        chromosome = fields[CHR].split('.')[0]
-
-        yield '%s %s %d read 0 %s - - %s%s' % (
-            chromosome,
-            start,
-            stop,
-            sense_map[fields[SENSE]],
-            sense_color[fields[SENSE]],
-            os.linesep
-        )
+    # we need more than the CHR field, and it needs to match a chromosome
+    if len(fields) <= CHR or \
+       fields[CHR][:len(chromosome_prefix)] != chromosome_prefix:
+        return None
+    start = fields[START]
+    stop = int(start) + len(fields[SEQ])
+    # strip off filename extension
+    chromosome = fields[CHR].split('.')[0]
+
+    return '%s %s %d read 0 %s - - %s%s' % (
+        chromosome,
+        start,
+        stop,
+        sense_map[fields[SENSE]],
+        sense_color[fields[SENSE]],
+        os.linesep
+    )
 
 
 def make_bed_from_multi_eland_stream(
@@ -1,6 +1,7 @@
 """
 Helpful utilities for turning random names/objects into streams.
 """
+from bisect import bisect_right
 import os
 import gzip
 import bz2
@@ -8,6 +9,9 @@ import six
 from six.moves import urllib
 import requests
 
+from htsworkflow.util.compression import load_record_index, \
+     record_index_is_current, RECORD_INDEX_SUFFIX
+
 if six.PY2:
     import types
     FILE_CLASS = types.FileType
@@ -73,5 +77,116 @@ def autoopen(file_ref, mode='r'):
         return gzip.open(file_ref, mode)
     elif os.path.splitext(file_ref)[1] == '.bz2':
         return bz2.BZ2File(file_ref, mode)
+    elif os.path.splitext(file_ref)[1] == '.fqa':
+        from htsworkflow.util.fastqarchive import open_archive
+        return open_archive(file_ref, mode)
     else:
         return open(file_ref, mode)
+
+
+class RecordRangeReader(object):
+    """Read from a decompressed BGZF stream, optionally stopping after
+    a number of lines.
+    """
+    def __init__(self, stream, raw, lines=None):
+        self.stream = stream
+        self.raw = raw
+        self._remaining = lines
+
+    def read(self, size=-1):
+        if self._remaining is None:
+            return self.stream.read(size)
+        elif self._remaining == 0:
+            return b''
+        elif size is None or size < 0:
+            # don't decompress the rest of the file to find our lines
+            return b''.join(iter(self.readline, b''))
+
+        block = self.stream.read(size)
+        count = block.count(b'\n')
+        if count < self._remaining:
+            self._remaining -= count
+            return block
+
+        end = -1
+        for i in range(self._remaining):
+            end = block.index(b'\n', end + 1)
+        self._remaining = 0
+        return block[:end + 1]
+
+    def readline(self):
+        if self._remaining == 0:
+            return b''
+        line = self.stream.readline()
+        if self._remaining is not None and len(line) > 0:
+            self._remaining -= 1
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def close(self):
+        self.stream.close()
+        self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def has_record_index(filename):
+    """Was filename written as BGZF with a record index?
+
+    An index left behind after filename was rewritten doesn't count.
+    """
+    return record_index_is_current(filename)
+
+
+def _load_current_record_index(filename):
+    if not record_index_is_current(filename):
+        raise ValueError("%s has no current record index" % (filename,))
+    return load_record_index(filename + RECORD_INDEX_SUFFIX)
+
+
+def open_record(filename, record, lines=None, index=None):
+    """Open a BGZF file with a record index starting at record
+
+    If lines is given, stop reading after that many lines.
+    index is the result of load_record_index, it will be loaded from
+    filename's sidecar if not provided, raising ValueError if that
+    index is missing or stale.
+    """
+    if index is None:
+        index = _load_current_record_index(filename)
+    entries, records, lines_per_record = index
+
+    # find the last indexed record at or before the one we want
+    position = bisect_right(entries, (record, float('inf'))) - 1
+    if position < 0:
+        first, virtual_offset = 0, 0
+    else:
+        first, virtual_offset = entries[position]
+
+    raw = open(filename, 'rb')
+    raw.seek(virtual_offset >> 16)
+    stream = gzip.GzipFile(fileobj=raw, mode='rb')
+    stream.read(virtual_offset & 0xffff)
+    for i in range((record - first) * lines_per_record):
+        stream.readline()
+    return RecordRangeReader(stream, raw, lines)
+
+
+def open_shard(filename, shard, shards, index=None):
+    """Open the records in shard (counting from 0) of shards of a BGZF file
+    """
+    if index is None:
+        index = _load_current_record_index(filename)
+    entries, records, lines_per_record = index
+    if shard < 0 or shard >= shards:
+        raise ValueError("shard must be between 0 and %d" % (shards - 1,))
+    start = records * shard // shards
+    end = records * (shard + 1) // shards
+    return open_record(filename, start, (end - start) * lines_per_record,
+                       index)
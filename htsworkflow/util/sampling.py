@@ -0,0 +1,212 @@
+"""
+Read a sample of the records in a large line oriented file
+
+A sample is either a fraction of the records (a float) or a fixed
+number of records (an int).
+
+Seekable files, uncompressed files or BGZF files with a record index,
+are sampled by reading runs of records from evenly spaced offsets.
+Anything else is read as a stream, keeping a reservoir of a fixed
+number of records or each record with probability fraction.
+"""
+import logging
+import os
+
+import numpy
+
+from htsworkflow.util.compression import load_record_index, \
+     RECORD_INDEX_SUFFIX
+from htsworkflow.util.fastqio import read_fastq_batches, BLOCK_SIZE
+from htsworkflow.util.opener import autoopen, has_record_index, open_record
+
+LOGGER = logging.getLogger(__name__)
+
+# how many places in a seekable file to read records from
+WINDOWS = 64
+# how much of the start of a file to read to guess the size of a record
+PROBE_SIZE = 1024 ** 2
+COMPRESSED_EXTENSIONS = ('.gz', '.bz2', '.fqa')
+
+
+def find_record_start(lines, lines_per_record=4):
+    """Return the index of the first line in lines that starts a record
+
+    lines is a list of complete lines from somewhere in the middle of a
+    file. Fastq records are recognized by an @ header followed by a +
+    line two lines later, with sequence and quality of the same length.
+    Returns None if no record start was found.
+    """
+    if lines_per_record != 4:
+        return 0
+    for i in range(len(lines) - 3):
+        if lines[i][:1] == b'@' and lines[i + 2][:1] == b'+' and \
+           len(lines[i + 1]) == len(lines[i + 3]):
+            return i
+    return None
+
+
+def sample_records(source, sample, lines_per_record=4, seed=None,
+                   block_size=BLOCK_SIZE):
+    """Yield lists of lines holding a sample of the records in source
+
+    source is a filename or a binary stream, sample is a fraction
+    (float) or number of records (int).
+    """
+    if sample is None:
+        raise ValueError("Please specify what to sample")
+    if isinstance(sample, float) and not 0 < sample <= 1:
+        raise ValueError("Sample fraction must be between 0 and 1")
+
+    if not isinstance(source, str):
+        return sample_stream(source, sample, lines_per_record, seed,
+                             block_size)
+    if has_record_index(source):
+        index = load_record_index(source + RECORD_INDEX_SUFFIX)
+        if index[2] == lines_per_record:
+            return sample_indexed(source, sample, index, seed, block_size)
+    if os.path.splitext(source)[1] not in COMPRESSED_EXTENSIONS:
+        return sample_seekable(source, sample, lines_per_record, seed,
+                               block_size)
+    return _sample_file_stream(source, sample, lines_per_record, seed,
+                               block_size)
+
+
+def _sample_file_stream(pathname, sample, lines_per_record, seed,
+                        block_size):
+    with autoopen(pathname, 'rb') as stream:
+        for lines in sample_stream(stream, sample, lines_per_record, seed,
+                                   block_size):
+            yield lines
+
+
+def _window_records(sample, records):
+    """How many records to read from each of up to WINDOWS windows
+
+    Returns (windows, records per window), or None if the sample is most
+    of the file and it should just be read.
+    """
+    if isinstance(sample, float):
+        sample = int(round(records * sample))
+    if sample * 2 >= records:
+        return None
+    windows = max(1, min(WINDOWS, sample))
+    return windows, -(-sample // windows)
+
+
+def sample_indexed(pathname, sample, index, seed=None,
+                   block_size=BLOCK_SIZE):
+    """Yield runs of records from evenly spaced records of a BGZF file
+    """
+    entries, records, lines_per_record = index
+    windows = _window_records(sample, records)
+    if windows is None:
+        return _sample_file_stream(pathname, sample, lines_per_record, seed,
+                                   block_size)
+    return _read_indexed_windows(pathname, index, windows[0], windows[1])
+
+
+def _read_indexed_windows(pathname, index, windows, per_window):
+    entries, records, lines_per_record = index
+    for i in range(windows):
+        start = records * i // windows
+        with open_record(pathname, start, per_window * lines_per_record,
+                         index) as stream:
+            lines = [line.rstrip(b'\r\n') for line in stream]
+        yield lines
+
+
+def sample_seekable(pathname, sample, lines_per_record=4, seed=None,
+                    block_size=BLOCK_SIZE):
+    """Yield runs of records read from evenly spaced offsets of pathname
+    """
+    size = os.path.getsize(pathname)
+    with open(pathname, 'rb') as stream:
+        probe = stream.read(PROBE_SIZE)
+    # the last line of the probe is probably incomplete
+    lines = probe.split(b'\n')[:-1] if len(probe) < size else \
+        probe.split(b'\n')
+    records = len(lines) // lines_per_record
+    if records == 0:
+        return _sample_file_stream(pathname, sample, lines_per_record, seed,
+                                   block_size)
+    record_size = float(sum(map(len, lines[:records * lines_per_record])) +
+                        records * lines_per_record) / records
+
+    windows = _window_records(sample, int(size / record_size))
+    if windows is None:
+        return _sample_file_stream(pathname, sample, lines_per_record, seed,
+                                   block_size)
+    return _read_windows(pathname, size, windows[0], windows[1],
+                         record_size, lines_per_record)
+
+
+def _read_windows(pathname, size, windows, per_window, record_size,
+                  lines_per_record):
+    # leave room to find the start of a record, but don't overlap windows
+    window_size = int((per_window + 2) * record_size)
+    with open(pathname, 'rb') as stream:
+        for i in range(windows):
+            offset = size * i // windows
+            stream.seek(offset)
+            lines = stream.read(window_size).split(b'\n')
+            if offset > 0:
+                # we probably started in the middle of a line
+                lines.pop(0)
+            if stream.tell() < size:
+                lines.pop()
+            lines = [line.rstrip(b'\r') for line in lines]
+            start = find_record_start(lines, lines_per_record)
+            if start is None:
+                LOGGER.debug("No record found at %d of %s", offset, pathname)
+                continue
+            lines = lines[start:start + per_window * lines_per_record]
+            del lines[len(lines) - len(lines) % lines_per_record:]
+            if len(lines) > 0:
+                yield lines
+
+
+def sample_stream(stream, sample, lines_per_record=4, seed=None,
+                  block_size=BLOCK_SIZE):
+    """Yield a sample of the records in a stream we can only read once
+
+    A fraction keeps each record with that probability, a number of
+    records is kept in a reservoir and yielded at the end.
+    """
+    random = numpy.random.RandomState(seed)
+    batches = read_fastq_batches(stream, block_size, allow_partial=True,
+                                 lines_per_record=lines_per_record)
+    if isinstance(sample, float):
+        for lines in batches:
+            keep = numpy.flatnonzero(
+                random.random_sample(len(lines) // lines_per_record) < sample)
+            sampled = []
+            for record in keep.tolist():
+                start = record * lines_per_record
+                sampled.extend(lines[start:start + lines_per_record])
+            if len(sampled) > 0:
+                yield sampled
+        return
+
+    reservoir = []
+    seen = 0
+    for lines in batches:
+        records = [lines[i:i + lines_per_record]
+                   for i in range(0, len(lines) - lines_per_record + 1,
+                                  lines_per_record)]
+        room = sample - len(reservoir)
+        if room > 0:
+            reservoir.extend(records[:room])
+            seen += len(records[:room])
+            records = records[room:]
+        if len(records) == 0:
+            continue
+        # record number seen + k + 1 replaces a random slot with
+        # probability sample / (seen + k + 1)
+        counts = numpy.arange(seen + 1, seen + len(records) + 1)
+        slots = (random.random_sample(len(records)) * counts).astype(int)
+        for k in numpy.flatnonzero(slots < sample).tolist():
+            reservoir[slots[k]] = records[k]
+        seen += len(records)
+
+    if len(reservoir) > 0:
+        yield [line for record in reservoir for line in record]
@@ -0,0 +1,138 @@
+"""Run a graph of dependent tasks on a limited number of threads
+
+Tasks are python callables, usually ones that wait on subprocesses or
+disk, so threads are enough to overlap them. A task only starts once
+everything it depends on has finished successfully, if one fails the
+tasks that depend on it are skipped and the first error is raised once
+everything else is done.
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+WAITING = 'waiting'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+class Task(object):
+    """A callable with the names of the tasks it has to wait for
+    """
+    def __init__(self, name, function, args=(), depends=(), step=None):
+        self.name = name
+        self.function = function
+        self.args = tuple(args)
+        self.depends = tuple(depends)
+        self.step = step if step is not None else name
+        self.state = WAITING
+        self.error = None
+        self.elapsed = None
+
+    def __repr__(self):
+        return '<Task %s %s>' % (self.name, self.state)
+
+
+class TaskGraph(object):
+    """Run tasks as soon as their dependencies are done
+
+    At most num_jobs tasks run at once. Tasks may add more tasks to
+    the graph while it is running.
+    """
+    def __init__(self, num_jobs=1):
+        self.num_jobs = max(num_jobs, 1)
+        self.tasks = OrderedDict()
+        self._running = 0
+        self._condition = threading.Condition()
+
+    def add(self, name, function, args=(), depends=(), step=None):
+        """Add a task, returning its name to use as a dependency
+
+        Dependencies have to already be in the graph, which keeps it
+        free of cycles.
+        """
+        with self._condition:
+            if name in self.tasks:
+                raise ValueError("Task %s was already added" % (name,))
+            for dependency in depends:
+                if dependency not in self.tasks:
+                    raise ValueError("%s depends on unknown task %s" % (
+                        name, dependency))
+            self.tasks[name] = Task(name, function, args, depends, step)
+            self._condition.notify_all()
+        return name
+
+    def _update_waiting(self):
+        """Skip tasks that can't run and return the ones that can
+        """
+        ready = []
+        for task in self.tasks.values():
+            if task.state != WAITING:
+                continue
+            states = [self.tasks[d].state for d in task.depends]
+            if FAILED in states or SKIPPED in states:
+                LOGGER.error("Skipping %s", task.name)
+                task.state = SKIPPED
+            elif all(state == DONE for state in states):
+                ready.append(task)
+        return ready
+
+    def _run_task(self, task):
+        LOGGER.debug("Starting %s", task.name)
+        start = time.time()
+        state = DONE
+        try:
+            task.function(*task.args)
+        except Exception as e:
+            LOGGER.exception("%s failed", task.name)
+            task.error = e
+            state = FAILED
+        elapsed = time.time() - start
+        LOGGER.info("%s finished in %.2f seconds", task.name, elapsed)
+        with self._condition:
+            task.elapsed = elapsed
+            task.state = state
+            self._running -= 1
+            self._condition.notify_all()
+
+    def run(self):
+        """Run everything that can be run
+        """
+        start = time.time()
+        with ThreadPoolExecutor(self.num_jobs) as executor:
+            with self._condition:
+                while True:
+                    ready = self._update_waiting()
+                    for task in ready[:self.num_jobs - self._running]:
+                        task.state = RUNNING
+                        self._running += 1
+                        executor.submit(self._run_task, task)
+                    if self._running == 0:
+                        break
+                    self._condition.wait()
+
+        for step, (count, elapsed) in self.step_timings().items():
+            LOGGER.info("%s: %d task(s) took %.2f seconds", step, count,
+                        elapsed)
+        LOGGER.info("Finished %d tasks in %.2f seconds",
+                    len(self.tasks), time.time() - start)
+
+        for task in self.tasks.values():
+            if task.error is not None:
+                raise task.error
+
+    def step_timings(self):
+        """Return step name to (tasks run, total seconds)
+        """
+        timings = OrderedDict()
+        for task in self.tasks.values():
+            if task.elapsed is None:
+                continue
+            count, elapsed = timings.get(task.step, (0, 0.0))
+            timings[task.step] = (count + 1, elapsed + task.elapsed)
+        return timings
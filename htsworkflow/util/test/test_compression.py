@@ -0,0 +1,164 @@
+import bz2
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import hashlib
+from io import BytesIO
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from htsworkflow.util.compression import compress_block, \
+     ParallelCompressor, open_compressed, BgzfWriter, BGZF_EOF, \
+     BGZF_BLOCK_SIZE, RECORD_INDEX_SUFFIX, load_record_index, \
+     compress_file, copy_file, checksum_file, has_checksums
+
+DATA = b''.join(b'@read%d\nAGCTAGCT\n+\nIIIIIIII\n' % (i,)
+                for i in range(5000))
+
+
+class TestCompression(TestCase):
+    def test_compress_block(self):
+        self.assertEqual(gzip.decompress(compress_block(DATA, '.gz')), DATA)
+        self.assertEqual(bz2.decompress(compress_block(DATA, '.bz2')), DATA)
+        self.assertRaises(ValueError, compress_block, DATA, '.zip')
+
+    def test_parallel_members_in_order(self):
+        for compression, module in [('.gz', gzip), ('.bz2', bz2)]:
+            raw = BytesIO()
+            writer = ParallelCompressor(raw, compression, threads=3,
+                                        block_size=1000, closefd=False)
+            # write in odd sized pieces so blocks don't line up with them
+            for i in range(0, len(DATA), 777):
+                writer.write(DATA[i:i+777])
+            writer.close()
+            self.assertTrue(writer.closed)
+            self.assertEqual(module.decompress(raw.getvalue()), DATA)
+
+    def test_write_after_close(self):
+        writer = ParallelCompressor(BytesIO(), '.gz')
+        writer.close()
+        self.assertRaises(ValueError, writer.write, b'data')
+
+    def test_open_compressed(self):
+        tempdir = tempfile.mkdtemp(prefix='compression_test')
+        try:
+            for compression, threads in [(None, 1), ('.gz', 1),
+                                         ('.gz', 2), ('.bz2', 2)]:
+                pathname = os.path.join(tempdir, 'out%s%d' % (
+                    compression, threads))
+                with open_compressed(pathname, compression, threads,
+                                     'wt') as stream:
+                    stream.write(DATA.decode('ascii'))
+                if compression == '.gz':
+                    stream = gzip.open(pathname, 'rb')
+                elif compression == '.bz2':
+                    stream = bz2.open(pathname, 'rb')
+                else:
+                    stream = open(pathname, 'rb')
+                with stream:
+                    self.assertEqual(stream.read(), DATA)
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_bgzf_blocks(self):
+        raw = BytesIO()
+        writer = BgzfWriter(raw, threads=2, closefd=False)
+        writer.write(DATA)
+        writer.close()
+        compressed = raw.getvalue()
+        self.assertTrue(compressed.endswith(BGZF_EOF))
+        self.assertEqual(gzip.decompress(compressed), DATA)
+
+        # walk the blocks using the sizes stored in their headers
+        offset = 0
+        blocks = 0
+        while offset < len(compressed):
+            self.assertEqual(compressed[offset + 12:offset + 14], b'BC')
+            size = compressed[offset + 16] + compressed[offset + 17] * 256
+            block = gzip.decompress(compressed[offset:offset + size + 1])
+            self.assertTrue(len(block) <= BGZF_BLOCK_SIZE)
+            offset += size + 1
+            blocks += 1
+        self.assertEqual(offset, len(compressed))
+        self.assertEqual(blocks, -(-len(DATA) // BGZF_BLOCK_SIZE) + 1)
+
+    def test_bgzf_record_index(self):
+        raw = BytesIO()
+        writer = BgzfWriter(raw, closefd=False)
+        # write in pieces so records span flushes and blocks
+        for i in range(0, len(DATA), 100000):
+            writer.write(DATA[i:i+100000])
+            writer.flush()
+        writer.close()
+        self.assertEqual(writer.records, 5000)
+        self.assertTrue(len(writer.entries) > 2)
+
+        compressed = raw.getvalue()
+        for record, virtual_offset in writer.entries:
+            stream = gzip.GzipFile(
+                fileobj=BytesIO(compressed[virtual_offset >> 16:]))
+            stream.read(virtual_offset & 0xffff)
+            self.assertEqual(stream.readline(), b'@read%d\n' % (record,))
+
+    def test_open_compressed_bgzf(self):
+        tempdir = tempfile.mkdtemp(prefix='compression_test')
+        try:
+            pathname = os.path.join(tempdir, 'out.fastq.gz')
+            with open_compressed(pathname, '.bgzf', 2) as stream:
+                stream.write(DATA)
+            with gzip.open(pathname, 'rb') as stream:
+                self.assertEqual(stream.read(), DATA)
+            entries, records, lines_per_record = load_record_index(
+                pathname + RECORD_INDEX_SUFFIX)
+            self.assertEqual(records, 5000)
+            self.assertEqual(lines_per_record, 4)
+            self.assertEqual(entries[0], (0, 0))
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_compress_file_checksums(self):
+        tempdir = tempfile.mkdtemp(prefix='compression_test')
+        try:
+            source = os.path.join(tempdir, 's_1_eland_result.txt')
+            with open(source, 'wb') as stream:
+                stream.write(DATA)
+            dest = source + '.bz2'
+            with ThreadPoolExecutor(2) as executor:
+                digests = compress_file(source, dest, '.bz2', 2,
+                                        checksums=('md5', 'sha256'),
+                                        executor=executor, block_size=10000)
+            with open(dest, 'rb') as stream:
+                compressed = stream.read()
+            self.assertEqual(bz2.decompress(compressed), DATA)
+            self.assertEqual(digests['md5'],
+                             hashlib.md5(compressed).hexdigest())
+            self.assertEqual(digests['sha256'],
+                             hashlib.sha256(compressed).hexdigest())
+            with open(dest + '.md5') as stream:
+                self.assertEqual(stream.read(),
+                                 '%s  %s\n' % (digests['md5'], dest))
+            self.assertTrue(has_checksums(dest, ('md5', 'sha256')))
+
+            copy = os.path.join(tempdir, 'copy.bz2')
+            self.assertEqual(copy_file(dest, copy), {'md5': digests['md5']})
+            os.unlink(copy + '.md5')
+            self.assertFalse(has_checksums(copy))
+            self.assertEqual(checksum_file(copy), {'md5': digests['md5']})
+            self.assertTrue(has_checksums(copy))
+
+            self.assertRaises(ValueError, copy_file, dest, copy, ('crc',))
+        finally:
+            shutil.rmtree(tempdir)
+
+
+def suite():
+    from unittest import TestSuite, defaultTestLoader
+    suite = TestSuite()
+    suite.addTests(defaultTestLoader.loadTestsFromTestCase(TestCompression))
+    return suite
+
+
+if __name__ == "__main__":
+    from unittest import main
+    main(defaultTest="suite")
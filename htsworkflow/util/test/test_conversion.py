@@ -14,6 +14,12 @@ class TestConversion(TestCase):
         self.assertEqual(s.start, 0)
         self.assertEqual(s.stop, 2)
 
+    def test_parse_sample(self):
+        self.assertEqual(conversion.parse_sample(None), None)
+        self.assertEqual(conversion.parse_sample("1000"), 1000)
+        self.assertEqual(conversion.parse_sample("0.01"), 0.01)
+        self.assertEqual(conversion.parse_sample("5%"), 0.05)
+
 def suite():
     from unittest import TestSuite, defaultTestLoader
     suite = TestSuite()
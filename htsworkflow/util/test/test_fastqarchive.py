@@ -0,0 +1,132 @@
+from io import BytesIO
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from htsworkflow.util import fastqarchive
+from htsworkflow.util.opener import autoopen
+
+FASTQ = b"""@HWI-ST0787:114:D0PMDACXX:8:1101:1605:2154 1:N:0:TAGCTT
+ACGTNACGTA
++
+@@@DDDDD?F
+@HWI-ST0787:114:D0PMDACXX:8:1101:1605:2155 1:Y:0:TAGCTT
+NNNNNNNNNN
++
+##########
+@HWI-ST0787:114:D0PMDACXX:8:1101:1602:2007 1:N:0:TAGCTT
+aagn.TTTTT
++HWI-ST0787:114:D0PMDACXX:8:1101:1602:2007 1:N:0:TAGCTT
+CDEFGHIJ5+
+@HWI-ST0787:114:D0PMDACXX:8:1102:003:0 1:N:0:TAGCTT
+GATTACA
++
+JJJJJJJ
+@other read
+C
++
+J
+"""
+
+
+class TestFastqArchive(TestCase):
+    def encode(self, data, bin_qualities=True, block_size=100):
+        archive = BytesIO()
+        records = fastqarchive.encode_fastq(BytesIO(data), archive,
+                                            bin_qualities, block_size)
+        archive.seek(0)
+        return records, archive
+
+    def test_headers(self):
+        headers = FASTQ.splitlines()[0::4]
+        flags, literals, changes, numbers = \
+            fastqarchive.encode_headers(headers)
+        # the second header has a changed filter flag, the third only
+        # differs by its numbers and the fourth has a zero padded number
+        self.assertEqual(flags, b'\x00\x02\x02\x00\x00')
+        self.assertEqual(literals.split(b'\n')[1:3], [b':Y:', b':N:'])
+        self.assertEqual(fastqarchive.decode_headers(
+            flags, literals, changes, numbers), headers)
+
+    def test_bases(self):
+        sequence = b''.join(FASTQ.splitlines()[1::4])
+        packed, positions, exceptions = fastqarchive.encode_bases(sequence)
+        self.assertEqual(len(packed), -(-len(sequence) // 4))
+        self.assertEqual(exceptions, b'NNNNNNNNNNNaagn.')
+        self.assertEqual(fastqarchive.decode_bases(
+            packed, positions, exceptions, len(sequence)), sequence)
+
+    def test_lossless_round_trip(self):
+        records, archive = self.encode(FASTQ, bin_qualities=False)
+        self.assertEqual(records, 5)
+        reader = fastqarchive.FastqArchiveReader(archive)
+        self.assertEqual(reader.read(), FASTQ)
+
+    def test_small_reads(self):
+        # several blocks, read in pieces that straddle their boundaries
+        records, archive = self.encode(FASTQ * 50, bin_qualities=False)
+        reader = fastqarchive.FastqArchiveReader(archive)
+        pieces = list(iter(lambda: reader.read(7), b''))
+        self.assertEqual(b''.join(pieces), FASTQ * 50)
+        self.assertTrue(all(len(piece) == 7 for piece in pieces[:-1]))
+
+        records, archive = self.encode(FASTQ * 50, bin_qualities=False)
+        reader = fastqarchive.FastqArchiveReader(archive)
+        self.assertEqual(list(reader), (FASTQ * 50).splitlines(True))
+
+    def test_binned_round_trip(self):
+        records, archive = self.encode(FASTQ * 50)
+        decoded = fastqarchive.FastqArchiveReader(archive).read().splitlines()
+        original = (FASTQ * 50).splitlines()
+        # everything but the qualities survives
+        for i in (0, 1, 2):
+            self.assertEqual(decoded[i::4], original[i::4])
+        binned = [q.translate(fastqarchive.QUALITY_BINS)
+                  for q in original[3::4]]
+        self.assertEqual(decoded[3::4], binned)
+        self.assertEqual(set(b''.join(decoded[3::4])),
+                         set(b"'07BFI"))
+
+    def test_bad_records(self):
+        self.assertRaises(ValueError, fastqarchive.encode_block,
+                          [b'@read', b'ACGT', b'+', b'III'])
+        self.assertRaises(ValueError, fastqarchive.FastqArchiveReader,
+                          BytesIO(b'@read\n'))
+
+    def test_autoopen(self):
+        tempdir = tempfile.mkdtemp(prefix='fastqarchive_test')
+        try:
+            source = os.path.join(tempdir, 'reads.fastq')
+            with open(source, 'wb') as stream:
+                stream.write(FASTQ)
+            archive = os.path.join(tempdir, 'reads.fqa')
+            fastqarchive.main(['--lossless', 'encode', source, archive])
+            with autoopen(archive, 'rb') as stream:
+                self.assertEqual(stream.read(), FASTQ)
+            with autoopen(archive, 'rt') as stream:
+                self.assertEqual(stream.readline(),
+                                 FASTQ.decode('ascii').splitlines(True)[0])
+
+            target = os.path.join(tempdir, 'decoded.fastq')
+            fastqarchive.main(['decode', archive, target])
+            with open(target, 'rb') as stream:
+                self.assertEqual(stream.read(), FASTQ)
+
+            results = fastqarchive.benchmark(source)
+            self.assertEqual([name for name, size, seconds in results],
+                             ['fastq', 'bzip2 -9', 'fqa'])
+        finally:
+            shutil.rmtree(tempdir)
+
+
+def suite():
+    from unittest import TestSuite, defaultTestLoader
+    suite = TestSuite()
+    suite.addTests(defaultTestLoader.loadTestsFromTestCase(TestFastqArchive))
+    return suite
+
+
+if __name__ == "__main__":
+    from unittest import main
+    main(defaultTest="suite")
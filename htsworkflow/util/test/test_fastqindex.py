@@ -0,0 +1,98 @@
+import gzip
+import hashlib
+from io import BytesIO
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from htsworkflow.util.fastqindex import SequenceIndex, IndexingWriter, \
+     make_sequence_index, load_sequence_index, save_sequence_index, \
+     get_sequence_index, has_sequence_index, sequence_index_name
+
+FASTQ = b"""@HWI-ST0787:114:D0PMDACXX:8:1101:1605:2154 1:N:0:TAGCTT
+ACGT
++
+ABCD
+@HWI-ST0787:114:D0PMDACXX:8:1101:1605:2155 1:Y:0:TAGCTT
+NNNN
++
+####
+@HWI-ST0787:114:D0PMDACXX:8:1101:1605:2157 1:N:0:TAGCTT
+TTTTT.
++
+EEEEEE
+"""
+
+
+class TestSequenceIndex(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='fastqindex_test')
+        self.pathname = os.path.join(self.tempdir, 'reads.fastq.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def check_index(self, index, copies=1):
+        self.assertEqual(index.reads, 3 * copies)
+        self.assertEqual(index.pass_qc, 2 * copies)
+        self.assertEqual(index.read_lengths, set([4, 6]))
+        self.assertEqual(index.read_length, None)
+        self.assertEqual(index.size, len(FASTQ) * copies)
+        self.assertEqual(index.md5, hashlib.md5(FASTQ * copies).hexdigest())
+
+    def test_make_index(self):
+        with gzip.open(self.pathname, 'wb') as stream:
+            stream.write(FASTQ)
+        self.assertFalse(has_sequence_index(self.pathname))
+
+        index = get_sequence_index(self.pathname)
+        self.check_index(index)
+        self.assertTrue(os.path.exists(sequence_index_name(self.pathname)))
+        self.check_index(load_sequence_index(self.pathname))
+
+    def test_indexing_writer(self):
+        data = FASTQ * 100
+        with IndexingWriter(gzip.open(self.pathname, 'wb'),
+                            self.pathname) as writer:
+            # write in pieces that split records and lines
+            for i in range(0, len(data), 37):
+                writer.write(data[i:i+37])
+        with gzip.open(self.pathname, 'rb') as stream:
+            self.assertEqual(stream.read(), data)
+
+        index = load_sequence_index(self.pathname)
+        self.check_index(index, 100)
+        self.assertEqual(index.to_dict(),
+                         make_sequence_index(self.pathname).to_dict())
+
+    def test_stale_index(self):
+        with gzip.open(self.pathname, 'wb') as stream:
+            stream.write(FASTQ)
+        index = make_sequence_index(self.pathname)
+        index.source_size += 1
+        save_sequence_index(self.pathname, index)
+        self.assertEqual(load_sequence_index(self.pathname), None)
+
+        with open(sequence_index_name(self.pathname), 'w') as stream:
+            stream.write('not json')
+        self.assertEqual(load_sequence_index(self.pathname), None)
+
+    def test_uniform_length(self):
+        index = SequenceIndex()
+        index.add_lines(FASTQ.splitlines()[:8])
+        self.assertEqual(index.read_length, 4)
+        copy = SequenceIndex.from_dict(index.to_dict())
+        self.assertEqual(copy.to_dict(), index.to_dict())
+
+
+def suite():
+    from unittest import TestSuite, defaultTestLoader
+    suite = TestSuite()
+    suite.addTests(defaultTestLoader.loadTestsFromTestCase(TestSequenceIndex))
+    return suite
+
+
+if __name__ == "__main__":
+    from unittest import main
+    main(defaultTest="suite")
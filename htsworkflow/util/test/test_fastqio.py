@@ -0,0 +1,122 @@
+import sys
+from io import BytesIO, StringIO
+from unittest import TestCase
+
+from htsworkflow.util.fastqio import read_fastq_batches, iter_fastq_records, \
+     FastqWriter, copy_fastq_batches, ThreadedReader
+
+FASTQ = b"""@read1 1:N:0:
+AGCT
++
+IIII
+@read2 1:Y:0:
+TTTTA
++
+@III#
+"""
+
+
+class TestFastqIO(TestCase):
+    def test_batches_hold_whole_records(self):
+        # small blocks split records and lines across reads
+        for block_size in (1, 3, 7, 1024):
+            batches = list(read_fastq_batches(BytesIO(FASTQ), block_size))
+            for lines in batches:
+                self.assertEqual(len(lines) % 4, 0)
+            lines = [line for batch in batches for line in batch]
+            self.assertEqual(lines, FASTQ.splitlines())
+
+    def test_text_and_crlf(self):
+        text = FASTQ.decode('ascii').replace('\n', '\r\n')
+        lines = next(read_fastq_batches(StringIO(text)))
+        self.assertEqual(lines, FASTQ.splitlines())
+
+    def test_missing_final_newline(self):
+        records = list(iter_fastq_records(BytesIO(FASTQ.rstrip())))
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[1], (b'@read2 1:Y:0:', b'TTTTA', b'+',
+                                      b'@III#'))
+
+    def test_partial_record(self):
+        truncated = BytesIO(FASTQ + b"@read3\nAGCT\n")
+        self.assertRaises(ValueError, list, read_fastq_batches(truncated))
+        truncated.seek(0)
+        batches = list(read_fastq_batches(truncated, allow_partial=True))
+        self.assertEqual(batches[-1], [b'@read3', b'AGCT'])
+
+    def test_writer(self):
+        binary = BytesIO()
+        writer = FastqWriter(binary, buffer_size=10)
+        writer.write_records([b'@a', b'@b'], [b'AC', b'GT'],
+                             [b'+', b'+'], [b'II', b'JJ'])
+        writer.write_lines([b'@c', b'A', b'+', b'I'])
+        writer.flush()
+        self.assertEqual(binary.getvalue(),
+                         b'@a\nAC\n+\nII\n@b\nGT\n+\nJJ\n@c\nA\n+\nI\n')
+
+        text = StringIO()
+        self.assertEqual(copy_fastq_batches(BytesIO(FASTQ), text), 2)
+        self.assertEqual(text.getvalue(), FASTQ.decode('ascii'))
+
+    def test_threaded_reader(self):
+        # blocks the same size as, and different sizes from, our reads
+        for block_size in (3, 5, 1024):
+            reader = ThreadedReader(BytesIO(FASTQ), block_size, max_blocks=2)
+            pieces = []
+            while True:
+                piece = reader.read(5)
+                if len(piece) == 0:
+                    break
+                pieces.append(piece)
+            self.assertEqual(b''.join(pieces), FASTQ)
+
+        reader = ThreadedReader(BytesIO(FASTQ), 4)
+        self.assertEqual(reader.read(2), FASTQ[:2])
+        self.assertEqual(reader.read(), FASTQ[2:])
+        self.assertEqual(reader.read(), b'')
+
+    def test_threaded_reader_close_early(self):
+        class Endless(object):
+            closed = False
+            def read(self, size):
+                return b'N' * size
+            def close(self):
+                self.closed = True
+        stream = Endless()
+        reader = ThreadedReader(stream, 4, max_blocks=1)
+        self.assertEqual(reader.read(4), b'NNNN')
+        reader.close()
+        self.assertFalse(reader._thread.is_alive())
+        self.assertTrue(stream.closed)
+
+    def test_threaded_reader_process(self):
+        from subprocess import Popen, PIPE, DEVNULL
+        process = Popen([sys.executable, '-c',
+                         'import sys\nwhile True: sys.stdout.write("N")'],
+                        stdout=PIPE, stderr=DEVNULL)
+        reader = ThreadedReader(process.stdout, 1024, max_blocks=1,
+                                process=process)
+        self.assertEqual(len(reader.read(1024)), 1024)
+        reader.close()
+        # the writer was stopped by the closed pipe instead of hanging
+        self.assertNotEqual(process.returncode, None)
+        self.assertFalse(reader._thread.is_alive())
+
+    def test_threaded_reader_error(self):
+        class Broken(object):
+            def read(self, size):
+                raise IOError("broken pipe")
+        reader = ThreadedReader(Broken())
+        self.assertRaises(IOError, reader.read, 10)
+
+
+def suite():
+    from unittest import TestSuite, defaultTestLoader
+    suite = TestSuite()
+    suite.addTests(defaultTestLoader.loadTestsFromTestCase(TestFastqIO))
+    return suite
+
+
+if __name__ == "__main__":
+    from unittest import main
+    main(defaultTest="suite")
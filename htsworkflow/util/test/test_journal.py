@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from htsworkflow.util.journal import Journal
+
+
+class TestJournal(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='journal_test')
+        self.pathname = os.path.join(self.tempdir, 'test.journal')
+        self.source = os.path.join(self.tempdir, 'source.txt')
+        with open(self.source, 'w') as stream:
+            stream.write('source')
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write_output(self, name, data):
+        self.calls.append(name)
+        with open(os.path.join(self.tempdir, name), 'w') as stream:
+            stream.write(data)
+
+    def test_run(self):
+        journal = Journal(self.pathname)
+        journal.run('copy', [self.source], ['out.txt', 'missing.txt'],
+                    self.write_output, 'out.txt', 'output')
+        journal.run('copy', [self.source], ['out.txt'],
+                    self.write_output, 'out.txt', 'output')
+        self.assertEqual(self.calls, ['out.txt'])
+        self.assertEqual(list(journal.entries['copy']['outputs']),
+                         ['out.txt'])
+
+        # a new journal reads what was recorded
+        journal = Journal(self.pathname)
+        self.assertTrue(journal.is_done('copy', [self.source]))
+        self.assertFalse(journal.is_done('other', [self.source]))
+
+    def test_changes(self):
+        journal = Journal(self.pathname)
+        journal.run('copy', [self.source], ['out.txt'],
+                    self.write_output, 'out.txt', 'output')
+
+        # truncated outputs need to be redone
+        self.write_output('out.txt', 'out')
+        self.assertFalse(journal.is_done('copy', [self.source]))
+        self.write_output('out.txt', 'output')
+        self.assertTrue(journal.is_done('copy', [self.source]))
+
+        # as do changed sources
+        with open(self.source, 'a') as stream:
+            stream.write('more')
+        self.assertFalse(journal.is_done('copy', [self.source]))
+
+    def test_incomplete_line(self):
+        journal = Journal(self.pathname)
+        journal.record('first')
+        with open(self.pathname, 'a') as stream:
+            stream.write('{"task": "sec')
+        journal = Journal(self.pathname)
+        self.assertEqual(list(journal.entries), ['first'])
+        journal.record('third')
+        journal = Journal(self.pathname)
+        self.assertEqual(sorted(journal.entries), ['first', 'third'])
+
+
+def suite():
+    from unittest import TestSuite, defaultTestLoader
+    suite = TestSuite()
+    suite.addTests(defaultTestLoader.loadTestsFromTestCase(TestJournal))
+    return suite
+
+
+if __name__ == "__main__":
+    from unittest import main
+    main(defaultTest="suite")
@@ -1,12 +1,17 @@
 from io import BytesIO
 import bz2
 import gzip
+import os
+import shutil
 import six
 import tempfile
 from unittest import TestCase, skipIf
 import requests_mock
 
-from htsworkflow.util.opener import isfilelike, isurllike, autoopen
+from htsworkflow.util.opener import isfilelike, isurllike, autoopen, \
+     has_record_index, open_record, open_shard
+from htsworkflow.util.compression import open_compressed, \
+     RECORD_INDEX_SUFFIX
 
 class TestOpener(TestCase):
     def test_isfilelike(self):
@@ -72,6 +77,57 @@ class TestOpener(TestCase):
             self.assertEqual(raw, 'hello')
         print('ran')
 
+
+class TestRecordIndex(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='opener_')
+        self.pathname = os.path.join(self.tempdir, 'reads.fastq.gz')
+        self.records = [b'@read%d\nAGCTAGCT\n+\nIIIIIIII\n' % (i,)
+                        for i in range(20000)]
+        with open_compressed(self.pathname, '.bgzf') as stream:
+            stream.write(b''.join(self.records))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_open_record(self):
+        self.assertTrue(has_record_index(self.pathname))
+        for record in (0, 1, 2047, 10001, 19999):
+            with open_record(self.pathname, record) as stream:
+                self.assertEqual(stream.read(), b''.join(self.records[record:]))
+        with open_record(self.pathname, 5, 8) as stream:
+            self.assertEqual(stream.read(), b''.join(self.records[5:7]))
+
+    def test_open_shard(self):
+        for shards in (1, 3, 7):
+            data = []
+            for shard in range(shards):
+                with open_shard(self.pathname, shard, shards) as stream:
+                    # small reads to exercise stopping mid block
+                    for block in iter(lambda: stream.read(1000), b''):
+                        data.append(block)
+            self.assertEqual(b''.join(data), b''.join(self.records))
+        self.assertRaises(ValueError, open_shard, self.pathname, 3, 3)
+
+    def test_stale_record_index(self):
+        # rewrite the file as plain gzip, leaving the old index behind
+        with gzip.open(self.pathname, 'wb') as stream:
+            stream.write(b''.join(self.records[:10]))
+        self.assertFalse(has_record_index(self.pathname))
+        self.assertRaises(ValueError, open_record, self.pathname, 5)
+        self.assertRaises(ValueError, open_shard, self.pathname, 0, 2)
+
+    def test_record_index_without_source(self):
+        # indexes from before we recorded the source's size and mtime
+        index = self.pathname + RECORD_INDEX_SUFFIX
+        with open(index, 'r') as stream:
+            lines = [line for line in stream
+                     if not line.startswith('#source_')]
+        with open(index, 'w') as stream:
+            stream.writelines(lines)
+        self.assertFalse(has_record_index(self.pathname))
+
+
 def gzip_compress(b):
     string_buffer = BytesIO()
     stream = gzip.GzipFile(mode='wb', fileobj=string_buffer)
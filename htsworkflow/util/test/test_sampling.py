@@ -0,0 +1,117 @@
+from io import BytesIO
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from htsworkflow.util.compression import open_compressed
+from htsworkflow.util.sampling import sample_records, find_record_start
+
+# quality lines starting with @ make finding records harder
+FASTQ = b''.join(b'@read%d\nAGCTAGCT\n+\n@IIIIIII\n' % (i,)
+                 for i in range(20000))
+
+
+def read_names(batches):
+    names = []
+    for lines in batches:
+        # every batch should hold whole records
+        assert len(lines) % 4 == 0
+        for header, plus in zip(lines[0::4], lines[2::4]):
+            assert header.startswith(b'@read') and plus == b'+'
+            names.append(int(header[5:]))
+    return names
+
+
+class TestSampling(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='sampling_test')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def make_file(self, name):
+        pathname = os.path.join(self.tempdir, name)
+        if name.endswith('.gz'):
+            stream = gzip.open(pathname, 'wb')
+        else:
+            stream = open(pathname, 'wb')
+        with stream:
+            stream.write(FASTQ)
+        return pathname
+
+    def test_find_record_start(self):
+        lines = FASTQ.split(b'\n')
+        self.assertEqual(find_record_start(lines[3:11]), 1)
+        self.assertEqual(find_record_start(lines[1:4]), None)
+        self.assertEqual(find_record_start(lines[3:11], 1), 0)
+
+    def test_seekable_spread_out(self):
+        pathname = self.make_file('reads.fastq')
+        names = read_names(sample_records(pathname, 640))
+        self.assertEqual(len(names), 640)
+        self.assertEqual(len(set(names)), 640)
+        # the sample should come from all over the file
+        self.assertTrue(min(names) < 1000)
+        self.assertTrue(max(names) > 19000)
+
+        names = read_names(sample_records(pathname, 0.01))
+        self.assertEqual(len(names), 256)
+
+    def test_indexed(self):
+        pathname = os.path.join(self.tempdir, 'reads.fastq.gz')
+        with open_compressed(pathname, '.bgzf') as stream:
+            stream.write(FASTQ)
+        names = read_names(sample_records(pathname, 100))
+        self.assertEqual(len(names), 128)
+        self.assertEqual(names[:2], [0, 1])
+        self.assertTrue(max(names) > 19000)
+
+        # most of the file is sampled as a stream
+        for fraction in [0.6, 0.9]:
+            names = read_names(sample_records(pathname, fraction, seed=1))
+            self.assertTrue(abs(len(names) - 20000 * fraction) < 500,
+                            (fraction, len(names)))
+
+    def test_stale_index(self):
+        pathname = os.path.join(self.tempdir, 'reads.fastq.gz')
+        with open_compressed(pathname, '.bgzf') as stream:
+            stream.write(FASTQ)
+        # a smaller rewrite leaves offsets in the index past its end
+        with gzip.open(pathname, 'wb') as stream:
+            stream.write(FASTQ[:FASTQ.index(b'@read5000\n')])
+        names = read_names(sample_records(pathname, 100, seed=1))
+        self.assertEqual(len(names), 100)
+        self.assertTrue(max(names) < 5000)
+
+    def test_stream_reservoir(self):
+        pathname = self.make_file('reads.fastq.gz')
+        names = read_names(sample_records(pathname, 100, seed=1))
+        self.assertEqual(len(names), 100)
+        self.assertEqual(len(set(names)), 100)
+        self.assertTrue(max(names) > 10000)
+        self.assertEqual(
+            names, read_names(sample_records(pathname, 100, seed=1)))
+
+        names = read_names(sample_records(BytesIO(FASTQ), 0.1, seed=1,
+                                          block_size=1000))
+        self.assertTrue(1600 < len(names) < 2400)
+
+    def test_most_of_file(self):
+        pathname = self.make_file('reads.fastq')
+        names = read_names(sample_records(pathname, 1.0))
+        self.assertEqual(names, list(range(20000)))
+        self.assertRaises(ValueError, sample_records, pathname, 2.0)
+
+
+def suite():
+    from unittest import TestSuite, defaultTestLoader
+    suite = TestSuite()
+    suite.addTests(defaultTestLoader.loadTestsFromTestCase(TestSampling))
+    return suite
+
+
+if __name__ == "__main__":
+    from unittest import main
+    main(defaultTest="suite")
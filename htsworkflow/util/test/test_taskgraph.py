@@ -0,0 +1,83 @@
+import threading
+import time
+from unittest import TestCase
+
+from htsworkflow.util.taskgraph import TaskGraph, DONE, FAILED, SKIPPED
+
+
+class TestTaskGraph(TestCase):
+    def setUp(self):
+        self.order = []
+        self.lock = threading.Lock()
+        self.running = 0
+        self.most_running = 0
+
+    def work(self, name, delay=0.01):
+        with self.lock:
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+        time.sleep(delay)
+        with self.lock:
+            self.running -= 1
+            self.order.append(name)
+
+    def fail(self):
+        raise RuntimeError("failed")
+
+    def test_dependencies(self):
+        graph = TaskGraph(4)
+        a = graph.add('a', self.work, ('a', 0.05))
+        b = graph.add('b', self.work, ('b',))
+        graph.add('c', self.work, ('c',), depends=[a, b])
+        graph.run()
+        self.assertEqual(self.order, ['b', 'a', 'c'])
+        self.assertEqual(self.most_running, 2)
+        self.assertRaises(ValueError, graph.add, 'd', self.work, depends=['e'])
+        self.assertRaises(ValueError, graph.add, 'a', self.work)
+
+    def test_num_jobs(self):
+        graph = TaskGraph(3)
+        for i in range(10):
+            graph.add(str(i), self.work, (i,), step='work')
+        graph.run()
+        self.assertEqual(len(self.order), 10)
+        self.assertEqual(self.most_running, 3)
+        count, elapsed = graph.step_timings()['work']
+        self.assertEqual(count, 10)
+        self.assertTrue(elapsed >= 0.1)
+
+    def test_added_while_running(self):
+        graph = TaskGraph(2)
+
+        def plan():
+            for name in 'xyz':
+                graph.add(name, self.work, (name,))
+
+        first = graph.add('first', self.work, ('first',))
+        graph.add('plan', plan, depends=[first])
+        graph.run()
+        self.assertEqual(self.order[0], 'first')
+        self.assertEqual(sorted(self.order[1:]), ['x', 'y', 'z'])
+
+    def test_failure(self):
+        graph = TaskGraph(2)
+        bad = graph.add('bad', self.fail)
+        graph.add('after', self.work, ('after',), depends=[bad])
+        graph.add('other', self.work, ('other',))
+        self.assertRaises(RuntimeError, graph.run)
+        self.assertEqual(self.order, ['other'])
+        self.assertEqual(graph.tasks['bad'].state, FAILED)
+        self.assertEqual(graph.tasks['after'].state, SKIPPED)
+        self.assertEqual(graph.tasks['other'].state, DONE)
+
+
+def suite():
+    from unittest import TestSuite, defaultTestLoader
+    suite = TestSuite()
+    suite.addTests(defaultTestLoader.loadTestsFromTestCase(TestTaskGraph))
+    return suite
+
+
+if __name__ == "__main__":
+    from unittest import main
+    main(defaultTest="suite")
@@ -1,6 +1,11 @@
+import bz2
+from contextlib import redirect_stdout
+import gzip
 import logging
 import os
+import shutil
 from six.moves import StringIO
+import tempfile
 from unittest import TestCase
 
 from htsworkflow.util import validate
@@ -52,11 +57,72 @@ class TestValidate(TestCase):
         errors = validate.validate_fastq(q)
         self.assertEqual(1, errors)
 
+    def test_truncated_record(self):
+        q = StringIO(u"@ abc\nAGCT\n+\nBBBB\n@ abcd\nAGCT\n")
+        result = validate.check_fastq(q)
+        self.assertEqual(result.records, 2)
+        self.assertEqual(dict(result.errors_by_class),
+                         {validate.TRUNCATED: 1})
+
+    def test_error_classes(self):
+        q = StringIO(u"@ abc\nAGXT\n+\nBBB\n@ abcd\nAGCT\n+x!\nBBBB\n")
+        result = validate.check_fastq(q, max_reports=2)
+        self.assertEqual(result.records, 2)
+        self.assertEqual(dict(result.errors_by_class),
+                         {validate.SEQ: 1, validate.QUAL_LEN: 1,
+                          validate.H2: 1})
+        self.assertEqual(result.first_errors,
+                         [(2, validate.SEQ, b'AGXT'),
+                          (4, validate.QUAL_LEN, b'BBB')])
+
+    def test_unicode_header(self):
+        q = StringIO(u"@ ab\u00e9\nAGCT\n+\nBBBB\n")
+        self.assertEqual(validate.validate_fastq(q), 0)
+
+
+class TestValidateMain(TestCase):
+    def setUp(self):
+        logging.disable(logging.ERROR)
+        self.tempdir = tempfile.mkdtemp(prefix='validate_test')
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(self.tempdir)
+
+    def test_compressed_files(self):
+        good = os.path.join(self.tempdir, 'good.fastq.gz')
+        with gzip.open(good, 'wb') as stream:
+            stream.write(b"@ abc\nAGCT\n+\nBBBB\n" * 100)
+        bad = os.path.join(self.tempdir, 'bad.fastq.bz2')
+        with bz2.open(bad, 'wb') as stream:
+            stream.write(b"@ abc\nAGCT\n+\nBBBB\n>oops\nAGCT\n+\nBBBB\n")
+
+        for args in [[], ['-j', '2']]:
+            cmdline = ['htsw-validate', '--fastq', '--format', 'phred33']
+            report = StringIO()
+            with redirect_stdout(report):
+                self.assertEqual(validate.main(cmdline + args + [good]), 0)
+                self.assertEqual(
+                    validate.main(cmdline + args + [good, bad]), 1)
+            self.assertIn('Total: 102 records, 1 errors', report.getvalue())
+
+        result = validate._validate_file(
+            (bad, 'phred33', False, None, 10, None))
+        self.assertEqual(result.records, 2)
+        self.assertEqual(result.first_errors, [(5, validate.H1, b'>oops')])
+
+        report = StringIO()
+        with redirect_stdout(report):
+            self.assertEqual(validate.main(
+                cmdline + ['--sample', '10', good]), 0)
+        self.assertIn('10 records, 0 errors', report.getvalue())
+
 
 def suite():
     from unittest import TestSuite, defaultTestLoader
     suite = TestSuite()
-    suite.addTests(defaultTestLoader.loadTestsFromTestCase(testValidate))
+    suite.addTests(defaultTestLoader.loadTestsFromTestCase(TestValidate))
+    suite.addTests(defaultTestLoader.loadTestsFromTestCase(TestValidateMain))
     return suite
 
 
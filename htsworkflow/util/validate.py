@@ -1,34 +1,89 @@
 #!/usr/bin/env python
+from collections import Counter
+import multiprocessing
 from optparse import OptionParser
 import os
 import re
 import sys
 import logging
 
+from htsworkflow.util.conversion import parse_sample
+from htsworkflow.util.fastqio import read_fastq_batches
+from htsworkflow.util.opener import autoopen
+from htsworkflow.util.sampling import sample_records
+
 LOGGER = logging.getLogger(__name__)
 
+def _byte_set(characters):
+    return bytes(bytearray(sorted(set(ord(c) for c in characters))))
+
+WHITESPACE = ' \t\n\r\x0b\x0c'
+WORD = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_'
+# what may follow the @ or + of a header
+HEADER_CHARS = _byte_set(WHITESPACE + WORD + ':-')
+SEQUENCE_CHARS = _byte_set('AGCT.Nagct.n')
+QUALITY_CHARS = {
+    'phred33': _byte_set(chr(c) for c in range(ord('!'), ord('J') + 1)),
+    'phred64': _byte_set(chr(c) for c in range(ord('@'), ord('h') + 1)),
+}
+
+# error classes and the messages we log them with
+H1 = 'H1'
+SEQ = 'SEQ'
+SEQ_LEN = 'SEQ LEN'
+H2 = 'H2'
+QUAL = 'QUAL'
+QUAL_LEN = 'QUAL LEN'
+TRUNCATED = 'TRUNCATED'
+ERROR_CLASSES = (H1, SEQ, SEQ_LEN, H2, QUAL, QUAL_LEN, TRUNCATED)
+
+# headers may also contain non-ascii word characters
+UNICODE_HEADER_RE = re.compile(r"^[\s\w:-]*$")
+
+
 def main(cmdline=None):
     parser = make_parser()
     opts, args = parser.parse_args(cmdline)
 
+    if opts.verbose:
+        logging.basicConfig(level=logging.INFO)
+    else:
+        logging.basicConfig(level=logging.WARN)
+
+    if not opts.fastq:
+        return 0
+
+    filenames = args[1:]
+    sample = parse_sample(opts.sample)
+    tasks = [(filename, opts.format, opts.uniform_lengths, opts.max_errors,
+              opts.report_errors, sample) for filename in filenames]
+    if opts.max_jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(opts.max_jobs, len(tasks)))
+        try:
+            results = pool.map(_validate_file, tasks, 1)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        results = [_validate_file(task) for task in tasks]
+
     error_happened = False
-    for filename in args[1:]:
-        stream = open(filename, 'r')
-        
-        if opts.fastq:
-            errors = validate_fastq(stream,
-                                    opts.format,
-                                    opts.uniform_lengths,
-                                    opts.max_errors)
-            if errors > 0:
-                LOGGER.error("%s failed validation", filename)
-                error_happened = True
-
-        stream.close()
+    total = FastqValidation()
+    for filename, result in zip(filenames, results):
+        if result.errors > 0:
+            LOGGER.error("%s failed validation", filename)
+            error_happened = True
+        print(result.format_report(filename))
+        total += result
+    if len(results) > 1:
+        print(total.format_report('Total', show_errors=False))
 
     if error_happened:
         return 1
-    
+
     return 0
 
 def make_parser():
@@ -43,10 +98,65 @@ def make_parser():
                       choices=encodings,
                       default='phred64',
                       help="choose quality encoding one of: %s" % (", ".join(encodings)))
-                      
+    parser.add_option("-j", "--max-jobs", type="int", default=1,
+                      help="number of files to validate at once")
+    parser.add_option("--report-errors", type="int", default=10,
+                      help="number of errors to list for each file")
+    parser.add_option("--sample", default=None,
+                      help="only check a fraction (e.g. 0.01 or 1%) or "
+                           "number of records from each file, line "
+                           "numbers are then counted within the sample")
+    parser.add_option("-v", "--verbose", action="store_true", default=False,
+                      help="show information about what we're doing")
+
     return parser
 
 
+class FastqValidation(object):
+    """Results of checking a fastq file
+
+    errors_by_class counts errors for each of ERROR_CLASSES, first_errors
+    holds (line number, error class, line) for the first errors found.
+    """
+    def __init__(self, max_reports=10):
+        self.records = 0
+        self.errors_by_class = Counter()
+        self.first_errors = []
+        self.max_reports = max_reports
+
+    @property
+    def errors(self):
+        return sum(self.errors_by_class.values())
+
+    def add_error(self, error_class, line_number, line):
+        self.errors_by_class[error_class] += 1
+        if len(self.first_errors) < self.max_reports:
+            self.first_errors.append((line_number, error_class, line))
+
+    def __iadd__(self, other):
+        self.records += other.records
+        self.errors_by_class.update(other.errors_by_class)
+        room = self.max_reports - len(self.first_errors)
+        self.first_errors.extend(other.first_errors[:max(room, 0)])
+        return self
+
+    def format_report(self, name, show_errors=True):
+        """Return a short text report of what we found
+        """
+        report = ['%s: %d records, %d errors' % (
+            name, self.records, self.errors)]
+        for error_class in ERROR_CLASSES:
+            if self.errors_by_class[error_class] > 0:
+                report.append('  FAIL %s: %d' % (
+                    error_class, self.errors_by_class[error_class]))
+        if show_errors:
+            for line_number, error_class, line in self.first_errors:
+                report.append('  [%d] FAIL %s: %s' % (
+                    line_number, error_class,
+                    line.decode('utf-8', 'replace')))
+        return os.linesep.join(report)
+
+
 def validate_fastq(stream, format='phred33', uniform_length=False, max_errors=None):
     """Validate that a fastq file isn't corrupted
 
@@ -55,77 +165,151 @@ def validate_fastq(stream, format='phred33', uniform_length=False, max_errors=No
 
     returns number of errors found
     """
-    FQ_NONE = 0
-    FQ_H1 = 1
-    FQ_SEQ = 2
-    FQ_H2 = 3
-    FQ_QUAL = 4
-    h1_re = re.compile("^@[\s\w:-]*$")
-    seq_re = re.compile("^[AGCT.N]+$", re.IGNORECASE)
-    h2_re = re.compile("^\+[\s\w:-]*$")
-    phred33 = re.compile("^[!\"#$%&'()*+,-./0123456789:;<=>?@ABCDEFGHIJ]+$")
-    phred64 = re.compile("^[@ABCDEFGHIJKLMNOPQRSTUVWXYZ[\]^_`abcdefgh]+$")
-
-    if format == 'phred33':
-        quality_re = phred33
-    elif format == 'phred64':
-        quality_re = phred64
-    else:
+    result = check_fastq(stream, format, uniform_length, max_errors)
+    for line_number, error_class, line in result.first_errors:
+        LOGGER.error("FAIL %s [%d]: %s", error_class, line_number,
+                     line.decode('utf-8', 'replace'))
+    return result.errors
+
+
+def check_fastq(stream, format='phred33', uniform_length=False,
+                max_errors=None, max_reports=10):
+    """Check a fastq stream a block at a time
+
+    Each block is first checked as a whole with bytes.translate; only
+    blocks with a problem are looked at line by line to find and
+    classify the errors.
+
+    returns a FastqValidation
+    """
+    batches = read_fastq_batches(stream, allow_partial=True)
+    return check_fastq_batches(batches, format, uniform_length, max_errors,
+                               max_reports)
+
+
+def check_fastq_batches(batches, format='phred33', uniform_length=False,
+                        max_errors=None, max_reports=10):
+    """Check lists of fastq lines, such as from read_fastq_batches
+
+    returns a FastqValidation
+    """
+    if format not in QUALITY_CHARS:
         raise ValueError("Unrecognized quality format name")
+    quality_chars = QUALITY_CHARS[format]
 
-    state = FQ_H1
+    result = FastqValidation(max_reports)
     length = None
     line_number = 1
-    errors = 0
-    for line in stream:
-        line = line.rstrip()
-        len_errors = 0
-        if state == FQ_H1:
-            # reset length at start of new record for non-uniform check
-            if not uniform_length:
-                length = None
-            # start of record checks
-            errors += validate_re(h1_re, line, line_number, "FAIL H1")
-            state = FQ_SEQ
-        elif state == FQ_SEQ:
-            errors += validate_re(seq_re, line, line_number, "FAIL SEQ")
-            length, len_errors = validate_length(line, length, line_number,
-                                                 "FAIL SEQ LEN")
-            errors += len_errors
-            state = FQ_H2
-        elif state == FQ_H2:
-            errors += validate_re(h2_re, line, line_number, "FAIL H2")
-            state = FQ_QUAL
-        elif state == FQ_QUAL:
-            errors += validate_re(quality_re, line, line_number, "FAIL QUAL")
-            length, len_errors = validate_length(line, length, line_number,
-                                                 "FAIL QUAL LEN")
-            errors += len_errors
-            state = FQ_H1
+    for lines in batches:
+        result.records += (len(lines) + 3) // 4
+        block_length = _check_block(lines, quality_chars, uniform_length,
+                                    length)
+        if block_length is not False:
+            if uniform_length:
+                length = block_length
         else:
-            raise RuntimeError("Invalid state: %d" % (state,))
-        line_number += 1
-        if max_errors is not None and errors > max_errors:
+            length = _check_lines(lines, line_number, quality_chars,
+                                  uniform_length, length, result)
+        line_number += len(lines)
+        if max_errors is not None and result.errors > max_errors:
             break
-        
-    return errors
 
-def validate_re(pattern, line, line_number, errmsg):
-    if pattern.match(line) is None:
-        LOGGER.error("%s [%d]: %s", errmsg, line_number, line)
-        return 1
-    else:
-        return 0
+    return result
+
+
+def _check_block(lines, quality_chars, uniform_length, length):
+    """Quickly check if a block of fastq lines is valid
+
+    Returns False if there's something wrong, otherwise the read
+    length seen if the reads all have the same length.
+    """
+    if len(lines) % 4 != 0:
+        return False
+    headers = lines[0::4]
+    sequences = lines[1::4]
+    quality_headers = lines[2::4]
+    qualities = lines[3::4]
+
+    sequence_lengths = list(map(len, sequences))
+    if sequence_lengths != list(map(len, qualities)):
+        return False
+    if min(sequence_lengths) == 0:
+        return False
+    if uniform_length:
+        lengths = set(sequence_lengths)
+        if length is not None:
+            lengths.add(length)
+        if len(lengths) != 1:
+            return False
+        length = lengths.pop()
+
+    if b''.join([h[:1] for h in headers]) != b'@' * len(headers):
+        return False
+    if b''.join([h[:1] for h in quality_headers]) != \
+       b'+' * len(quality_headers):
+        return False
+    header_bodies = b''.join([h[1:] for h in headers + quality_headers])
+    if len(header_bodies.translate(None, HEADER_CHARS)) > 0:
+        return False
+    if len(b''.join(sequences).translate(None, SEQUENCE_CHARS)) > 0:
+        return False
+    if len(b''.join(qualities).translate(None, quality_chars)) > 0:
+        return False
+    return length
+
 
-def validate_length(line, line_length, line_number, errmsg):
+def _check_lines(lines, line_number, quality_chars, uniform_length, length,
+                 result):
+    """Find the errors in a block of fastq lines one line at a time
+
+    returns the current read length
     """
-    if line_length is None, sets it
+    checks = [(H1, b'@', HEADER_CHARS),
+              (SEQ, None, SEQUENCE_CHARS),
+              (H2, b'+', HEADER_CHARS),
+              (QUAL, None, quality_chars)]
+    for i, line in enumerate(lines):
+        line = line.rstrip()
+        state = i % 4
+        error_class, prefix, allowed = checks[state]
+        if state == 0 and not uniform_length:
+            # reset length at start of new record for non-uniform check
+            length = None
+
+        if prefix is not None:
+            valid = line.startswith(prefix) and \
+                len(line[1:].translate(None, allowed)) == 0
+            if not valid and line.startswith(prefix) and \
+               max(bytearray(line)) > 127:
+                header = line[1:].decode('utf-8', 'replace')
+                valid = UNICODE_HEADER_RE.match(header) is not None
+        else:
+            valid = len(line) > 0 and len(line.translate(None, allowed)) == 0
+        if not valid:
+            result.add_error(error_class, line_number + i, line)
+
+        if state in (1, 3):
+            line_length = len(line)
+            if not valid:
+                # count characters, not bytes, in a mangled line
+                line_length = len(line.decode('utf-8', 'replace'))
+            if length is None:
+                length = line_length
+            elif line_length != length:
+                result.add_error(error_class + ' LEN', line_number + i, line)
+
+    if len(lines) % 4 != 0:
+        result.add_error(TRUNCATED, line_number + len(lines) - 1, lines[-1])
+    return length
+
+
+def _validate_file(task):
+    """Validate a (possibly compressed) fastq file for main
     """
-    error_count = 0
-    if line_length is None:
-        line_length = len(line)
-    elif len(line) != line_length:
-        LOGGER.error("%s %d: %s", errmsg, line_number, line)
-        error_count = 1
-    return line_length, error_count
-    
+    filename, format, uniform_length, max_errors, max_reports, sample = task
+    if sample is not None:
+        return check_fastq_batches(sample_records(filename, sample), format,
+                                   uniform_length, max_errors, max_reports)
+    with autoopen(filename, 'rb') as stream:
+        return check_fastq(stream, format, uniform_length, max_errors,
+                           max_reports)
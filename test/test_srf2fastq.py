@@ -1,3 +1,4 @@
+from io import BytesIO
 import os
 from six.moves import StringIO
 import sys
@@ -38,6 +39,21 @@ IIIIB+++
         self.assertEqual(lines2[2].rstrip(), '+')
         self.assertEqual(lines2[3].rstrip(), 'B+++')
 
+    def test_split_threaded_reader(self):
+        records = b"".join(b"@header%d\nAGCTTTTT\n+\nIIIIB+++\n" % (i,)
+                           for i in range(1000))
+        source = srf2fastq.ThreadedReader(BytesIO(records), 1000, 2)
+        target1 = BytesIO()
+        target2 = BytesIO()
+
+        srf2fastq.convert_single_to_two_fastq(source, target1, target2)
+
+        lines1 = target1.getvalue().split()
+        lines2 = target2.getvalue().split()
+        self.assertEqual(len(lines1), 4000)
+        self.assertEqual(lines1[-4:], [b'@header999/1', b'AGCT', b'+', b'IIII'])
+        self.assertEqual(lines2[-4:], [b'@header999/2', b'TTTT', b'+', b'B+++'])
+
     def test_split_at_with_header(self):
         source = StringIO("""@header1
 AGCTTTTT